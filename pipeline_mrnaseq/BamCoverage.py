@@ -0,0 +1,302 @@
+"""Normalised, binned bigWig coverage tracks from an indexed BAM file.
+
+Reproduces the ``bamCoverage`` (deeptools) settings used by
+:file:`pipeline_mrnaseq.py` without its per-region overheads:
+
+* chromosomes are counted in parallel in a process pool, each worker
+  fetching its chromosome from the BAM index and counting reads per
+  bin into a NumPy array (a read counts once in each bin its aligned
+  blocks overlap)
+* reads are filtered on mapping quality and SAM flags
+  (``--min-mapq``, ``--flag-include``, ``--flag-exclude``)
+* bins are smoothed with a running mean over ``--smooth-length``
+  bases and normalised by BPM, CPM, RPKM or not at all. CPM & RPKM
+  use the reads passing the same filters as library size, as
+  deeptools does, counted by the workers in the same pass
+* runs of equal bins are written straight to bigWig with pyBigWig,
+  empty bins are skipped
+* for stranded libraries (``--strandedness``) plus & minus strand
+  tracks are counted in the same pass, each read assigned to the
+  strand of the transcript it came from. Strand tracks share the
+  scale of the combined track, so plus + minus = combined
+
+Usage::
+
+   python BamCoverage.py --bin-size 5 --smooth-length 10
+                         --normalize-using BPM --min-mapq 255
+                         --flag-include 64 --threads 8
+                         --strandedness RF
+                         --plus star.dir/a.coverage.plus.bw
+                         --minus star.dir/a.coverage.minus.bw
+                         star.dir/a.bam star.dir/a.coverage.bw
+
+"""
+import sys
+import array
+import argparse
+import multiprocessing
+import numpy as np
+import pysam
+import pyBigWig
+
+
+NORMALISATIONS = ("BPM", "CPM", "RPKM", "None")
+
+
+def readBins(read, bin_size):
+    '''Return (first, last + 1) bins overlapped by the aligned blocks
+       of a read, each bin counted once'''
+
+    bins = []
+    last = -1
+
+    for start, end in read.get_blocks():
+        first = max(start // bin_size, last + 1)
+        last_block = (end - 1) // bin_size
+        if first <= last_block:
+            bins.append((first, last_block + 1))
+            last = last_block
+
+    return bins
+
+
+def keepRead(read, min_mapq, flag_include, flag_exclude):
+    '''True if a read passes the mapping quality & flag filters'''
+
+    return read.mapping_quality >= min_mapq and \
+        (read.flag & flag_include) == flag_include and \
+        not read.flag & flag_exclude
+
+
+def transcriptStrand(read, strandedness):
+    '''Return 0 if a read comes from a plus strand transcript, 1 if
+       from the minus strand. strandedness is FR/F (first read on the
+       transcript strand) or RF/R (first read antisense, e.g. dUTP)'''
+
+    read_one = not read.is_paired or read.is_read1
+    sense = read_one == (strandedness in ("FR", "F"))
+
+    return int(read.is_reverse == sense)
+
+
+def binCounts(starts, ends, nbins):
+    '''Reads per bin from the (first, last + 1) bins of each read'''
+
+    depth = np.zeros(nbins + 1, np.int64)
+
+    np.add.at(depth, np.minimum(np.frombuffer(starts, np.int64), nbins), 1)
+    np.add.at(depth, np.minimum(np.frombuffer(ends, np.int64), nbins), -1)
+
+    return np.cumsum(depth[:-1])
+
+
+def sparseTrack(counts, smooth_bins):
+    '''Return positions & values of the non-empty smoothed bins'''
+
+    values = smooth(counts, smooth_bins)
+    bins = np.flatnonzero(values)
+
+    return bins, values[bins].astype(np.float32)
+
+
+def countChromosome(args):
+    '''Count reads per bin on one chromosome. Returns the chromosome,
+       a dict of track: (positions, values) of non-empty smoothed bins,
+       the sum of raw bin counts of the combined track and the number
+       of reads counted. Tracks are "combined", and "plus" & "minus"
+       if strandedness is given'''
+
+    (bamfile, chrom, length, bin_size, smooth_bins,
+     min_mapq, flag_include, flag_exclude, strandedness) = args
+
+    nbins = (length + bin_size - 1) // bin_size
+    nreads = 0
+
+    # bins of reads on each transcript strand, all in [0] if unstranded
+    starts = (array.array("q"), array.array("q"))
+    ends = (array.array("q"), array.array("q"))
+
+    with pysam.AlignmentFile(bamfile) as bam:
+        for read in bam.fetch(chrom):
+            if not keepRead(read, min_mapq, flag_include, flag_exclude):
+                continue
+
+            nreads += 1
+            strand = transcriptStrand(read, strandedness) if strandedness else 0
+
+            for first, last in readBins(read, bin_size):
+                starts[strand].append(first)
+                ends[strand].append(last)
+
+    if strandedness:
+        plus = binCounts(starts[0], ends[0], nbins)
+        minus = binCounts(starts[1], ends[1], nbins)
+        combined = plus + minus
+        tracks = {"plus": sparseTrack(plus, smooth_bins),
+                  "minus": sparseTrack(minus, smooth_bins)}
+    else:
+        combined = binCounts(starts[0], ends[0], nbins)
+        tracks = {}
+
+    tracks["combined"] = sparseTrack(combined, smooth_bins)
+
+    return chrom, tracks, int(combined.sum()), nreads
+
+
+def smooth(counts, smooth_bins):
+    '''Running mean over smooth_bins bins centred on each bin'''
+
+    if smooth_bins <= 1:
+        return counts.astype(np.float64)
+
+    window = np.ones(smooth_bins) / smooth_bins
+    return np.convolve(counts, window, mode="same")
+
+
+def smoothBins(smooth_length, bin_size):
+    '''Bins in the smoothing window, odd so it is centred (as deeptools)'''
+
+    if not smooth_length or smooth_length <= bin_size:
+        return 1
+
+    n = int(smooth_length / bin_size)
+    return n + 1 if n % 2 == 0 else n
+
+
+def scaleFactor(method, bin_size, total, library_size):
+    '''Return factor scaling raw bin counts for a normalisation method'''
+
+    if method == "BPM":
+        return 1e6 / total if total else 0.0
+    elif method == "CPM":
+        return 1e6 / library_size if library_size else 0.0
+    elif method == "RPKM":
+        return 1e6 / library_size / (bin_size / 1000) if library_size else 0.0
+
+    return 1.0
+
+
+def runs(bins, values):
+    '''Merge consecutive bins with equal values, returns run start & end
+       bins and values'''
+
+    if len(bins) == 0:
+        return bins, bins, values
+
+    new = np.ones(len(bins), bool)
+    new[1:] = (bins[1:] != bins[:-1] + 1) | (values[1:] != values[:-1])
+
+    starts = np.flatnonzero(new)
+    ends = np.append(starts[1:], len(bins))
+
+    return bins[starts], bins[ends - 1] + 1, values[starts]
+
+
+def writeBigWig(outfile, chromosomes, results, bin_size, scale):
+    '''Write scaled bin values per chromosome to a bigWig file.
+       results are (chrom, bins, values) in the order of chromosomes'''
+
+    bw = pyBigWig.open(outfile, "w")
+    bw.addHeader(chromosomes)
+    lengths = dict(chromosomes)
+
+    for chrom, bins, values in results:
+        run_starts, run_ends, run_values = runs(bins, (values * scale).astype(np.float32))
+
+        if len(run_starts) == 0:
+            continue
+
+        starts = run_starts * bin_size
+        ends = np.minimum(run_ends * bin_size, lengths[chrom])
+
+        bw.addEntries([chrom] * len(starts), starts.tolist(),
+                      ends=ends.tolist(), values=run_values.tolist())
+
+    bw.close()
+
+
+def bamCoverage(bamfile, outfile, bin_size=5, smooth_length=10,
+                normalize_using="BPM", min_mapq=0, flag_include=0,
+                flag_exclude=4, threads=1, strandedness=None,
+                plus=None, minus=None):
+    '''Write a normalised coverage track of bamfile to outfile, and
+       for stranded libraries plus & minus strand tracks to plus and
+       minus, from a single pass over the BAM'''
+
+    if strandedness not in ("FR", "F", "RF", "R"):
+        strandedness = None
+    elif not (plus and minus):
+        raise ValueError("stranded coverage needs plus & minus outputs")
+
+    if str(normalize_using) not in NORMALISATIONS:
+        raise ValueError("unsupported normalisation '%s', use one of %s" %
+                         (normalize_using, ", ".join(NORMALISATIONS)))
+
+    with pysam.AlignmentFile(bamfile) as bam:
+        chromosomes = list(zip(bam.references, bam.lengths))
+
+    smooth_bins = smoothBins(smooth_length, bin_size)
+
+    jobs = [(bamfile, chrom, length, bin_size, smooth_bins,
+             min_mapq, flag_include, flag_exclude, strandedness)
+            for chrom, length in chromosomes]
+
+    # largest chromosomes first keeps the pool busy, results are
+    # collected in header order for writing
+    order = sorted(range(len(jobs)), key=lambda x: -jobs[x][2])
+
+    with multiprocessing.Pool(threads) as pool:
+        counted = dict(zip(order, pool.map(countChromosome, [jobs[x] for x in order],
+                                           chunksize=1)))
+
+    results = [counted[x] for x in range(len(jobs))]
+
+    total = sum(x[2] for x in results)
+    library_size = sum(x[3] for x in results)
+
+    scale = scaleFactor(normalize_using, bin_size, total, library_size)
+
+    outfiles = {"combined": outfile}
+    if strandedness:
+        outfiles.update({"plus": plus, "minus": minus})
+
+    for track, path in outfiles.items():
+        writeBigWig(path, chromosomes,
+                    [(chrom,) + tracks[track] for chrom, tracks, total, nreads in results],
+                    bin_size, scale)
+
+    return library_size
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("bam", help="coordinate sorted, indexed BAM file")
+    parser.add_argument("bigwig", help="output bigWig file, both strands")
+    parser.add_argument("--bin-size", type=int, default=5)
+    parser.add_argument("--smooth-length", type=int, default=10)
+    parser.add_argument("--normalize-using", default="BPM",
+                        help="one of %s" % ", ".join(NORMALISATIONS))
+    parser.add_argument("--min-mapq", type=int, default=0)
+    parser.add_argument("--flag-include", type=int, default=0,
+                        help="only count reads with all of these SAM flags")
+    parser.add_argument("--flag-exclude", type=int, default=4,
+                        help="skip reads with any of these SAM flags")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--strandedness", default=None,
+                        help="library strandedness (RF, FR, R or F) for strand tracks")
+    parser.add_argument("--plus", default=None, help="output plus strand bigWig")
+    parser.add_argument("--minus", default=None, help="output minus strand bigWig")
+
+    args = parser.parse_args(argv)
+
+    bamCoverage(args.bam, args.bigwig, bin_size=args.bin_size,
+                smooth_length=args.smooth_length,
+                normalize_using=args.normalize_using,
+                min_mapq=args.min_mapq, flag_include=args.flag_include,
+                flag_exclude=args.flag_exclude, threads=args.threads,
+                strandedness=args.strandedness, plus=args.plus, minus=args.minus)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
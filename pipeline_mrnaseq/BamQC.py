@@ -0,0 +1,544 @@
+"""Single pass alignment & RNA-seq QC of a coordinate sorted BAM file.
+
+Each BAM is streamed once, computing together:
+
+* alignment summary statistics, per read category (as picard
+  CollectAlignmentSummaryMetrics)
+* strand orientation of reads overlapping genes
+* coding, UTR, intronic & intergenic base counts from a refFlat file
+* coverage over the normalised length of the longest transcript of
+  each gene, for 5'/3' bias & the coverage histogram (as picard
+  CollectRnaSeqMetrics)
+
+Output tables have the columns of the picard metrics they replace,
+so they load into the ``picardAlignmentSummary`` and
+``picardRNAseqMetrics`` tables unchanged. Metrics that need data
+picard is given but this pass is not are left empty: ribosomal
+bases (no rRNA intervals), BAD_CYCLES, and mismatch rates for BAMs
+without NM tags. PCT_ADAPTER is empty too: picard matches unaligned
+reads to its adapter sequences allowing for mismatches, which a
+substring test would not reproduce.
+
+Reads are collected per chromosome in chunks, and bases are assigned
+to annotation classes and transcript coverage with NumPy, so memory
+is bounded by ``--chunk-size`` and the largest chromosome's
+transcripts.
+
+Usage::
+
+   python BamQC.py --refflat refFlat.txt --strandedness RF
+                   --alignment-stats bam.dir/a.picardAlignmentStats.txt
+                   --rnaseq-metrics bam.dir/a.picardRNAseqMetrics.txt
+                   --coverage-histogram bam.dir/a.picardRNAseqMetrics.hist.txt
+                   bam.dir/a.bam
+
+"""
+import sys
+import gzip
+import array
+import argparse
+import collections
+import numpy as np
+import pandas as pd
+import pysam
+
+
+ALIGNMENT_COLUMNS = [
+    "CATEGORY", "TOTAL_READS", "PF_READS", "PCT_PF_READS", "PF_NOISE_READS",
+    "PF_READS_ALIGNED", "PCT_PF_READS_ALIGNED", "PF_ALIGNED_BASES",
+    "PF_HQ_ALIGNED_READS", "PF_HQ_ALIGNED_BASES", "PF_HQ_ALIGNED_Q20_BASES",
+    "PF_HQ_MEDIAN_MISMATCHES", "PF_MISMATCH_RATE", "PF_HQ_ERROR_RATE",
+    "PF_INDEL_RATE", "MEAN_READ_LENGTH", "READS_ALIGNED_IN_PAIRS",
+    "PCT_READS_ALIGNED_IN_PAIRS", "PF_READS_IMPROPER_PAIRS",
+    "PCT_PF_READS_IMPROPER_PAIRS", "BAD_CYCLES", "STRAND_BALANCE",
+    "PCT_CHIMERAS", "PCT_ADAPTER", "SAMPLE", "LIBRARY", "READ_GROUP"]
+
+RNASEQ_COLUMNS = [
+    "PF_BASES", "PF_ALIGNED_BASES", "RIBOSOMAL_BASES", "CODING_BASES",
+    "UTR_BASES", "INTRONIC_BASES", "INTERGENIC_BASES", "IGNORED_READS",
+    "CORRECT_STRAND_READS", "INCORRECT_STRAND_READS",
+    "NUM_R1_TRANSCRIPT_STRAND_READS", "NUM_R2_TRANSCRIPT_STRAND_READS",
+    "NUM_UNEXPLAINED_READS", "PCT_R1_TRANSCRIPT_STRAND_READS",
+    "PCT_R2_TRANSCRIPT_STRAND_READS", "PCT_RIBOSOMAL_BASES",
+    "PCT_CODING_BASES", "PCT_UTR_BASES", "PCT_INTRONIC_BASES",
+    "PCT_INTERGENIC_BASES", "PCT_MRNA_BASES", "PCT_USABLE_BASES",
+    "PCT_CORRECT_STRAND_READS", "MEDIAN_CV_COVERAGE", "MEDIAN_5PRIME_BIAS",
+    "MEDIAN_3PRIME_BIAS", "MEDIAN_5PRIME_TO_3PRIME_BIAS", "SAMPLE",
+    "LIBRARY", "READ_GROUP"]
+
+# annotation classes, higher classes take precedence where they overlap
+INTERGENIC, INTRONIC, UTR, CODING = 0, 1, 2, 3
+
+# picard defaults
+MIN_MAPQ_HQ = 20
+MAX_INSERT_SIZE = 100000
+MIN_TRANSCRIPT_LENGTH = 500
+TOP_TRANSCRIPTS = 1000
+END_BIAS_BASES = 100
+
+
+def ratio(a, b):
+    '''a / b, 0 if b is 0 (as picard)'''
+
+    return a / b if b else 0.0
+
+
+def strandSpecificity(strandedness):
+    '''Return picard STRAND_SPECIFICITY for the pipeline's strandedness'''
+
+    if strandedness in ("RF", "R"):
+        return "SECOND_READ_TRANSCRIPTION_STRAND"
+    elif strandedness in ("FR", "F"):
+        return "FIRST_READ_TRANSCRIPTION_STRAND"
+
+    return "NONE"
+
+
+# ---------------------------------------------------
+# Annotation
+
+def readRefFlat(infile):
+    '''Return a dict of chromosome: list of transcripts from a refFlat
+       file, as (gene, strand, tx_start, tx_end, cds_start, cds_end, exons)'''
+
+    opener = gzip.open if infile.endswith(".gz") else open
+    transcripts = collections.defaultdict(list)
+
+    with opener(infile, "rt") as inf:
+        for line in inf:
+            fields = line.rstrip("\n").split("\t")
+            if line.startswith("#") or len(fields) < 11:
+                continue
+
+            starts = [int(x) for x in fields[9].rstrip(",").split(",")]
+            ends = [int(x) for x in fields[10].rstrip(",").split(",")]
+
+            transcripts[fields[2]].append(
+                (fields[0], fields[3], int(fields[4]), int(fields[5]),
+                 int(fields[6]), int(fields[7]), list(zip(starts, ends))))
+
+    return transcripts
+
+
+def segments(intervals, levels):
+    '''Partition a chromosome at the boundaries of intervals, a list of
+       (start, end, level). Returns the boundaries and the highest level
+       covering each segment between consecutive boundaries (0 if none)'''
+
+    intervals = [x for x in intervals if x[0] < x[1]]
+    if not intervals:
+        return np.zeros(1, np.int64), np.zeros(0, np.int8)
+
+    iv = np.array(intervals, dtype=np.int64)
+    bounds = np.unique(iv[:, :2])
+    level = np.zeros(len(bounds) - 1, np.int8)
+
+    for k in range(1, levels + 1):
+        selected = iv[iv[:, 2] == k]
+        depth = np.zeros(len(bounds), np.int64)
+        np.add.at(depth, np.searchsorted(bounds, selected[:, 0]), 1)
+        np.add.at(depth, np.searchsorted(bounds, selected[:, 1]), -1)
+        level[np.cumsum(depth)[:-1] > 0] = k
+
+    return bounds, level
+
+
+def cumulativeBases(bounds, level, k, x):
+    '''Number of bases in segments of level k before each position in x'''
+
+    if len(level) == 0:
+        return np.zeros(len(x), np.int64)
+
+    inside = level == k
+    cum = np.concatenate([[0], np.cumsum(np.diff(bounds) * inside)])
+
+    i = np.searchsorted(bounds, x, side="right") - 1
+    j = np.clip(i, 0, len(level) - 1)
+
+    bases = np.where(i >= len(level), cum[-1], cum[j] + (x - bounds[j]) * inside[j])
+
+    return np.where(i < 0, 0, bases)
+
+
+def levelBases(bounds, level, k, starts, ends):
+    '''Number of bases of intervals [starts, ends) in segments of level k'''
+
+    return (cumulativeBases(bounds, level, k, ends) -
+            cumulativeBases(bounds, level, k, starts))
+
+
+def chromosomeAnnotation(transcripts):
+    '''Build the per chromosome annotation used to classify aligned
+       bases and reads: base class segments, gene segments per strand,
+       and the exonic positions of the longest transcript of each gene'''
+
+    regions = []
+    genes = {"+": [], "-": []}
+    longest = {}
+
+    for gene, strand, tx_start, tx_end, cds_start, cds_end, exons in transcripts:
+        regions.append((tx_start, tx_end, INTRONIC))
+        genes[strand].append((tx_start, tx_end, 1))
+
+        for start, end in exons:
+            regions.append((start, end, UTR))
+            regions.append((max(start, cds_start), min(end, cds_end), CODING))
+
+        length = sum(end - start for start, end in exons)
+        if length >= MIN_TRANSCRIPT_LENGTH and \
+           length > longest.get(gene, (0, None, None))[0]:
+            longest[gene] = (length, strand, exons)
+
+    selected = list(longest.values())
+
+    if selected:
+        positions = np.concatenate([np.arange(start, end, dtype=np.int64)
+                                    for length, strand, exons in selected
+                                    for start, end in exons])
+    else:
+        positions = np.zeros(0, np.int64)
+
+    return {"classes": segments(regions, CODING),
+            "+": segments(genes["+"], 1),
+            "-": segments(genes["-"], 1),
+            "transcripts": [(length, strand) for length, strand, exons in selected],
+            "positions": positions,
+            "coverage": np.zeros(len(positions), np.int64)}
+
+
+# ---------------------------------------------------
+# Streaming
+
+def newBuffers():
+    '''Buffers of aligned blocks & reads for the current chunk'''
+
+    return {"starts": array.array("q"), "ends": array.array("q"),
+            "read_starts": array.array("q"), "read_ends": array.array("q"),
+            "read_flags": array.array("b")}
+
+
+def flushChunk(annotation, buffers, rna, specificity):
+    '''Assign the aligned bases and reads in buffers to annotation
+       classes, strands and transcript coverage'''
+
+    starts = np.frombuffer(buffers["starts"], dtype=np.int64)
+    ends = np.frombuffer(buffers["ends"], dtype=np.int64)
+
+    if len(starts) == 0:
+        return
+
+    bounds, level = annotation["classes"]
+    aligned = int((ends - starts).sum())
+    classified = 0
+    for k, column in ((CODING, "CODING_BASES"), (UTR, "UTR_BASES"),
+                      (INTRONIC, "INTRONIC_BASES")):
+        n = int(levelBases(bounds, level, k, starts, ends).sum())
+        rna[column] += n
+        classified += n
+
+    rna["INTERGENIC_BASES"] += aligned - classified
+
+    # strand of reads overlapping genes on one strand only
+    read_starts = np.frombuffer(buffers["read_starts"], dtype=np.int64)
+    read_ends = np.frombuffer(buffers["read_ends"], dtype=np.int64)
+    flags = np.frombuffer(buffers["read_flags"], dtype=np.int8)
+
+    plus = levelBases(*annotation["+"], 1, read_starts, read_ends) > 0
+    minus = levelBases(*annotation["-"], 1, read_starts, read_ends) > 0
+    one = plus ^ minus
+
+    negative_read = (flags & 1) > 0
+    read_one = (flags & 2) > 0
+    r1_strand = read_one == (minus == negative_read)
+
+    rna["NUM_R1_TRANSCRIPT_STRAND_READS"] += int((one & r1_strand).sum())
+    rna["NUM_R2_TRANSCRIPT_STRAND_READS"] += int((one & ~r1_strand).sum())
+    rna["NUM_UNEXPLAINED_READS"] += int((plus & minus).sum())
+
+    if specificity != "NONE":
+        correct = r1_strand if specificity.startswith("FIRST") else ~r1_strand
+        rna["CORRECT_STRAND_READS"] += int((one & correct).sum())
+        rna["INCORRECT_STRAND_READS"] += int((one & ~correct).sum())
+
+    # coverage of transcript positions, p is covered by [s, e) if s <= p < e
+    positions = annotation["positions"]
+    if len(positions):
+        annotation["coverage"] += (
+            np.searchsorted(np.sort(starts), positions, side="right") -
+            np.searchsorted(np.sort(ends), positions, side="right"))
+
+
+def transcriptProfiles(annotation):
+    '''Return (mean coverage, normalised coverage profile, CV, 5' bias,
+       3' bias) of covered transcripts on a chromosome, 5' to 3' '''
+
+    profiles = []
+    offset = 0
+
+    for length, strand in annotation["transcripts"]:
+        coverage = annotation["coverage"][offset:offset + length].astype(np.float64)
+        offset += length
+
+        if strand == "-":
+            coverage = coverage[::-1]
+
+        mean = coverage.mean()
+        if mean == 0:
+            continue
+
+        bins = np.arange(length) * 101 // length
+        profile = np.bincount(bins, coverage, 101) / np.bincount(bins, minlength=101)
+
+        profiles.append((mean, profile / mean, coverage.std() / mean,
+                         coverage[:END_BIAS_BASES].mean() / mean,
+                         coverage[-END_BIAS_BASES:].mean() / mean))
+
+    return profiles
+
+
+def bamQC(bamfile, refflat, strandedness=None, chunk_size=5000000):
+    '''Stream a coordinate sorted BAM once and return the alignment
+       summary, RNA-seq metrics and coverage histogram tables'''
+
+    annotations = readRefFlat(refflat)
+    specificity = strandSpecificity(strandedness)
+
+    categories = ("UNPAIRED", "FIRST_OF_PAIR", "SECOND_OF_PAIR")
+    stats = {x: collections.Counter() for x in categories}
+    mismatches = {x: collections.Counter() for x in categories}
+    rna = collections.Counter()
+    profiles = []
+
+    tid = None
+    annotation = None
+    buffers = newBuffers()
+
+    with pysam.AlignmentFile(bamfile) as bam:
+        for read in bam.fetch(until_eof=True):
+            if read.is_secondary or read.is_supplementary:
+                continue
+
+            category = categories[read.is_paired * (1 + read.is_read2)]
+            c = stats[category]
+            c["TOTAL_READS"] += 1
+
+            if read.is_qcfail:
+                continue
+
+            length = read.infer_read_length() or read.query_length
+            c["PF_READS"] += 1
+            c["PF_BASES"] += length
+
+            if read.is_unmapped:
+                if not (read.query_sequence or "").strip("AN"):
+                    c["PF_NOISE_READS"] += 1
+                continue
+
+            blocks = read.get_blocks()
+            aligned = sum(end - start for start, end in blocks)
+            hq = read.mapping_quality >= MIN_MAPQ_HQ
+
+            c["PF_READS_ALIGNED"] += 1
+            c["PF_ALIGNED_BASES"] += aligned
+            c["FORWARD_READS"] += not read.is_reverse
+
+            operations, events = read.get_cigar_stats()
+            c["INDEL_EVENTS"] += events[1] + events[2]
+
+            if read.has_tag("NM"):
+                mismatch = read.get_tag("NM") - operations[1] - operations[2]
+                c["NM_READS"] += 1
+                c["MISMATCHES"] += mismatch
+            else:
+                mismatch = None
+
+            if hq:
+                c["PF_HQ_ALIGNED_READS"] += 1
+                c["PF_HQ_ALIGNED_BASES"] += aligned
+                qualities = read.query_alignment_qualities
+                if qualities is not None:
+                    c["PF_HQ_ALIGNED_Q20_BASES"] += int(
+                        (np.frombuffer(qualities, dtype=np.uint8) >= 20).sum())
+                if mismatch is not None:
+                    c["HQ_MISMATCHES"] += mismatch
+                    mismatches[category][mismatch] += 1
+
+            if read.is_paired and not read.mate_is_unmapped:
+                c["READS_ALIGNED_IN_PAIRS"] += 1
+                c["PF_READS_IMPROPER_PAIRS"] += not read.is_proper_pair
+                c["CHIMERAS"] += (read.reference_id != read.next_reference_id or
+                                  abs(read.template_length) > MAX_INSERT_SIZE)
+
+            if read.reference_id != tid:
+                if annotation is not None:
+                    flushChunk(annotation, buffers, rna, specificity)
+                    profiles.extend(transcriptProfiles(annotation))
+                    buffers = newBuffers()
+
+                tid = read.reference_id
+                annotation = chromosomeAnnotation(annotations.get(read.reference_name, []))
+
+            for start, end in blocks:
+                buffers["starts"].append(start)
+                buffers["ends"].append(end)
+
+            buffers["read_starts"].append(read.reference_start)
+            buffers["read_ends"].append(read.reference_end)
+            buffers["read_flags"].append(
+                read.is_reverse + 2 * (not read.is_paired or read.is_read1))
+
+            if len(buffers["starts"]) >= chunk_size:
+                flushChunk(annotation, buffers, rna, specificity)
+                buffers = newBuffers()
+
+    if annotation is not None:
+        flushChunk(annotation, buffers, rna, specificity)
+        profiles.extend(transcriptProfiles(annotation))
+
+    # alignment summary, per category and for pairs
+    if stats["FIRST_OF_PAIR"]["TOTAL_READS"] or stats["SECOND_OF_PAIR"]["TOTAL_READS"]:
+        rows = ["FIRST_OF_PAIR", "SECOND_OF_PAIR", "PAIR"]
+        stats["PAIR"] = stats["FIRST_OF_PAIR"] + stats["SECOND_OF_PAIR"]
+        mismatches["PAIR"] = mismatches["FIRST_OF_PAIR"] + mismatches["SECOND_OF_PAIR"]
+    else:
+        rows = ["UNPAIRED"]
+
+    alignment = pd.DataFrame([alignmentMetrics(x, stats[x], mismatches[x]) for x in rows],
+                             columns=ALIGNMENT_COLUMNS)
+
+    # RNA-seq metrics
+    rna["PF_BASES"] = sum(stats[x]["PF_BASES"] for x in categories)
+    rna["PF_ALIGNED_BASES"] = sum(stats[x]["PF_ALIGNED_BASES"] for x in categories)
+
+    top = sorted(profiles, key=lambda x: x[0], reverse=True)[:TOP_TRANSCRIPTS]
+
+    rnaseq = pd.DataFrame([rnaseqMetrics(rna, top)], columns=RNASEQ_COLUMNS)
+
+    if top:
+        coverage = np.mean([x[1] for x in top], axis=0)
+    else:
+        coverage = np.zeros(101)
+
+    histogram = pd.DataFrame({"normalized_position": np.arange(101),
+                              "All_Reads.normalized_coverage": coverage})
+
+    return alignment, rnaseq, histogram
+
+
+def medianCount(counts):
+    '''Median of values in a Counter of value: occurrences'''
+
+    total = sum(counts.values())
+    if total == 0:
+        return 0
+
+    seen = 0
+    for value in sorted(counts):
+        seen += counts[value]
+        if seen * 2 >= total:
+            return value
+
+
+def alignmentMetrics(category, c, mismatches):
+    '''Return a row of CollectAlignmentSummaryMetrics for a category'''
+
+    has_nm = c["NM_READS"] > 0
+
+    return {"CATEGORY": category,
+            "TOTAL_READS": c["TOTAL_READS"],
+            "PF_READS": c["PF_READS"],
+            "PCT_PF_READS": ratio(c["PF_READS"], c["TOTAL_READS"]),
+            "PF_NOISE_READS": c["PF_NOISE_READS"],
+            "PF_READS_ALIGNED": c["PF_READS_ALIGNED"],
+            "PCT_PF_READS_ALIGNED": ratio(c["PF_READS_ALIGNED"], c["PF_READS"]),
+            "PF_ALIGNED_BASES": c["PF_ALIGNED_BASES"],
+            "PF_HQ_ALIGNED_READS": c["PF_HQ_ALIGNED_READS"],
+            "PF_HQ_ALIGNED_BASES": c["PF_HQ_ALIGNED_BASES"],
+            "PF_HQ_ALIGNED_Q20_BASES": c["PF_HQ_ALIGNED_Q20_BASES"],
+            "PF_HQ_MEDIAN_MISMATCHES": medianCount(mismatches) if has_nm else None,
+            "PF_MISMATCH_RATE": ratio(c["MISMATCHES"], c["PF_ALIGNED_BASES"]) if has_nm else None,
+            "PF_HQ_ERROR_RATE": ratio(c["HQ_MISMATCHES"], c["PF_HQ_ALIGNED_BASES"]) if has_nm else None,
+            "PF_INDEL_RATE": ratio(c["INDEL_EVENTS"], c["PF_ALIGNED_BASES"]),
+            "MEAN_READ_LENGTH": ratio(c["PF_BASES"], c["PF_READS"]),
+            "READS_ALIGNED_IN_PAIRS": c["READS_ALIGNED_IN_PAIRS"],
+            "PCT_READS_ALIGNED_IN_PAIRS": ratio(c["READS_ALIGNED_IN_PAIRS"],
+                                                c["PF_READS_ALIGNED"]),
+            "PF_READS_IMPROPER_PAIRS": c["PF_READS_IMPROPER_PAIRS"],
+            "PCT_PF_READS_IMPROPER_PAIRS": ratio(c["PF_READS_IMPROPER_PAIRS"],
+                                                 c["PF_READS_ALIGNED"]),
+            "BAD_CYCLES": None,
+            "STRAND_BALANCE": ratio(c["FORWARD_READS"], c["PF_READS_ALIGNED"]),
+            "PCT_CHIMERAS": ratio(c["CHIMERAS"], c["READS_ALIGNED_IN_PAIRS"]),
+            "PCT_ADAPTER": None}
+
+
+def rnaseqMetrics(rna, top):
+    '''Return the row of CollectRnaSeqMetrics from base & read counts
+       and the profiles of the most highly covered transcripts'''
+
+    aligned = rna["PF_ALIGNED_BASES"]
+    mrna = rna["CODING_BASES"] + rna["UTR_BASES"]
+    stranded = rna["NUM_R1_TRANSCRIPT_STRAND_READS"] + rna["NUM_R2_TRANSCRIPT_STRAND_READS"]
+
+    def median(column):
+        return float(np.median([x[column] for x in top])) if top else 0.0
+
+    bias5, bias3 = median(3), median(4)
+
+    row = {x: rna[x] for x in ("PF_BASES", "PF_ALIGNED_BASES", "CODING_BASES",
+                               "UTR_BASES", "INTRONIC_BASES", "INTERGENIC_BASES",
+                               "IGNORED_READS", "CORRECT_STRAND_READS",
+                               "INCORRECT_STRAND_READS",
+                               "NUM_R1_TRANSCRIPT_STRAND_READS",
+                               "NUM_R2_TRANSCRIPT_STRAND_READS",
+                               "NUM_UNEXPLAINED_READS")}
+
+    row.update({"RIBOSOMAL_BASES": None,
+                "PCT_R1_TRANSCRIPT_STRAND_READS": ratio(rna["NUM_R1_TRANSCRIPT_STRAND_READS"], stranded),
+                "PCT_R2_TRANSCRIPT_STRAND_READS": ratio(rna["NUM_R2_TRANSCRIPT_STRAND_READS"], stranded),
+                "PCT_RIBOSOMAL_BASES": None,
+                "PCT_CODING_BASES": ratio(rna["CODING_BASES"], aligned),
+                "PCT_UTR_BASES": ratio(rna["UTR_BASES"], aligned),
+                "PCT_INTRONIC_BASES": ratio(rna["INTRONIC_BASES"], aligned),
+                "PCT_INTERGENIC_BASES": ratio(rna["INTERGENIC_BASES"], aligned),
+                "PCT_MRNA_BASES": ratio(mrna, aligned),
+                "PCT_USABLE_BASES": ratio(mrna, rna["PF_BASES"]),
+                "PCT_CORRECT_STRAND_READS": ratio(rna["CORRECT_STRAND_READS"],
+                                                  rna["CORRECT_STRAND_READS"] +
+                                                  rna["INCORRECT_STRAND_READS"]),
+                "MEDIAN_CV_COVERAGE": median(2),
+                "MEDIAN_5PRIME_BIAS": bias5,
+                "MEDIAN_3PRIME_BIAS": bias3,
+                "MEDIAN_5PRIME_TO_3PRIME_BIAS": ratio(bias5, bias3)})
+
+    return row
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("bam", help="coordinate sorted BAM file")
+    parser.add_argument("--refflat", required=True, help="refFlat gene annotation")
+    parser.add_argument("--strandedness", default=None,
+                        help="library strandedness: RF, FR, R, F or none")
+    parser.add_argument("--alignment-stats", required=True,
+                        help="output alignment summary table")
+    parser.add_argument("--rnaseq-metrics", required=True,
+                        help="output RNA-seq metrics table")
+    parser.add_argument("--coverage-histogram", required=True,
+                        help="output normalised transcript coverage table")
+    parser.add_argument("--chunk-size", type=int, default=5000000,
+                        help="aligned blocks processed at a time")
+
+    args = parser.parse_args(argv)
+
+    alignment, rnaseq, histogram = bamQC(args.bam, args.refflat,
+                                         args.strandedness, args.chunk_size)
+
+    alignment.to_csv(args.alignment_stats, sep="\t", index=False)
+    rnaseq.to_csv(args.rnaseq_metrics, sep="\t", index=False)
+    histogram.to_csv(args.coverage_histogram, sep="\t", index=False)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,497 @@
+"""Benchmarks of the Python stages of :file:`pipeline_mrnaseq.py` on a
+synthetic RNA-seq project.
+
+A fixture is generated for each scale (number of samples): fastq
+file names, a transcript to gene map, salmon ``quant.sf`` files,
+featureCounts tables counted in batches and picard metric tables.
+The stages below are then run on it, each in a fresh process, and
+their wall time and peak memory (RSS) recorded:
+
+* sample_info      - parsing sample names (makeSampleInfoTable)
+* salmon_genes     - summing quant.sf over genes (salmonGeneTable)
+* salmon_load      - loading quant.sf files into csvdb (loadSalmon)
+* featurecounts    - merging featureCounts batches (featureCount)
+* featurecounts_load - loading the merged counts (loadFeatureCount)
+* picard_load      - loading picard metric tables (load* picard tasks)
+* matrix_store     - writing & reading the counts matrix store
+* report_bundle    - writing & loading the report data bundle (reportData)
+* expression_stats - the report notebook's expression QC (ExpressionStats.py)
+* sample_correlation - sample correlations & distances, uncached
+                     (sampleCorrelation)
+
+Nothing but Python, NumPy and pandas is needed, i.e. no STAR, salmon,
+picard or cluster.
+
+Results are written as a table. With ``--baseline`` they are
+compared to those of an earlier run (``--output``) and the script
+exits with status 1 if a stage got slower or bigger than
+``--threshold`` (fractional increase) allows::
+
+   python BenchmarkMrnaseq.py --samples 10,100,1000 --output baseline.tsv
+   ...
+   python BenchmarkMrnaseq.py --samples 10,100,1000 --baseline baseline.tsv
+
+"""
+import os
+import sys
+import time
+import sqlite3
+import argparse
+import resource
+import tempfile
+import traceback
+import multiprocessing
+from queue import Empty
+import numpy as np
+import pandas as pd
+import PipelineMrnaseq
+import MatrixStore
+import ExpressionStats
+import SampleCorrelation
+import ReportData
+import CsvDB
+
+
+CONDITIONS = ["WT", "KO"]
+TREATMENTS = ["0hr", "2hr", "6hr", "24hr"]
+
+# samples per featureCounts batch, as featurecounts_batch_size
+BATCH_SIZE = 100
+
+# a subset of the picard metric columns, enough to be representative
+ALIGNMENT_COLUMNS = ["CATEGORY", "TOTAL_READS", "PF_READS", "PF_READS_ALIGNED",
+                     "PCT_PF_READS_ALIGNED", "PF_ALIGNED_BASES",
+                     "PF_MISMATCH_RATE", "MEAN_READ_LENGTH",
+                     "READS_ALIGNED_IN_PAIRS", "STRAND_BALANCE", "PCT_CHIMERAS"]
+
+RNASEQ_COLUMNS = ["PF_BASES", "PF_ALIGNED_BASES", "CODING_BASES", "UTR_BASES",
+                  "INTRONIC_BASES", "INTERGENIC_BASES", "CORRECT_STRAND_READS",
+                  "INCORRECT_STRAND_READS", "PCT_CODING_BASES", "PCT_MRNA_BASES",
+                  "MEDIAN_CV_COVERAGE", "MEDIAN_5PRIME_TO_3PRIME_BIAS"]
+
+RESULT_COLUMNS = ["stage", "samples", "genes", "seconds", "peak_rss_mb", "status"]
+
+
+# ---------------------------------------------------
+# Synthetic fixture
+
+def sampleNames(nsamples):
+    '''Return nsamples names following the pipeline naming convention,
+       condition_treatment_replicate'''
+
+    groups = [(c, t) for c in CONDITIONS for t in TREATMENTS]
+    replicates = -(-nsamples // len(groups))
+
+    names = [f"{c}_{t}_R{r + 1}" for r in range(replicates) for c, t in groups]
+
+    return sorted(names[:nsamples])
+
+
+def writeFixture(outdir, nsamples, ngenes, transcripts_per_gene=4, seed=1):
+    '''Write a synthetic project with nsamples samples and ngenes genes
+       to outdir. Returns a dict describing it'''
+
+    rng = np.random.RandomState(seed)
+    samples = sampleNames(nsamples)
+
+    genes = np.array([f"ENSG{x:011d}" for x in range(ngenes)])
+    transcripts = np.array([f"ENST{x:011d}" for x in range(ngenes * transcripts_per_gene)])
+    transcript_genes = np.repeat(genes, transcripts_per_gene)
+    lengths = rng.randint(300, 8000, len(transcripts))
+
+    for subdir in ("data.dir", "salmon.dir", "read_counts.dir", "bam.dir"):
+        os.makedirs(os.path.join(outdir, subdir), exist_ok=True)
+
+    # transcript to gene map, as written by the annotation cache
+    tx2gene = os.path.join(outdir, "transcript2gene.tsv")
+    pd.DataFrame({"transcript_id": transcripts,
+                  "gene_id": transcript_genes,
+                  "gene_name": np.char.replace(transcript_genes, "ENSG", "GENE")}
+                 ).to_csv(tx2gene, sep="\t", index=False)
+
+    # per transcript expression levels shared by samples, with sample noise
+    expression = rng.lognormal(2, 2, len(transcripts))
+
+    quants = {}
+    for sample in samples:
+        open(os.path.join(outdir, "data.dir", f"{sample}.fastq.1.gz"), "w").close()
+        open(os.path.join(outdir, "data.dir", f"{sample}.fastq.2.gz"), "w").close()
+
+        reads = rng.poisson(expression * rng.lognormal(0, 0.3, len(transcripts)))
+        effective = np.maximum(lengths - 200, 1).astype(float)
+        rate = reads / effective
+        tpm = rate / rate.sum() * 1e6
+
+        quant = os.path.join(outdir, "salmon.dir", sample, "quant.sf")
+        os.makedirs(os.path.dirname(quant), exist_ok=True)
+        pd.DataFrame({"Name": transcripts, "Length": lengths,
+                      "EffectiveLength": effective, "TPM": tpm,
+                      "NumReads": reads.astype(float)}
+                     ).to_csv(quant, sep="\t", index=False, float_format="%.6g")
+        quants[sample] = quant
+
+    # featureCounts tables, one per batch of samples
+    annotation = pd.DataFrame({"Chr": "1",
+                               "Start": (np.arange(ngenes) * 10000 + 1).astype(str),
+                               "End": (np.arange(ngenes) * 10000 + 5000).astype(str),
+                               "Strand": "+",
+                               "Length": 5000},
+                              index=pd.Index(genes, name="Geneid"))
+
+    batches = []
+    for n in range(0, nsamples, BATCH_SIZE):
+        batch = samples[n:n + BATCH_SIZE]
+        table = os.path.join(outdir, "read_counts.dir", f"featureCounts.batch{len(batches)}.txt")
+
+        counts = pd.DataFrame(rng.poisson(rng.lognormal(3, 2, (ngenes, 1)),
+                                          (ngenes, len(batch))),
+                              index=annotation.index,
+                              columns=[f"bam.dir/{x}.bam" for x in batch])
+
+        with open(table, "w") as outf:
+            outf.write("# Program:featureCounts v1.6.3; Command:\"featureCounts\"\n")
+            pd.concat([annotation, counts], axis=1).to_csv(outf, sep="\t")
+
+        summary = pd.DataFrame(rng.randint(0, 1000000, (3, len(batch))),
+                               index=pd.Index(["Assigned", "Unassigned_NoFeatures",
+                                               "Unassigned_Ambiguity"], name="Status"),
+                               columns=counts.columns)
+        summary.to_csv(table + ".summary", sep="\t")
+
+        batches.append(table)
+
+    # picard metric tables, one of each per sample
+    alignment_stats = []
+    rnaseq_metrics = []
+    for sample in samples:
+        prefix = os.path.join(outdir, "bam.dir", sample)
+
+        stats = pd.DataFrame(rng.rand(3, len(ALIGNMENT_COLUMNS) - 1) * 1e6,
+                             columns=ALIGNMENT_COLUMNS[1:])
+        stats.insert(0, "CATEGORY", ["FIRST_OF_PAIR", "SECOND_OF_PAIR", "PAIR"])
+        stats.to_csv(prefix + ".picardAlignmentStats.txt", sep="\t", index=False)
+        alignment_stats.append(prefix + ".picardAlignmentStats.txt")
+
+        metrics = pd.DataFrame(rng.rand(1, len(RNASEQ_COLUMNS)) * 1e6,
+                               columns=RNASEQ_COLUMNS)
+        metrics.to_csv(prefix + ".picardRNAseqMetrics.txt", sep="\t", index=False)
+        rnaseq_metrics.append(prefix + ".picardRNAseqMetrics.txt")
+
+    # annotation database with the tables the report bundle joins
+    anndb = os.path.join(outdir, "annotations.db")
+    dbh = sqlite3.connect(anndb)
+    pd.DataFrame({"gene_id": genes,
+                  "gene_name": np.char.replace(genes, "ENSG", "GENE")}
+                 ).to_sql("gene_info", dbh, index=False)
+    pd.DataFrame({"contig": "1", "start": np.arange(len(transcripts)) * 2500,
+                  "end": np.arange(len(transcripts)) * 2500 + 2000,
+                  "gene_id": transcript_genes,
+                  "transcript_biotype": np.where(rng.rand(len(transcripts)) < 0.6,
+                                                 "protein_coding", "lncRNA")}
+                 ).to_sql("geneset_all_gtf_genome_coordinates", dbh, index=False)
+    dbh.close()
+
+    return {"dir": outdir,
+            "anndb": anndb,
+            "samples": samples,
+            "genes": ngenes,
+            "tx2gene": tx2gene,
+            "quants": quants,
+            "featurecounts": batches,
+            "alignment_stats": alignment_stats,
+            "rnaseq_metrics": rnaseq_metrics}
+
+
+# ---------------------------------------------------
+# Stages
+#
+# Each stage takes the fixture and runs in a scratch directory shared
+# by the stages of a scale, as the pipeline runs in its working
+# directory. Stages reading the output of another stage list it in
+# REQUIRES; if it is missing (the other stage was not selected) it is
+# made first, in a separate process, so it is not measured.
+
+def stageSampleInfo(fixture):
+    files = [os.path.join(fixture["dir"], "data.dir", x)
+             for x in os.listdir(os.path.join(fixture["dir"], "data.dir"))]
+    layouts = PipelineMrnaseq.fastqLayouts(files)
+
+    sample_info = PipelineMrnaseq.sampleInfoTable(files, layouts)
+    CsvDB.bulkLoad("csvdb", "sample_info", [sample_info.reset_index()],
+                   index="sample_id")
+
+    sample_info.to_csv("sample_info.txt", sep="\t", index=False)
+
+
+def stageSalmonGenes(fixture):
+    tx2gene = pd.read_csv(fixture["tx2gene"], sep="\t", dtype=str,
+                          keep_default_na=False)
+    matrices = PipelineMrnaseq.aggregateSalmon(fixture["quants"], tx2gene)
+
+    for name, column in (("salmon_genes.txt", "TPM"),
+                         ("salmon_genes_numreads.txt", "NumReads")):
+        matrices[column].to_csv(name, sep="\t", index=True, index_label="gene_id")
+
+
+def stageSalmonLoad(fixture):
+    CsvDB.concatenateAndLoad("csvdb", list(fixture["quants"].values()), "salmon",
+                             regex_filename=".*/(.*)/quant.sf",
+                             cat="sample_id", index=["Name", "sample_id"])
+
+
+def stageFeatureCounts(fixture):
+    PipelineMrnaseq.mergeFeatureCounts(fixture["featurecounts"], "featureCounts.txt")
+
+
+def stageFeatureCountsLoad(fixture):
+    CsvDB.loadTable("csvdb", "featureCounts.txt", "featureCounts", index="Geneid")
+
+
+def stagePicardLoad(fixture):
+    CsvDB.concatenateAndLoad("csvdb", fixture["alignment_stats"], "picardAlignmentSummary",
+                             regex_filename="(.*).picardAlignmentStats",
+                             cat="sample_id", index="sample_id")
+    CsvDB.concatenateAndLoad("csvdb", fixture["rnaseq_metrics"], "picardRNAseqMetrics",
+                             regex_filename="(.*).picardRNAseqMetrics",
+                             cat="sample_id", index="sample_id")
+
+    open("picard.table", "w").close()
+
+
+def stageMatrixStore(fixture):
+    counts = PipelineMrnaseq.readFeatureCounts("featureCounts.txt")
+    counts = counts.drop(PipelineMrnaseq.FEATURECOUNTS_ANNOTATION, axis=1)
+
+    MatrixStore.writeMatrix(counts, "matrix.dir/featureCounts")
+    MatrixStore.loadMatrix("matrix.dir/featureCounts",
+                           samples=fixture["samples"][::2]).sum()
+
+
+def stageReportBundle(fixture):
+    ReportData.writeBundle("csvdb", fixture["anndb"])
+    ReportData.loadBundle()
+
+
+def stageExpressionStats(fixture):
+    salmon_genes = pd.read_csv("salmon_genes.txt", sep="\t", index_col=0)
+
+    salmon_genes = ExpressionStats.upperQuartileNormalise(salmon_genes)
+    ExpressionStats.expressionSummary(salmon_genes, thresholds=(0, 1), top=5000)
+
+
+def stageSampleCorrelation(fixture):
+    salmon_genes = pd.read_csv("salmon_genes.txt", sep="\t", index_col=0)
+
+    SampleCorrelation.correlationTable(salmon_genes, top=5000,
+                                       threads=os.cpu_count() or 1)
+
+
+STAGES = {"sample_info": stageSampleInfo,
+          "salmon_genes": stageSalmonGenes,
+          "salmon_load": stageSalmonLoad,
+          "featurecounts": stageFeatureCounts,
+          "featurecounts_load": stageFeatureCountsLoad,
+          "picard_load": stagePicardLoad,
+          "matrix_store": stageMatrixStore,
+          "report_bundle": stageReportBundle,
+          "expression_stats": stageExpressionStats,
+          "sample_correlation": stageSampleCorrelation}
+
+# stage: [(file, stage making it)] read by the stage
+REQUIRES = {"featurecounts_load": [("featureCounts.txt", "featurecounts")],
+            "matrix_store": [("featureCounts.txt", "featurecounts")],
+            "report_bundle": [("sample_info.txt", "sample_info"),
+                              ("picard.table", "picard_load"),
+                              ("featureCounts.txt", "featurecounts"),
+                              ("matrix.dir/featureCounts/values.npy", "matrix_store")],
+            "expression_stats": [("salmon_genes.txt", "salmon_genes")],
+            "sample_correlation": [("salmon_genes.txt", "salmon_genes")]}
+
+
+# ---------------------------------------------------
+# Measurement
+
+def makeRequired(stage, fixture, workdir, queue):
+    '''Make the missing files a stage reads in this (child) process,
+       put the status on queue'''
+
+    os.chdir(workdir)
+    status = "ok"
+
+    try:
+        for required, maker in REQUIRES.get(stage, []):
+            if not os.path.exists(required):
+                STAGES[maker](fixture)
+    except Exception:
+        status = "error: " + traceback.format_exc().strip().split("\n")[-1]
+
+    queue.put(status)
+
+
+def runStage(stage, fixture, workdir, queue):
+    '''Run a stage in this (child) process, put seconds, peak RSS and
+       status on queue'''
+
+    os.chdir(workdir)
+    status = "ok"
+
+    start = time.perf_counter()
+    try:
+        STAGES[stage](fixture)
+    except Exception:
+        status = "error: " + traceback.format_exc().strip().split("\n")[-1]
+    seconds = time.perf_counter() - start
+
+    # ru_maxrss is in KB on linux
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+    queue.put((seconds, peak, status))
+
+
+def runProcess(target, *args):
+    '''Run target(*args, queue) in a fresh process, returns what it
+       put on queue, or an error status if it exited without'''
+
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=target, args=args + (queue,))
+    process.start()
+
+    result = None
+    while result is None:
+        try:
+            result = queue.get(timeout=1)
+        except Empty:
+            if not process.is_alive():
+                # the result may have been put just before it exited
+                try:
+                    result = queue.get(timeout=1)
+                except Empty:
+                    result = f"error: exited with status {process.exitcode}"
+
+    process.join()
+
+    return result
+
+
+def measure(stage, fixture, workdir, repeats=1):
+    '''Run a stage in fresh processes, returns the fastest time, the
+       largest peak RSS (MB) and the status of the last run. Files the
+       stage reads are made beforehand, in a process of their own, so
+       neither their time nor their memory is counted'''
+
+    status = runProcess(makeRequired, stage, fixture, workdir)
+    if status != "ok":
+        return np.nan, np.nan, status
+
+    results = []
+
+    for n in range(repeats):
+        result = runProcess(runStage, stage, fixture, workdir)
+        if isinstance(result, str):
+            result = (np.nan, np.nan, result)
+        results.append(result)
+
+    seconds = pd.Series([x[0] for x in results]).min()
+    peak = pd.Series([x[1] for x in results]).max()
+
+    return seconds, peak, results[-1][2]
+
+
+def runBenchmarks(scales, ngenes, stages=STAGES, repeats=1, tmpdir=None):
+    '''Run stages at each scale (number of samples), returns a
+       dataframe of results'''
+
+    rows = []
+
+    for nsamples in scales:
+        with tempfile.TemporaryDirectory(dir=tmpdir) as fixture_dir:
+            fixture = writeFixture(fixture_dir, nsamples, ngenes)
+            workdir = os.path.join(fixture_dir, "work")
+            os.makedirs(workdir)
+
+            for stage in stages:
+                seconds, peak, status = measure(stage, fixture, workdir, repeats)
+
+                rows.append([stage, nsamples, ngenes, seconds, peak, status])
+                sys.stderr.write("%s\t%i samples\t%.3fs\t%.0f MB\t%s\n" %
+                                 (stage, nsamples, seconds, peak, status))
+
+    return pd.DataFrame(rows, columns=RESULT_COLUMNS)
+
+
+def compareBaseline(results, baseline, threshold=0.25, min_seconds=0.05):
+    '''Compare results to a baseline, adds time & memory ratios and
+       a "regression" column flagging stages slower or bigger than
+       threshold allows. Stages faster than min_seconds in both are
+       not timed reliably, only their memory is compared'''
+
+    baseline = baseline[["stage", "samples", "genes", "seconds", "peak_rss_mb"]]
+    merged = pd.merge(results, baseline, how="left", on=["stage", "samples", "genes"],
+                      suffixes=("", "_baseline"))
+
+    merged["time_ratio"] = merged["seconds"] / merged["seconds_baseline"]
+    merged["memory_ratio"] = merged["peak_rss_mb"] / merged["peak_rss_mb_baseline"]
+
+    timed = (merged["seconds"] >= min_seconds) | (merged["seconds_baseline"] >= min_seconds)
+
+    merged["regression"] = ((timed & (merged["time_ratio"] > 1 + threshold)) |
+                            (merged["memory_ratio"] > 1 + threshold))
+
+    return merged
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--samples", default="10,100,1000",
+                        help="comma separated numbers of samples to benchmark at")
+    parser.add_argument("--genes", type=int, default=2000,
+                        help="genes in the synthetic annotation (4 transcripts each)")
+    parser.add_argument("--stages", default=",".join(STAGES),
+                        help="comma separated stages to run, from %s" % ", ".join(STAGES))
+    parser.add_argument("--repeats", type=int, default=1,
+                        help="runs of each stage, the fastest is reported")
+    parser.add_argument("--output", default="-",
+                        help="write results table to this file, default stdout")
+    parser.add_argument("--baseline", default=None,
+                        help="results of an earlier run to compare against")
+    parser.add_argument("--threshold", type=float, default=0.25,
+                        help="allowed fractional increase in time or peak memory")
+    parser.add_argument("--min-seconds", type=float, default=0.05,
+                        help="stages faster than this are not compared on time")
+    parser.add_argument("--tmpdir", default=None,
+                        help="directory for fixtures & scratch files")
+
+    args = parser.parse_args(argv)
+
+    scales = [int(x) for x in args.samples.split(",")]
+    stages = [x for x in args.stages.split(",") if x]
+
+    unknown = [x for x in stages if x not in STAGES]
+    if unknown:
+        parser.error("unknown stages: %s" % ", ".join(unknown))
+
+    results = runBenchmarks(scales, args.genes, stages, args.repeats, args.tmpdir)
+
+    failed = results["status"] != "ok"
+
+    if args.baseline:
+        results = compareBaseline(results, pd.read_csv(args.baseline, sep="\t"),
+                                  args.threshold, args.min_seconds)
+        failed = failed | results["regression"]
+
+    results.to_csv(args.output if args.output != "-" else sys.stdout,
+                   sep="\t", index=False, float_format="%.4g")
+
+    if failed.any():
+        sys.stderr.write("%i benchmarks failed or regressed:\n%s\n" %
+                         (failed.sum(), results.loc[failed, ["stage", "samples", "status"]]
+                          .to_string(index=False)))
+        return 1
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
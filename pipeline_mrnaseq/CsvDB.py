@@ -0,0 +1,214 @@
+"""Database access layer for the pipeline's sqlite database (csvdb).
+
+* one connection per database per thread of each process, opened on
+  first use and tuned for bulk loading (journal mode, synchronous,
+  page cache). ruffus runs tasks in threads, a thread runs one task at
+  a time, so tasks never share a connection or its transactions
+* helper databases are attached once per connection
+* tables are bulk loaded with large batched, transactional
+  ``executemany`` inserts, and indices created after the data is in
+
+Usage::
+
+   import CsvDB
+   CsvDB.configure(journal_mode="WAL", cache_mb=512)
+   dbh = CsvDB.getConnection("csvdb")
+   CsvDB.loadTable("csvdb", "read_counts.dir/featureCounts.txt",
+                   "featureCounts", index="Geneid")
+
+"""
+import os
+import re
+import sqlite3
+import threading
+import pandas as pd
+
+
+OPTIONS = {"journal_mode": "WAL",
+           "synchronous": "NORMAL",
+           "cache_mb": 512,
+           "batch_size": 100000}
+
+# connections of the current thread, by (pid, database)
+_local = threading.local()
+
+
+def configure(**options):
+    '''Set connection & loading options, unset (None/blank) values
+       keep their defaults. Applies to connections opened afterwards'''
+
+    OPTIONS.update({k: v for k, v in options.items() if v not in (None, "")})
+
+
+def getConnection(dbfile):
+    '''Return the connection to dbfile for this process & thread,
+       opening and tuning it on first use'''
+
+    if not hasattr(_local, "connections"):
+        _local.connections = {}
+
+    _connections = _local.connections
+    key = (os.getpid(), os.path.abspath(dbfile))
+
+    if key not in _connections:
+        dbh = sqlite3.connect(dbfile, timeout=300)
+        dbh.execute("pragma journal_mode = %s" % OPTIONS["journal_mode"])
+        dbh.execute("pragma synchronous = %s" % OPTIONS["synchronous"])
+        # negative cache_size is in KiB
+        dbh.execute("pragma cache_size = -%i" % (int(OPTIONS["cache_mb"]) * 1024))
+        dbh.execute("pragma temp_store = MEMORY")
+        _connections[key] = dbh
+
+    return _connections[key]
+
+
+def attach(dbh, dbfile, name):
+    '''Attach dbfile to connection dbh as name, unless already attached'''
+
+    attached = [x[1] for x in dbh.execute("pragma database_list")]
+
+    if name not in attached:
+        if not os.path.exists(dbfile):
+            raise ValueError("can't find database '%s'" % dbfile)
+        dbh.execute(f'''attach database '{dbfile}' as {name}''')
+
+    return dbh
+
+
+def quote(name):
+    '''Return name quoted as an sqlite identifier, embedded quotes
+       doubled. Raises ValueError for names sqlite can't hold'''
+
+    name = str(name)
+
+    if not name or "\x00" in name:
+        raise ValueError("invalid table or column name %r" % name)
+
+    return '"%s"' % name.replace('"', '""')
+
+
+def tableColumns(dbh, table):
+    '''Return column names of a table, empty if it does not exist'''
+
+    cc = dbh.execute(f'''pragma table_info({quote(table)})''')
+    return [x[1] for x in cc.fetchall()]
+
+
+def sqlType(dtype):
+    '''Return sqlite column type for a pandas dtype'''
+
+    if pd.api.types.is_integer_dtype(dtype) or pd.api.types.is_bool_dtype(dtype):
+        return "INTEGER"
+    if pd.api.types.is_float_dtype(dtype):
+        return "REAL"
+    return "TEXT"
+
+
+def toRows(df):
+    '''Return rows of df as tuples of python values, NaN as NULL'''
+
+    return df.astype(object).where(df.notnull(), None).itertuples(index=False, name=None)
+
+
+def createIndex(dbh, table, column):
+    '''Create an index on table.column'''
+
+    dbh.execute(f'''create index if not exists {quote(f"{table}_{column}")}
+                    on {quote(table)} ({quote(column)})''')
+
+
+def dropTables(dbfile, tables):
+    '''Drop tables of dbfile that exist, in a single transaction'''
+
+    dbh = getConnection(dbfile)
+
+    with dbh:
+        for table in tables:
+            dbh.execute(f'''drop table if exists {quote(table)}''')
+
+
+def bulkLoad(dbfile, table, chunks, index=(), replace=True):
+    '''Load an iterable of dataframes into table in a single
+       transaction, with batched executemany inserts. The table is
+       created from the first chunk's columns & dtypes, and columns
+       first seen in later chunks are added to it, so the table holds
+       the union of the chunks' columns, missing values as NULL.
+       Indices on the columns in index are created after the data is
+       loaded. With replace, an existing table is dropped even if
+       there are no chunks. Returns the number of rows loaded'''
+
+    if isinstance(index, str):
+        index = [index]
+
+    dbh = getConnection(dbfile)
+    batch_size = int(OPTIONS["batch_size"])
+    nrows = 0
+
+    with dbh:
+        if replace:
+            dbh.execute(f'''drop table if exists {quote(table)}''')
+
+        columns = tableColumns(dbh, table)
+
+        for chunk in chunks:
+            added = [x for x in chunk.columns if x not in columns]
+
+            if added:
+                if not columns:
+                    definition = ", ".join(f'''{quote(x)} {sqlType(chunk[x].dtype)}'''
+                                           for x in added)
+                    dbh.execute(f'''create table {quote(table)} ({definition})''')
+                else:
+                    for column in added:
+                        dbh.execute(f'''alter table {quote(table)} add column
+                                        {quote(column)} {sqlType(chunk[column].dtype)}''')
+                columns = columns + added
+
+            insert = f'''insert into {quote(table)} ({", ".join(quote(x) for x in columns)})
+                         values ({", ".join("?" for x in columns)})'''
+
+            chunk = chunk.reindex(columns=columns)
+            for start in range(0, len(chunk), batch_size):
+                dbh.executemany(insert, toRows(chunk.iloc[start:start + batch_size]))
+
+            nrows += len(chunk)
+
+        # nothing to index if there were no chunks
+        for column in index if columns else ():
+            createIndex(dbh, table, column)
+
+    return nrows
+
+
+def loadTable(dbfile, infile, table, index=(), sep="\t"):
+    '''Bulk load a tab-separated table, read in chunks, into table.
+       Leading "#" comment lines are skipped'''
+
+    skip = 0
+    with open(infile) as inf:
+        for line in inf:
+            if not line.startswith("#"):
+                break
+            skip += 1
+
+    chunks = pd.read_csv(infile, sep=sep, skiprows=skip,
+                         chunksize=int(OPTIONS["batch_size"]))
+
+    return bulkLoad(dbfile, table, chunks, index=index)
+
+
+def concatenateAndLoad(dbfile, infiles, table, regex_filename,
+                       cat="sample_id", index=(), sep="\t"):
+    '''Bulk load a set of tables into a single table, with an extra
+       first column cat holding the part of each filename matched by
+       the first group of regex_filename'''
+
+    def chunks():
+        for infile in infiles:
+            value = re.search(regex_filename, infile).groups()[0]
+            for chunk in pd.read_csv(infile, sep=sep,
+                                     chunksize=int(OPTIONS["batch_size"])):
+                chunk.insert(0, cat, value)
+                yield chunk
+
+    return bulkLoad(dbfile, table, chunks(), index=index)
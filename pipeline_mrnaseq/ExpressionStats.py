@@ -0,0 +1,81 @@
+"""Expression QC statistics for the report notebooks of
+:file:`pipeline_mrnaseq.py`, computed with NumPy on genes x samples
+matrices (e.g. salmon TPMs from the report data bundle).
+
+:func:`expressionSummary` goes over the matrix once, in blocks of
+genes, and collects for all samples at once
+
+* the number of genes detected above each of several thresholds
+* the mean of each gene, to select the top expressed genes
+
+so memory is bounded by the block size, not by copies of the
+expression matrix. Sample correlations are computed by the pipeline
+(SampleCorrelation.py) and read from the report data bundle::
+
+   import ExpressionStats
+   tpm = ExpressionStats.upperQuartileNormalise(data.salmon_genes)
+   summary = ExpressionStats.expressionSummary(tpm, thresholds=(0, 1), top=5000)
+   summary.detected, summary.top_genes
+
+"""
+import types
+import numpy as np
+import pandas as pd
+
+
+def upperQuartileNormalise(matrix, q=0.75):
+    '''Divide each sample (column) by its upper quartile. Samples with
+       an upper quartile of 0 are left unscaled. The dtype of matrix is
+       kept, so float32 TPMs stay float32'''
+
+    values = np.asarray(matrix.values)
+    dtype = values.dtype if np.issubdtype(values.dtype, np.floating) else np.float64
+
+    quartiles = np.quantile(values, q, axis=0)
+    quartiles[quartiles == 0] = 1
+
+    return pd.DataFrame(values / quartiles.astype(dtype), index=matrix.index,
+                        columns=matrix.columns)
+
+
+def log2p1(values):
+    '''log2(x + 1) as float64, missing values as 0'''
+
+    return np.log2(np.nan_to_num(np.asarray(values, dtype=np.float64)) + 1)
+
+
+def expressionSummary(matrix, thresholds=(0, 1), top=5000, block_size=10000):
+    '''Summarise a genes x samples matrix in a single pass over blocks of
+       genes. Returns a namespace of
+
+       detected        - sample_id, threshold, no_genes: genes above threshold
+       mean            - mean of each gene
+       top_genes       - the top genes by mean
+    '''
+
+    values = matrix.values
+    ngenes, nsamples = values.shape
+
+    detected = np.zeros((len(thresholds), nsamples), dtype=np.int64)
+    means = np.zeros(ngenes)
+
+    for start in range(0, ngenes, block_size):
+        block = np.asarray(values[start:start + block_size])
+
+        for n, threshold in enumerate(thresholds):
+            detected[n] += (block > threshold).sum(axis=0)
+
+        means[start:start + block_size] = np.nanmean(block, axis=1)
+
+    # top genes by mean, highest first as a stable sort on the means
+    order = np.argsort(-means, kind="stable")[:top]
+    top_genes = matrix.index[order]
+
+    detected = pd.DataFrame({"sample_id": np.tile(np.asarray(matrix.columns), len(thresholds)),
+                             "threshold": np.repeat(list(thresholds), nsamples),
+                             "no_genes": detected.ravel()})
+
+    return types.SimpleNamespace(
+        detected=detected,
+        mean=pd.Series(means, index=matrix.index),
+        top_genes=top_genes)
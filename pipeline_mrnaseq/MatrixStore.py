@@ -0,0 +1,157 @@
+"""Columnar, memory-mappable store for the genes x samples matrices
+(read counts, TPMs) produced by :file:`pipeline_mrnaseq.py`.
+
+A matrix is stored in a directory::
+
+   matrix.dir/<name>/values.npy   - values, column (sample) major
+   matrix.dir/<name>/rows.txt     - row (gene) ids, one per line
+   matrix.dir/<name>/columns.txt  - column (sample) ids, one per line
+
+Values are written in Fortran order so that each sample is a
+contiguous block of the file, integers (counts) as int32 and floats
+(TPMs) as float32. R has no 64 bit integers, so integers out of the
+range of int32 are stored as float64. Float matrices are only stored
+as integers if the writer asks for it (``downcast=True``) and all
+values are whole numbers. Files are opened
+memory-mapped, so loading a subset of genes or samples only reads
+those parts of the file::
+
+   import MatrixStore
+   tpm = MatrixStore.loadMatrix("matrix.dir/salmon_genes",
+                                samples=["WT_0hr_R1", "WT_0hr_R2"])
+
+MatrixStore.R (:data:`R_SOURCE`) reads and writes the same stores
+from R, so matrices pass between the Python and R cells of the report
+notebooks as files, not as rpy2 conversions::
+
+   robjects.r.source(MatrixStore.R_SOURCE)
+
+"""
+import os
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+# R functions readMatrixStore & writeMatrixStore
+R_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "MatrixStore.R")
+
+
+def integerDtype(values):
+    '''Return int32 if it holds values, None if they are out of its
+       range'''
+
+    if values.size == 0:
+        return np.int32
+
+    limits = np.iinfo(np.int32)
+
+    if values.min() >= limits.min and values.max() <= limits.max:
+        return np.int32
+
+    return None
+
+
+def compactDtype(values, downcast=False):
+    '''Return int32 for integer values, float64 if they are out of
+       its range, float32 for floats. With downcast, floats that are
+       all whole numbers are stored as integers the same way'''
+
+    if np.issubdtype(values.dtype, np.integer):
+        return integerDtype(values) or np.float64
+
+    if downcast and np.isfinite(values).all() and \
+       np.equal(np.mod(values, 1), 0).all():
+        return integerDtype(values) or np.float64
+
+    return np.float32
+
+
+def writeIds(ids, outfile):
+    '''Write ids to outfile, one per line'''
+
+    with open(outfile, "w") as outf:
+        for x in ids:
+            outf.write(f"{x}\n")
+
+
+def readIds(infile):
+    '''Read ids written by :func:`writeIds`'''
+
+    with open(infile) as inf:
+        return [x.rstrip("\n") for x in inf]
+
+
+def writeMatrix(df, path, dtype=None, downcast=False):
+    '''Write dataframe df (rows x columns) to matrix store path, as
+       dtype or the dtype :func:`compactDtype` picks'''
+
+    os.makedirs(path, exist_ok=True)
+
+    values = df.values
+    if dtype is None:
+        dtype = compactDtype(values, downcast=downcast)
+
+    tmp = os.path.join(path, "values.tmp.npy")
+    np.save(tmp, np.asfortranarray(values.astype(dtype)))
+
+    writeIds(df.index, os.path.join(path, "rows.txt"))
+    writeIds(df.columns, os.path.join(path, "columns.txt"))
+
+    # replace values last, it marks the store as complete
+    os.replace(tmp, os.path.join(path, "values.npy"))
+
+
+def matrixChecksum(df):
+    '''sha1 of the values, row & column ids of dataframe df'''
+
+    sha1 = hashlib.sha1()
+    sha1.update(np.ascontiguousarray(df.values).tobytes())
+    sha1.update("\n".join(map(str, df.index)).encode())
+    sha1.update("\n".join(map(str, df.columns)).encode())
+
+    return sha1.hexdigest()
+
+
+def readIndex(path):
+    '''Return (rows, columns) ids of a matrix store'''
+
+    return (readIds(os.path.join(path, "rows.txt")),
+            readIds(os.path.join(path, "columns.txt")))
+
+
+def openMatrix(path):
+    '''Return read-only memory-mapped values of a matrix store'''
+
+    return np.load(os.path.join(path, "values.npy"), mmap_mode="r")
+
+
+def loadMatrix(path, genes=None, samples=None, index_name="gene_id"):
+    '''Load a matrix store as a dataframe.
+
+    Only the requested genes and/or samples are read, in the order
+    given. Unknown ids raise a KeyError.
+    '''
+
+    rows, columns = readIndex(path)
+    values = openMatrix(path)
+
+    if samples is not None:
+        position = {x: n for n, x in enumerate(columns)}
+        cols = [position[x] for x in samples]
+        columns = list(samples)
+    else:
+        cols = slice(None)
+
+    if genes is not None:
+        position = {x: n for n, x in enumerate(rows)}
+        rws = [position[x] for x in genes]
+        rows = list(genes)
+    else:
+        rws = slice(None)
+
+    # select columns first, they are contiguous on disk
+    values = np.asarray(values[:, cols])[rws, :]
+
+    return pd.DataFrame(values, index=pd.Index(rows, name=index_name),
+                        columns=columns)
@@ -0,0 +1,780 @@
+"""Helper functions for :file:`pipeline_mrnaseq.py`.
+
+Functions take the pipeline parameter dictionary (``PARAMS``) as
+their first argument so they can be used from the pipeline, from
+cluster jobs and from the report notebooks alike.
+
+"""
+import os
+import re
+import gzip
+import shutil
+import hashlib
+import tempfile
+import itertools
+import numpy as np
+import pandas as pd
+import CsvDB
+
+
+# ---------------------------------------------------
+# Resource profiles
+
+def nodeCores(params):
+    '''Return the number of cores on a compute node, resources_node_cores.
+       "auto" (or blank) counts the cores available to this process,
+       which are those of the node jobs run on only if the pipeline runs
+       them locally (without_cluster), so it raises ValueError otherwise'''
+
+    cores = params.get("resources_node_cores")
+
+    if cores in (None, "", "auto"):
+        if not params.get("without_cluster"):
+            raise ValueError(
+                "set resources: node_cores to the cores of a compute node to use "
+                "threads: auto with a cluster, auto only detects the cores of "
+                "the host running the pipeline")
+        try:
+            cores = len(os.sched_getaffinity(0))
+        except AttributeError:
+            cores = os.cpu_count() or 1
+
+    return int(cores)
+
+
+def resolveThreads(params, threads):
+    '''Resolve a threads setting to a number of threads.
+       "auto" shares the node between resources_jobs_per_node jobs.
+       Values are capped at resources_max_threads, or at
+       resources_node_cores if only that is configured'''
+
+    if threads in (None, "", "auto"):
+        jobs_per_node = int(params.get("resources_jobs_per_node") or 1)
+        threads = nodeCores(params) // max(jobs_per_node, 1)
+
+    max_threads = params.get("resources_max_threads")
+
+    if max_threads in (None, "") and \
+       params.get("resources_node_cores") not in (None, "", "auto"):
+        max_threads = params["resources_node_cores"]
+
+    if max_threads not in (None, "", "auto"):
+        threads = min(int(threads), int(max_threads))
+
+    return max(1, int(threads))
+
+
+def getResources(params, task, section, threads=1, memory="4G"):
+    '''Return (threads, memory) for a pipeline task.
+
+    Settings are looked up, in order, in
+
+    1. a per-task override in the resources section,
+       e.g. resources: {picardRNAseqMetrics: {threads: 2, memory: 8G}}
+    2. the tool section of pipeline.yml, e.g. star: {threads: 12, memory: 2G}
+    3. resources_threads & resources_memory
+    4. the defaults passed to this function
+
+    Threads may be given as "auto" to size jobs from the cores of a
+    compute node, resources_node_cores (see :func:`resolveThreads`).
+    '''
+
+    resources = params.get("resources") or {}
+    override = resources.get(task) or {}
+
+    def lookup(key, default):
+        for value in (override.get(key),
+                      params.get(f"{section}_{key}"),
+                      params.get(f"resources_{key}")):
+            if value not in (None, ""):
+                return value
+        return default
+
+    threads = resolveThreads(params, lookup("threads", threads))
+    memory = str(lookup("memory", memory))
+
+    return threads, memory
+
+
+# ---------------------------------------------------
+# Sample layout
+
+def fastqLayouts(files):
+    '''Return a dict of sample: "paired" or "single" from fastq file
+       names, <sample>.fastq.1.gz & <sample>.fastq.2.gz for paired end
+       and <sample>.fastq.gz for single end reads'''
+
+    layouts = {}
+
+    for fastq in files:
+        name = os.path.basename(fastq)
+
+        if re.search(r"\.fastq\.[12]\.gz$", name):
+            sample, layout = name[:-len(".fastq.1.gz")], "paired"
+        elif name.endswith(".fastq.gz"):
+            sample, layout = name[:-len(".fastq.gz")], "single"
+        else:
+            continue
+
+        if layouts.get(sample, layout) != layout:
+            raise ValueError(
+                "sample %s has both single and paired end fastq files" % sample)
+
+        layouts[sample] = layout
+
+    return layouts
+
+
+def sampleInfoTable(files, layouts):
+    '''Parse sample names of fastq files into a sample info table,
+       with "category" column for DESeq2 design and the "layout" of
+       each sample from layouts. Returns None if names do not follow
+       the naming convention'''
+
+    make_sample_table = True
+    info = {}
+
+    for f in files:
+        sample_id = os.path.basename(f).split(".")[0]
+        attr = sample_id.split("_")
+
+        if len(attr) == 2:
+            cols = ["sample_id", "condition", "replicate"]
+
+        elif len(attr) == 3:
+            cols = ["sample_id", "condition", "treatment", "replicate"]
+
+        elif len(attr) == 4:
+            cols = ["sample_id", "group", "condition", "treatment", "replicate"]
+
+        else:
+            make_sample_table = False
+            print("Please reformat sample names according to pipeline documentation")
+
+        if sample_id not in info:
+            info[sample_id] = [sample_id] + attr
+
+    if not make_sample_table or not info:
+        return None
+
+    sample_info = pd.DataFrame.from_dict(info, orient="index")
+    sample_info.columns = cols
+    sub = [x for x in list(sample_info) if x not in ["sample_id", "index", "replicate"]]
+    sample_info["category"] = sample_info[sub].apply(lambda x: '_'.join(str(y) for y in x), axis=1)
+    sample_info["layout"] = [layouts.get(x, "unknown") for x in sample_info["sample_id"]]
+    sample_info.reset_index(inplace=True, drop=True)
+
+    return sample_info
+
+
+# ---------------------------------------------------
+# DESeq2 contrasts
+
+def comparisonName(name):
+    '''Return a comparison name that is safe in file & table names,
+       runs of characters other than letters, digits & "_" as "_"'''
+
+    return re.sub(r"\W+", "_", str(name)).strip("_")
+
+
+def deseq2Contrasts(categories, comparisons=None):
+    '''Return [(comparison, a, b)] DESeq2 contrasts, those of
+       comparisons (dict of name: [a, b], report: comparisons in
+       pipeline.yml) or, if none are given, all pairs of categories in
+       order of first appearance, named a_VS_b. Names are passed through
+       :func:`comparisonName`. Comparisons of unknown categories are
+       skipped, names that are the same once sanitised raise ValueError'''
+
+    categories = list(dict.fromkeys(str(x) for x in categories))
+
+    if not comparisons:
+        comparisons = {f"{a}_VS_{b}": (a, b) for a, b in itertools.combinations(categories, 2)}
+
+    contrasts = {}
+    for name, (a, b) in comparisons.items():
+        if str(a) not in categories or str(b) not in categories:
+            print(f"Skipping comparison {name}, {a} or {b} is not a sample category")
+            continue
+
+        sanitised = comparisonName(name)
+        if not sanitised or sanitised in contrasts:
+            raise ValueError(f"comparison name '{name}' is empty or not unique "
+                             f"once sanitised to '{sanitised}'")
+
+        contrasts[sanitised] = (str(a), str(b))
+
+    return [(name, a, b) for name, (a, b) in contrasts.items()]
+
+
+# ---------------------------------------------------
+# BAM indexes
+
+def indexIsCurrent(bam, index=None):
+    '''True if the index of a BAM exists, is at least as new as the BAM
+       and can be read. index defaults to <bam>.bai'''
+
+    index = index or bam + ".bai"
+
+    if not os.path.exists(index) or os.path.getsize(index) == 0 or \
+       os.path.getmtime(index) < os.path.getmtime(bam):
+        return False
+
+    # pysam is only needed here, not by the report notebooks
+    import pysam
+
+    try:
+        with pysam.AlignmentFile(bam, index_filename=index) as inf:
+            inf.get_index_statistics()
+    except (ValueError, OSError):
+        return False
+
+    return True
+
+
+# ---------------------------------------------------
+# Read counting
+
+FEATURECOUNTS_ANNOTATION = ["Chr", "Start", "End", "Strand", "Length"]
+
+
+def sampleName(bam):
+    '''Return sample name for a BAM file, e.g. bam.dir/a_b_R1.bam -> a_b_R1'''
+
+    return os.path.basename(bam)[:-len(".bam")]
+
+
+def countComments(infile):
+    '''Return the number of leading "#" comment lines in a table'''
+
+    n = 0
+    with open(infile) as inf:
+        for line in inf:
+            if not line.startswith("#"):
+                break
+            n += 1
+
+    return n
+
+
+def readFeatureCounts(infile):
+    '''Read a featureCounts table, indexed by Geneid, with BAM paths
+       in the column names replaced by sample names'''
+
+    df = pd.read_csv(infile, sep="\t", comment=None, skiprows=countComments(infile),
+                     index_col=0, dtype={"Chr": str, "Start": str,
+                                         "End": str, "Strand": str})
+
+    df.columns = [sampleName(x) if x.endswith(".bam") else x for x in df.columns]
+
+    return df
+
+
+def mergeFeatureCounts(infiles, outfile):
+    '''Merge featureCounts tables, each counted over a batch of BAMs,
+       into a single table with the columns of one featureCounts run:
+       Geneid, Chr, Start, End, Strand, Length then one column per
+       sample. The per-batch ".summary" tables are merged alongside'''
+
+    tables = [readFeatureCounts(x) for x in infiles]
+
+    annotation = tables[0][FEATURECOUNTS_ANNOTATION]
+
+    for infile, table in zip(infiles, tables):
+        if not table.index.equals(annotation.index):
+            raise ValueError(
+                "genes in %s differ from those in %s" % (infile, infiles[0]))
+
+    counts = pd.concat([table.drop(FEATURECOUNTS_ANNOTATION, axis=1)
+                        for table in tables], axis=1)
+    # batches may be grouped by layout, keep samples in name order
+    counts = counts[sorted(counts.columns)]
+    merged = pd.concat([annotation, counts], axis=1)
+
+    merged.to_csv(outfile, sep="\t", index=True, index_label="Geneid")
+
+    mergeFeatureCountsSummaries(infiles, outfile)
+
+    return merged
+
+
+def mergeFeatureCountsSummaries(infiles, outfile):
+    '''Merge the ".summary" tables of featureCounts runs over infiles
+       into outfile.summary'''
+
+    summaries = [x + ".summary" for x in infiles]
+    if all(os.path.exists(x) for x in summaries):
+        summary = pd.concat([pd.read_csv(x, sep="\t", index_col=0)
+                             for x in summaries], axis=1)
+        summary.columns = [sampleName(x) if x.endswith(".bam") else x
+                           for x in summary.columns]
+        summary.to_csv(outfile + ".summary", sep="\t",
+                       index=True, index_label="Status")
+
+
+def featureCountsSamples(infile):
+    '''Return sample names in the header of a featureCounts table'''
+
+    with open(infile) as inf:
+        for line in inf:
+            if not line.startswith("#"):
+                header = line.rstrip("\n").split("\t")
+                break
+
+    return [sampleName(x) if x.endswith(".bam") else x
+            for x in header[len(FEATURECOUNTS_ANNOTATION) + 1:]]
+
+
+def spliceFeatureCounts(infiles, outfile):
+    '''Splice per-sample featureCounts tables into the merged table.
+       Only tables newer than outfile, or of samples missing from it,
+       are read. Samples without a table are dropped. Falls back to
+       :func:`mergeFeatureCounts` if outfile does not exist yet or the
+       genes differ. Returns the samples that were (re)counted'''
+
+    samples = {}
+    for infile in sorted(infiles):
+        samples[featureCountsSamples(infile)[0]] = infile
+
+    if not os.path.exists(outfile):
+        mergeFeatureCounts(list(samples.values()), outfile)
+        return list(samples)
+
+    merged = readFeatureCounts(outfile)
+    since = os.path.getmtime(outfile)
+
+    changed = [sample for sample, infile in samples.items()
+               if sample not in merged.columns or os.path.getmtime(infile) > since]
+
+    for sample in changed:
+        table = readFeatureCounts(samples[sample])
+
+        if not table.index.equals(merged.index):
+            mergeFeatureCounts(list(samples.values()), outfile)
+            return list(samples)
+
+        merged[sample] = table[sample]
+
+    merged = merged[FEATURECOUNTS_ANNOTATION + list(samples)]
+    merged.to_csv(outfile, sep="\t", index=True, index_label="Geneid")
+
+    mergeFeatureCountsSummaries(list(samples.values()), outfile)
+
+    return changed
+
+
+# ---------------------------------------------------
+# Annotation cache
+#
+# Decompressed annotations and the transcript to gene map derived
+# from them are cached once per annotation release, in a directory
+# named after the checksum of the source file:
+#
+#   <cache_dir>/<sha1>/geneset.gtf
+#   <cache_dir>/<sha1>/transcript2gene.tsv
+#   <cache_dir>/<sha1>/refflat.txt
+#
+# so that re-runs, and other projects using the same annotations_dir,
+# reuse them. Checksums are memoised on path, size & mtime in
+# <cache_dir>/checksums.tsv
+
+def annotationCacheDir(params):
+    '''Return annotation cache directory, annotations_cache_dir or
+       mrnaseq_cache/ within annotations_dir'''
+
+    cache_dir = params.get("annotations_cache_dir")
+
+    if not cache_dir:
+        cache_dir = os.path.join(params["annotations_dir"], "mrnaseq_cache")
+
+    return cache_dir
+
+
+def fileChecksum(infile, cache_dir):
+    '''Return sha1 checksum of infile, memoised on path, size & mtime'''
+
+    infile = os.path.abspath(infile)
+    stat = os.stat(infile)
+    key = "\t".join(map(str, (infile, stat.st_size, stat.st_mtime_ns)))
+
+    index = os.path.join(cache_dir, "checksums.tsv")
+
+    if os.path.exists(index):
+        with open(index) as inf:
+            for line in inf:
+                fields = line.rstrip("\n").rsplit("\t", 1)
+                if fields[0] == key:
+                    return fields[1]
+
+    sha1 = hashlib.sha1()
+    with open(infile, "rb") as inf:
+        for chunk in iter(lambda: inf.read(1 << 20), b""):
+            sha1.update(chunk)
+    checksum = sha1.hexdigest()
+
+    os.makedirs(cache_dir, exist_ok=True)
+    with open(index, "a") as outf:
+        outf.write(f"{key}\t{checksum}\n")
+
+    return checksum
+
+
+def openAnnotation(infile):
+    '''Open a plain or gzipped annotation file for reading'''
+
+    if infile.endswith(".gz"):
+        return gzip.open(infile, "rt")
+
+    return open(infile)
+
+
+def writeAtomic(outfile, write):
+    '''Call write(outf) on a temporary file then move it to outfile,
+       so concurrent readers never see a partially written file'''
+
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(outfile),
+                               prefix=os.path.basename(outfile) + ".")
+    try:
+        with os.fdopen(fd, "w") as outf:
+            write(outf)
+        os.chmod(tmp, 0o664)
+        os.replace(tmp, outfile)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+GTF_ATTRIBUTE = re.compile(r'(transcript_id|gene_id|gene_name) "([^"]*)"')
+
+
+def buildGtfCache(source, gtf, tx2gene):
+    '''Decompress source GTF to gtf and, in the same pass, write the
+       transcript_id, gene_id, gene_name map to tx2gene'''
+
+    transcripts = {}
+
+    def write_gtf(outf):
+        with openAnnotation(source) as inf:
+            for line in inf:
+                outf.write(line)
+
+                if line.startswith("#"):
+                    continue
+
+                attributes = dict(GTF_ATTRIBUTE.findall(line))
+                transcript_id = attributes.get("transcript_id")
+
+                if transcript_id and transcript_id not in transcripts:
+                    transcripts[transcript_id] = (attributes.get("gene_id", ""),
+                                                  attributes.get("gene_name", ""))
+
+    def write_map(outf):
+        outf.write("transcript_id\tgene_id\tgene_name\n")
+        for transcript_id, (gene_id, gene_name) in transcripts.items():
+            outf.write(f"{transcript_id}\t{gene_id}\t{gene_name}\n")
+
+    writeAtomic(gtf, write_gtf)
+    writeAtomic(tx2gene, write_map)
+
+
+def cachedAnnotationPath(params, source, name):
+    '''Return path of cached annotation file name derived from source'''
+
+    cache_dir = annotationCacheDir(params)
+
+    return os.path.join(cache_dir, fileChecksum(source, cache_dir), name)
+
+
+def cachedAnnotation(params, source, name):
+    '''Return path of cached annotation file name derived from source,
+       building the cache entry if it does not exist yet'''
+
+    path = cachedAnnotationPath(params, source, name)
+
+    if os.path.exists(path):
+        return path
+
+    entry = os.path.dirname(path)
+    os.makedirs(entry, exist_ok=True)
+
+    if name in ("geneset.gtf", "transcript2gene.tsv"):
+        buildGtfCache(source,
+                      os.path.join(entry, "geneset.gtf"),
+                      os.path.join(entry, "transcript2gene.tsv"))
+    else:
+        def write(outf):
+            with openAnnotation(source) as inf:
+                shutil.copyfileobj(inf, outf)
+
+        writeAtomic(path, write)
+
+    with open(os.path.join(entry, "source.txt"), "w") as outf:
+        outf.write(os.path.abspath(source) + "\n")
+
+    return path
+
+
+def ensemblGeneset(params):
+    '''Return path of the compressed ensembl geneset'''
+
+    return os.path.join(params["annotations_dir"],
+                        params["annotations_ensembl_geneset"])
+
+
+def getCachedGtf(params):
+    '''Return path of the decompressed ensembl geneset'''
+
+    return cachedAnnotation(params, ensemblGeneset(params), "geneset.gtf")
+
+
+def getTranscriptGeneMap(params):
+    '''Return path of transcript_id to gene_id/gene_name map'''
+
+    return cachedAnnotation(params, ensemblGeneset(params), "transcript2gene.tsv")
+
+
+def getCachedRefFlat(params):
+    '''Return path of the decompressed refFlat annotation'''
+
+    return cachedAnnotation(params, params["ref_flat"], "refflat.txt")
+
+
+def cachedAnnotations(params):
+    '''Return list of (name, source, builder) for the cached annotations'''
+
+    return [("geneset.gtf", ensemblGeneset(params), getCachedGtf),
+            ("transcript2gene.tsv", ensemblGeneset(params), getTranscriptGeneMap),
+            ("refflat.txt", params["ref_flat"], getCachedRefFlat)]
+
+
+def annotationCacheIsCurrent(params, infile):
+    '''Check a table of cached annotations, as written by the pipeline,
+       still points at existing cache entries for the current sources'''
+
+    if not os.path.exists(infile):
+        return False
+
+    table = pd.read_csv(infile, sep="\t", dtype=str)
+    cached = dict(zip(table["name"], table["path"]))
+
+    for name, source, builder in cachedAnnotations(params):
+        path = cachedAnnotationPath(params, source, name)
+        if cached.get(name) != path or not os.path.exists(path):
+            return False
+
+    return True
+
+
+def loadTranscriptGeneMap(params):
+    '''Return transcript to gene map as a dataframe'''
+
+    return pd.read_csv(getTranscriptGeneMap(params), sep="\t", dtype=str,
+                       keep_default_na=False)
+
+
+# ---------------------------------------------------
+# Salmon gene aggregation
+#
+# quant.sf files are streamed one at a time; transcripts are mapped
+# to rows of a dense genes x samples matrix through an index array
+# that is computed once and reused for every file with the same
+# transcript order (i.e. quantified against the same salmon index),
+# so memory is proportional to the output matrix.
+
+def transcriptGeneIndex(names, tx2gene, genes):
+    '''Return array with, for each transcript in names, the row of its
+       gene in genes or -1 if the transcript is not in tx2gene'''
+
+    gene_row = pd.Series(np.arange(len(genes)), index=genes)
+    transcript_gene = pd.Series(tx2gene["gene_id"].values,
+                                index=tx2gene["transcript_id"].values)
+    transcript_gene = transcript_gene[~transcript_gene.index.duplicated()]
+
+    rows = gene_row.reindex(transcript_gene.reindex(names).values)
+
+    return rows.fillna(-1).values.astype(np.int64)
+
+
+def aggregateSalmon(quants, tx2gene, columns=("TPM", "NumReads")):
+    '''Sum salmon quant.sf columns over genes.
+
+    quants is a dict of sample: quant.sf path. Returns a dict of
+    column: genes x samples dataframe, with genes that no quantified
+    transcript maps to left out, as with an inner join on tx2gene.
+    '''
+
+    columns = list(columns)
+    samples = list(quants)
+    genes = pd.unique(tx2gene["gene_id"].values)
+
+    matrices = {x: np.zeros((len(genes), len(samples))) for x in columns}
+    seen = np.zeros(len(genes), dtype=bool)
+
+    names = None
+    index = None
+
+    for n, sample in enumerate(samples):
+        quant = pd.read_csv(quants[sample], sep="\t",
+                            usecols=["Name"] + columns,
+                            dtype={"Name": str})
+
+        if names is None or not np.array_equal(quant["Name"].values, names):
+            names = quant["Name"].values
+            index = transcriptGeneIndex(names, tx2gene, genes)
+            mapped = index >= 0
+            seen[index[mapped]] = True
+
+        for column in columns:
+            matrices[column][:, n] = np.bincount(
+                index[mapped],
+                weights=quant[column].values[mapped],
+                minlength=len(genes))
+
+    genes = pd.Index(genes[seen], name="gene_id")
+
+    return {x: pd.DataFrame(matrices[x][seen], index=genes, columns=samples).sort_index()
+            for x in columns}
+
+
+def salmonTranscriptTable(quants, column="TPM"):
+    '''Return transcripts x samples table of a quant.sf column,
+       quants is a dict of sample: quant.sf path'''
+
+    table = None
+
+    for n, (sample, quant) in enumerate(quants.items()):
+        df = pd.read_csv(quant, sep="\t", usecols=["Name", column],
+                         dtype={"Name": str}, index_col=0)
+
+        if table is None:
+            table = np.zeros((len(df), len(quants)))
+            names = df.index
+
+        if not df.index.equals(names):
+            df = df.reindex(names)
+
+        table[:, n] = df[column].values
+
+    if table is None:
+        return pd.DataFrame()
+
+    return pd.DataFrame(table, index=pd.Index(names, name="transcript_id"),
+                        columns=list(quants))
+
+
+# ---------------------------------------------------
+# Incremental updates
+#
+# In incremental mode only samples whose per-sample output is newer
+# than the merged matrix (or database table) are read, and spliced into
+# the existing matrix or upserted into csvdb.
+
+def modifiedSince(infile, outfile):
+    '''True if outfile does not exist or infile is newer than it'''
+
+    return not os.path.exists(outfile) or \
+        os.path.getmtime(infile) > os.path.getmtime(outfile)
+
+
+def spliceMatrix(outfile, vectors, samples, index_label):
+    '''Splice per-sample vectors into the genes x samples matrix in
+       outfile. vectors is a dict of sample: series for new or changed
+       samples, columns not in samples are dropped'''
+
+    if os.path.exists(outfile):
+        matrix = pd.read_csv(outfile, sep="\t", index_col=0)
+    else:
+        matrix = pd.DataFrame()
+
+    matrix = matrix[[x for x in matrix.columns if x in samples]]
+
+    if vectors:
+        new = pd.DataFrame(vectors)
+        matrix = matrix.drop([x for x in new.columns if x in matrix.columns], axis=1)
+        matrix = pd.concat([matrix, new], axis=1)
+
+    matrix = matrix[sorted(matrix.columns)]
+    matrix.to_csv(outfile, sep="\t", index=True, index_label=index_label)
+
+    return matrix
+
+
+def upsertColumns(dbfile, table, matrix, index, changed):
+    '''Update a wide genes x samples table in place: add new sample
+       columns and overwrite those of changed samples.
+       Returns False if the table has to be reloaded in full instead,
+       i.e. it does not exist, its genes differ or samples were removed'''
+
+    dbh = CsvDB.getConnection(dbfile)
+    quote = CsvDB.quote
+
+    with dbh:
+        columns = CsvDB.tableColumns(dbh, table)
+        if not columns:
+            return False
+
+        genes = set(x[0] for x in dbh.execute(
+            f'''select {quote(index)} from {quote(table)}'''))
+        if genes != set(matrix.index):
+            return False
+
+        if any(x not in matrix.columns for x in columns if x != index):
+            return False
+
+        added = [x for x in matrix.columns if x not in columns]
+        update = added + [x for x in changed if x in columns and x not in added]
+
+        for column in added:
+            dbh.execute(f'''alter table {quote(table)} add column {quote(column)}''')
+
+        if update:
+            # updates look genes up by index
+            CsvDB.createIndex(dbh, table, index)
+
+            assign = ", ".join(f'''{quote(x)} = ?''' for x in update)
+            values = matrix[update].astype(object).where(matrix[update].notnull(), None)
+            rows = [tuple(row) + (gene,)
+                    for gene, row in zip(values.index, values.itertuples(index=False))]
+
+            dbh.executemany(
+                f'''update {quote(table)} set {assign} where {quote(index)} = ?''', rows)
+
+    return True
+
+
+def upsertRows(dbfile, table, frames, samples, key="sample_id"):
+    '''Replace the rows of changed samples in a long table. frames is
+       a dict of sample: dataframe of rows to insert, rows of samples not
+       in samples are deleted. Returns False if the table does not exist'''
+
+    dbh = CsvDB.getConnection(dbfile)
+    quote = CsvDB.quote
+
+    with dbh:
+        columns = CsvDB.tableColumns(dbh, table)
+        if not columns:
+            return False
+
+        # deletes look samples up by key, tables loaded with a
+        # composite index don't have one that starts with it
+        CsvDB.createIndex(dbh, table, key)
+
+        loaded = [x[0] for x in dbh.execute(
+            f'''select distinct {quote(key)} from {quote(table)}''')]
+        remove = [x for x in loaded if x not in set(samples)]
+
+        dbh.executemany(f'''delete from {quote(table)} where {quote(key)} = ?''',
+                        [(x,) for x in list(frames) + list(remove)])
+
+        for sample, df in frames.items():
+            df = df.copy()
+            df[key] = sample
+            df = df[[x for x in columns if x in df.columns]]
+
+            insert = ", ".join(quote(x) for x in df.columns)
+            placeholders = ", ".join("?" for x in df.columns)
+            dbh.executemany(
+                f'''insert into {quote(table)} ({insert}) values ({placeholders})''',
+                df.astype(object).where(df.notnull(), None).itertuples(index=False))
+
+    return True
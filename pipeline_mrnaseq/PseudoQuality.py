@@ -0,0 +1,81 @@
+"""Add placeholder sequence & base qualities to reads that lack them.
+
+BAMs from the CGAT mapping pipelines can have SEQ and/or QUAL stripped
+("*"), which picard refuses. Reads without a sequence get a run of N
+of their query length, reads without qualities a constant placeholder
+quality. All other fields are left as they are.
+
+By default the fixed BAM is streamed uncompressed to stdout, so picard
+can read it through a pipe without a second copy of the BAM on disk::
+
+   python PseudoQuality.py bam.dir/a.bam |
+   picard CollectAlignmentSummaryMetrics I=/dev/stdin ...
+
+With ``--output`` a BGZF compressed BAM is written instead, compressed
+with ``--threads`` threads.
+
+"""
+import sys
+import argparse
+import pysam
+
+
+PLACEHOLDER_QUALITY = 30
+
+
+def fixRead(read, quality=PLACEHOLDER_QUALITY):
+    '''Set placeholder sequence and/or qualities on a read if missing.
+       Returns True if the read was changed'''
+
+    if read.query_sequence and read.query_qualities is not None:
+        return False
+
+    length = read.query_length or read.infer_query_length() or 0
+    if length == 0:
+        return False
+
+    if not read.query_sequence:
+        read.query_sequence = "N" * length
+
+    read.query_qualities = pysam.qualitystring_to_array(chr(quality + 33) * length)
+
+    return True
+
+
+def pseudoQuality(infile, outfile="-", threads=1, quality=PLACEHOLDER_QUALITY):
+    '''Copy infile to outfile ("-" for uncompressed BAM on stdout),
+       adding placeholder sequence & qualities. Returns the number of
+       reads changed'''
+
+    mode = "wbu" if outfile == "-" else "wb"
+    changed = 0
+
+    with pysam.AlignmentFile(infile, threads=threads) as inf, \
+         pysam.AlignmentFile(outfile, mode, template=inf, threads=threads) as outf:
+        for read in inf.fetch(until_eof=True):
+            changed += fixRead(read, quality)
+            outf.write(read)
+
+    return changed
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("bam", help="input BAM file")
+    parser.add_argument("--output", default="-",
+                        help="output BAM file, default uncompressed BAM to stdout")
+    parser.add_argument("--threads", type=int, default=1,
+                        help="threads for BGZF compression & decompression")
+    parser.add_argument("--quality", type=int, default=PLACEHOLDER_QUALITY,
+                        help="placeholder base quality")
+
+    args = parser.parse_args(argv)
+
+    changed = pseudoQuality(args.bam, args.output, args.threads, args.quality)
+
+    sys.stderr.write("added pseudo sequence/quality to %i reads\n" % changed)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
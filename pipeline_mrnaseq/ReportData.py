@@ -0,0 +1,204 @@
+"""Report data bundle of :file:`pipeline_mrnaseq.py`.
+
+The data the report notebooks plot is queried, joined and written
+once, after the pipeline has run, to a bundle directory::
+
+   report.dir/manifest.tsv         - contents of the bundle, with a
+                                     checksum of each table & matrix
+   report.dir/<table>.pkl          - tables (pickled dataframes)
+   report.dir/<matrix>/values.npy  - matrices (see MatrixStore.py)
+
+Only tables & matrices whose checksum changed are rewritten, and
+ReportEngine.py fingerprints the bundle by its manifest, so rewriting
+an unchanged bundle does not re-run the reports.
+
+Tables are
+
+* sample_info       - sample information, as makeSampleInfoTable
+* gene_info         - protein coding genes from the annotation database
+* alignment_stats   - picard alignment summary metrics with sample info
+* rnaseq_metrics    - picard RNA-seq metrics with sample info
+* sample_correlations - sample correlations & distances (SampleCorrelation.py)
+* deseq2_contrasts  - DESeq2 comparisons with the table & file of their results
+* deseq2_design     - DESeq2 design & fitType the pipeline fitted the model with
+
+and matrices featureCounts (read counts) and salmon_genes (TPMs), with
+the samples of sample_info as columns, in its order.
+
+Pipeline task metrics are not bundled, they change with every run
+(rendering the reports included); :func:`taskMetrics` reads them from
+csvdb.
+
+Notebooks load it in one call::
+
+   import ReportData
+   data = ReportData.loadBundle("report.dir", matrices=["salmon_genes"])
+   data.sample_info, data.salmon_genes
+
+"""
+import os
+import types
+import pickle
+import hashlib
+import sqlite3
+import pandas as pd
+import MatrixStore
+import CsvDB
+import TaskMetrics
+
+
+BUNDLE_DIR = "report.dir"
+
+MATRICES = {"featureCounts": "matrix.dir/featureCounts",
+            "salmon_genes": "matrix.dir/salmon_genes"}
+
+PROTEIN_CODING_GENES = '''select distinct b.contig, b.start, b.end, a.gene_id,
+                          a.gene_name from gene_info a, geneset_all_gtf_genome_coordinates
+                          b where a.gene_id = b.gene_id and
+                          transcript_biotype = "protein_coding"'''
+
+
+def readTable(dbh, table):
+    '''Return a table as a dataframe, empty if it does not exist'''
+
+    if not CsvDB.tableColumns(dbh, table):
+        return pd.DataFrame()
+
+    return pd.read_sql_query(f'''select * from "{table}"''', dbh)
+
+
+def withSampleInfo(metrics, sample_info):
+    '''Join per sample metrics to sample info. Sample ids of metrics
+       loaded from bam.dir/<sample>.* files are reduced to <sample>'''
+
+    if metrics.empty:
+        return metrics
+
+    metrics = metrics.copy()
+    metrics["sample_id"] = metrics["sample_id"].map(os.path.basename)
+
+    return pd.merge(metrics, sample_info, how="inner", on="sample_id")
+
+
+def geneInfo(anndb):
+    '''Return protein coding genes of the annotation database, opened
+       read-only as it is shared between projects'''
+
+    dbh = sqlite3.connect(f"file:{os.path.abspath(anndb)}?mode=ro", uri=True)
+
+    try:
+        return pd.read_sql_query(PROTEIN_CODING_GENES, dbh)
+    finally:
+        dbh.close()
+
+
+def bundleTables(dbfile, anndb):
+    '''Return dict of name: dataframe of the tables of the bundle'''
+
+    dbh = CsvDB.getConnection(dbfile)
+
+    sample_info = readTable(dbh, "sample_info")
+    sample_info = sample_info.drop([x for x in ("index",) if x in sample_info], axis=1)
+
+    alignment_stats = readTable(dbh, "picardAlignmentSummary")
+
+    rnaseq_metrics = readTable(dbh, "picardRNAseqMetrics")
+    if "PCT_RIBOSOMAL_BASES" in rnaseq_metrics:
+        # empty without ribosomal intervals
+        rnaseq_metrics["PCT_RIBOSOMAL_BASES"] = pd.to_numeric(
+            rnaseq_metrics["PCT_RIBOSOMAL_BASES"], errors="coerce").fillna(0)
+
+    return {"sample_info": sample_info,
+            "gene_info": geneInfo(anndb),
+            "alignment_stats": withSampleInfo(alignment_stats, sample_info),
+            "rnaseq_metrics": withSampleInfo(rnaseq_metrics, sample_info),
+            "sample_correlations": readTable(dbh, "sample_correlations"),
+            "deseq2_contrasts": readTable(dbh, "DESeq2_contrasts"),
+            "deseq2_design": readTable(dbh, "DESeq2_design")}
+
+
+def taskMetrics(dbfile):
+    '''Return pipeline task timing & resource usage from csvdb'''
+
+    task_metrics = readTable(CsvDB.getConnection(dbfile), "pipeline_task_metrics")
+
+    if task_metrics.empty:
+        task_metrics = pd.DataFrame(columns=TaskMetrics.COLUMNS)
+
+    return task_metrics
+
+
+def readChecksums(outdir):
+    '''Return dict of name: checksum of an existing bundle'''
+
+    manifest = os.path.join(outdir, "manifest.tsv")
+
+    if not os.path.exists(manifest):
+        return {}
+
+    manifest = pd.read_csv(manifest, sep="\t")
+
+    if "checksum" not in manifest:
+        return {}
+
+    return dict(zip(manifest["name"], manifest["checksum"]))
+
+
+def writeBundle(dbfile, anndb, outdir=BUNDLE_DIR, matrices=MATRICES):
+    '''Write the report data bundle to outdir, returns its manifest.
+       Tables & matrices that are unchanged are left as they are'''
+
+    os.makedirs(outdir, exist_ok=True)
+    previous = readChecksums(outdir)
+    manifest = []
+
+    tables = bundleTables(dbfile, anndb)
+    samples = list(tables["sample_info"]["sample_id"])
+
+    for name, df in tables.items():
+        data = pickle.dumps(df, protocol=4)
+        checksum = hashlib.sha1(data).hexdigest()
+        outfile = os.path.join(outdir, f"{name}.pkl")
+
+        if previous.get(name) != checksum or not os.path.exists(outfile):
+            with open(outfile + ".tmp", "wb") as outf:
+                outf.write(data)
+            os.replace(outfile + ".tmp", outfile)
+
+        manifest.append([name, "table", len(df), len(df.columns), checksum])
+
+    for name, path in matrices.items():
+        if not os.path.exists(os.path.join(path, "values.npy")):
+            continue
+
+        rows, columns = MatrixStore.readIndex(path)
+        matrix = MatrixStore.loadMatrix(path, samples=[x for x in samples if x in set(columns)])
+        checksum = MatrixStore.matrixChecksum(matrix)
+        store = os.path.join(outdir, name)
+
+        if previous.get(name) != checksum or not os.path.exists(os.path.join(store, "values.npy")):
+            MatrixStore.writeMatrix(matrix, store)
+
+        manifest.append([name, "matrix", len(matrix), len(matrix.columns), checksum])
+
+    manifest = pd.DataFrame(manifest, columns=["name", "kind", "rows", "columns", "checksum"])
+    manifest.to_csv(os.path.join(outdir, "manifest.tsv"), sep="\t", index=False)
+
+    return manifest
+
+
+def loadBundle(path=BUNDLE_DIR, matrices=None):
+    '''Load the report data bundle. Returns a namespace with an
+       attribute per table and matrix. matrices limits the matrices
+       loaded, default all'''
+
+    manifest = pd.read_csv(os.path.join(path, "manifest.tsv"), sep="\t")
+    data = {}
+
+    for name, kind in zip(manifest["name"], manifest["kind"]):
+        if kind == "table":
+            data[name] = pd.read_pickle(os.path.join(path, f"{name}.pkl"))
+        elif matrices is None or name in matrices:
+            data[name] = MatrixStore.loadMatrix(os.path.join(path, name))
+
+    return types.SimpleNamespace(**data)
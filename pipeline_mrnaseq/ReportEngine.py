@@ -0,0 +1,240 @@
+"""Headless rendering of the Jupyter notebook reports of
+:file:`pipeline_mrnaseq.py`.
+
+Each template is executed once, in the pipeline's working directory,
+and the HTML report is exported from the executed notebook without
+running it again. The executed notebook is kept next to the report
+(``<name>.nbconvert.ipynb``) and carries a fingerprint of what went
+into it:
+
+* the template itself
+* the csvdb tables the template names, each fingerprinted by the
+  ``.load`` file of the task that loaded it, or by its row count & last
+  rowid for tables without one (e.g. ``sample_info``). Tables the
+  template writes itself (``to_sql``, ``upload2csvdb``) are left out
+* other files & directories the template reads from the working
+  directory, e.g. ``pipeline.yml`` and ``matrix.dir`` stores, and the
+  report data bundle ``report.dir`` by the checksums of its manifest
+
+A report whose fingerprint is unchanged is not executed again, so
+reports are only re-run when an input they actually read has changed,
+e.g. loading new picard metrics re-runs the QC report but not DESeq2.
+
+Usage::
+
+   python ReportEngine.py --timeout 3600
+                          <PATH>/reports/RNA_Pipeline_Report.ipynb
+                          RNA_Pipeline_Report.nbconvert.html
+
+"""
+import os
+import re
+import sys
+import glob
+import json
+import sqlite3
+import hashlib
+import argparse
+
+
+FINGERPRINT_KEY = "mrnaseq_report"
+
+# string literals in code cells, candidate input files
+STRING_LITERAL = re.compile(r'''["']([\w./-]+)["']''')
+MATRIX_STORE = re.compile(r"matrix\.dir/[\w.-]+")
+# tables written by a notebook, df.to_sql("table", ...), upload2csvdb(df, "table", ...)
+WRITTEN_TABLE = re.compile(r'''(?:to_sql|upload2csvdb)\(\s*(?:\w+\s*,\s*)?["'](\w+)["']''')
+
+
+def loadSentinels(workdir="."):
+    '''Return dict of table: .load file of the pipeline task that loaded
+       it, table names derived from file names as cgatcore's to_table'''
+
+    sentinels = {}
+
+    for sentinel in glob.glob(os.path.join(workdir, "*.load")) + \
+            glob.glob(os.path.join(workdir, "*", "*.load")):
+        table = os.path.basename(sentinel)[:-len(".load")]
+        sentinels[re.sub(r"[-.]", "_", table)] = sentinel
+
+    return sentinels
+
+
+def fileStamp(path):
+    '''Size & modification time of a file, or of the files in a
+       directory. A directory with a manifest.tsv, i.e. the report data
+       bundle (see ReportData.py), is stamped by the manifest's content,
+       which has a checksum of each table & matrix'''
+
+    manifest = os.path.join(path, "manifest.tsv")
+
+    if os.path.isdir(path) and os.path.exists(manifest):
+        with open(manifest, "rb") as inf:
+            return hashlib.sha1(inf.read()).hexdigest()
+
+    if os.path.isdir(path):
+        return [(x, fileStamp(os.path.join(path, x))) for x in sorted(os.listdir(path))]
+
+    stat = os.stat(path)
+
+    return [stat.st_size, stat.st_mtime_ns]
+
+
+def tableStamp(dbh, table):
+    '''Row count & last rowid of a table, tables are replaced or
+       appended to when they are loaded'''
+
+    return list(dbh.execute(f'''select count(*), max(rowid) from "{table}"''').fetchone())
+
+
+def notebookSource(notebook):
+    '''Return the code of a notebook, all code cells concatenated'''
+
+    return "\n".join("".join(cell["source"]) for cell in notebook["cells"]
+                     if cell["cell_type"] == "code")
+
+
+def reportInputs(notebook, dbfile="csvdb", workdir="."):
+    '''Return dict of input: fingerprint for the csvdb tables, files
+       and matrix stores a notebook reads'''
+
+    source = notebookSource(notebook)
+    words = set(re.findall(r"\w+", source)) - set(WRITTEN_TABLE.findall(source))
+    inputs = {}
+
+    if os.path.exists(dbfile):
+        sentinels = loadSentinels(workdir)
+        dbh = sqlite3.connect(dbfile)
+
+        try:
+            tables = [x[0] for x in dbh.execute(
+                '''select name from sqlite_master where type in ('table', 'view')''')]
+
+            for table in sorted(x for x in tables if x in words):
+                if table in sentinels:
+                    inputs[f"table:{table}"] = fileStamp(sentinels[table])
+                else:
+                    inputs[f"table:{table}"] = tableStamp(dbh, table)
+        finally:
+            dbh.close()
+
+    # the database is covered by its tables, not its file stamp
+    ignore = {os.path.abspath(dbfile)}
+
+    paths = set(MATRIX_STORE.findall(source)) | set(STRING_LITERAL.findall(source))
+
+    for path in sorted(paths):
+        full = os.path.join(workdir, path)
+        if os.path.abspath(full) in ignore or not os.path.exists(full):
+            continue
+        inputs[f"file:{os.path.normpath(path)}"] = fileStamp(full)
+
+    return inputs
+
+
+def reportFingerprint(template, dbfile="csvdb", workdir=".", kernel=None):
+    '''sha1 of a template and the inputs it reads'''
+
+    with open(template) as inf:
+        notebook = json.load(inf)
+
+    with open(template, "rb") as inf:
+        content = hashlib.sha1(inf.read()).hexdigest()
+
+    state = {"template": content,
+             "kernel": kernel,
+             "inputs": reportInputs(notebook, dbfile, workdir)}
+
+    return hashlib.sha1(json.dumps(state, sort_keys=True).encode()).hexdigest()
+
+
+def executedNotebook(outfile):
+    '''Path of the executed notebook kept with an html report'''
+
+    return re.sub(r"\.html$", "", outfile) + ".ipynb"
+
+
+def reportIsCurrent(template, outfile, dbfile="csvdb", workdir=".", kernel=None):
+    '''True if the html report and its executed notebook exist and were
+       made from the current template & inputs'''
+
+    executed = executedNotebook(outfile)
+
+    if not (os.path.exists(outfile) and os.path.exists(executed)):
+        return False
+
+    try:
+        with open(executed) as inf:
+            metadata = json.load(inf).get("metadata", {}).get(FINGERPRINT_KEY, {})
+    except ValueError:
+        return False
+
+    return metadata.get("fingerprint") == \
+        reportFingerprint(template, dbfile, workdir, kernel)
+
+
+def renderReport(template, outfile, dbfile="csvdb", workdir=".", timeout=None,
+                 kernel=None, force=False):
+    '''Execute template once in workdir and export it to html outfile.
+       Returns False if the report was current and skipped'''
+
+    # jupyter is only needed to render, not to check reports
+    import nbformat
+    from nbconvert import HTMLExporter
+    from nbconvert.preprocessors import ExecutePreprocessor
+
+    if not force and reportIsCurrent(template, outfile, dbfile, workdir, kernel):
+        return False
+
+    notebook = nbformat.read(template, as_version=4)
+
+    options = {"timeout": timeout, "allow_errors": True}
+    if kernel:
+        options["kernel_name"] = kernel
+
+    ExecutePreprocessor(**options).preprocess(
+        notebook, {"metadata": {"path": workdir}})
+
+    # taken after running, so files the report writes itself do not
+    # make it out of date
+    fingerprint = reportFingerprint(template, dbfile, workdir, kernel)
+
+    notebook.metadata[FINGERPRINT_KEY] = {"template": os.path.abspath(template),
+                                          "fingerprint": fingerprint}
+
+    nbformat.write(notebook, executedNotebook(outfile))
+
+    body, resources = HTMLExporter().from_notebook_node(notebook)
+
+    with open(outfile, "w") as outf:
+        outf.write(body)
+
+    return True
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("template", help="report notebook template")
+    parser.add_argument("html", help="output html report")
+    parser.add_argument("--database", default="csvdb",
+                        help="pipeline database the report reads")
+    parser.add_argument("--timeout", type=int, default=None,
+                        help="seconds a cell may run, default no limit")
+    parser.add_argument("--kernel", default=None,
+                        help="jupyter kernel, default that of the template")
+    parser.add_argument("--force", action="store_true",
+                        help="render even if the report is current")
+
+    args = parser.parse_args(argv)
+
+    rendered = renderReport(args.template, args.html, args.database,
+                            timeout=args.timeout, kernel=args.kernel,
+                            force=args.force)
+
+    sys.stderr.write("%s %s\n" % ("rendered" if rendered else "skipped, current:",
+                                  args.html))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,272 @@
+"""Pairwise sample correlations & distances of a genes x samples
+expression matrix, for the report heatmaps of
+:file:`pipeline_mrnaseq.py`.
+
+Values are upper quartile normalised TPMs (see ExpressionStats.py),
+log2(x + 1) transformed, of protein coding genes; for all of them and
+for the top genes by mean. For each gene set
+
+* pearson   - Pearson correlation
+* spearman  - Spearman correlation, Pearson correlation of average ranks
+* manhattan - Manhattan distance, sum of absolute differences
+
+are computed over blocks of genes in a thread pool, so memory is
+bounded by the block size per thread (plus, for spearman, a float32
+matrix of ranks). Results are cached in ``--cache-dir``, keyed by the
+checksum of the matrix and its gene & sample ids, so unchanged
+matrices are not recomputed. Only the results of the most recently
+used matrices are kept, as DESeq2Analysis.R prunes its model cache.
+
+Results are written as a single table, one row per method, gene set
+and sample, with a column per sample::
+
+   method, genes, sample_id, <sample 1>, <sample 2>, ...
+
+from which :func:`tableMatrix` returns the samples x samples matrix of
+a method & gene set, e.g. for the heatmaps of the report::
+
+   SampleCorrelation.tableMatrix(data.sample_correlations, "pearson", "all")
+
+Usage::
+
+   python SampleCorrelation.py --annotations-db csvdb --top 5000
+                               --threads 8 --cache-dir correlation.dir/cache
+                               matrix.dir/salmon_genes
+                               correlation.dir/sample_correlations.tsv
+
+"""
+import os
+import sys
+import argparse
+import concurrent.futures
+import numpy as np
+import pandas as pd
+import MatrixStore
+import ExpressionStats
+
+
+METHODS = ("pearson", "spearman", "manhattan")
+
+
+def geneBlocks(ngenes, block_size):
+    '''Return (start, end) of blocks of genes'''
+
+    return [(x, min(x + block_size, ngenes)) for x in range(0, ngenes, block_size)]
+
+
+def mapBlocks(function, values, block_size, threads, dtype=np.float64):
+    '''Apply function to blocks of rows of values, as dtype, in a thread
+       pool, returns the results in block order. NumPy releases the GIL
+       in the array operations, so blocks run in parallel'''
+
+    blocks = geneBlocks(len(values), block_size)
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, threads)) as pool:
+        return list(pool.map(lambda x: function(np.asarray(values[x[0]:x[1]], dtype)),
+                             blocks))
+
+
+def pearsonFromMoments(n, sums, cross):
+    '''Pearson correlation matrix of the columns of a matrix with n rows,
+       from its column sums and cross products (X'X)'''
+
+    means = sums / n
+    covariance = (cross - n * np.outer(means, means)) / (n - 1)
+    sd = np.sqrt(np.diag(covariance))
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        correlation = covariance / np.outer(sd, sd)
+
+    return np.clip(correlation, -1, 1)
+
+
+def pearson(values, block_size=5000, threads=1):
+    '''Pearson correlation of the columns of values'''
+
+    def moments(block):
+        return block.sum(axis=0), block.T @ block
+
+    partials = mapBlocks(moments, values, block_size, threads)
+
+    sums = sum(x[0] for x in partials)
+    cross = sum(x[1] for x in partials)
+
+    return pearsonFromMoments(len(values), sums, cross)
+
+
+def averageRanks(column):
+    '''Ranks of the values of a column, ties given their average rank'''
+
+    order = np.argsort(column, kind="mergesort")
+    ordered = column[order]
+
+    new = np.empty(len(column), dtype=bool)
+    new[:1] = True
+    new[1:] = ordered[1:] != ordered[:-1]
+
+    starts = np.flatnonzero(new)
+    ends = np.append(starts[1:], len(column))
+
+    ranks = np.empty(len(column), dtype=np.float32)
+    ranks[order] = ((starts + ends + 1) / 2)[np.cumsum(new) - 1]
+
+    return ranks
+
+
+def spearman(values, block_size=5000, threads=1):
+    '''Spearman correlation of the columns of values'''
+
+    ranks = np.empty(values.shape, dtype=np.float32, order="F")
+
+    def rank(n):
+        ranks[:, n] = averageRanks(np.asarray(values[:, n]))
+
+    with concurrent.futures.ThreadPoolExecutor(max(1, threads)) as pool:
+        list(pool.map(rank, range(values.shape[1])))
+
+    return pearson(ranks, block_size, threads)
+
+
+def manhattan(values, block_size=5000, threads=1):
+    '''Manhattan distance between the columns of values'''
+
+    nsamples = values.shape[1]
+
+    def distances(block):
+        d = np.zeros((nsamples, nsamples))
+        for n in range(nsamples - 1):
+            d[n, n + 1:] = np.abs(block[:, n + 1:] - block[:, n:n + 1]).sum(
+                axis=0, dtype=np.float64)
+        return d
+
+    # differences in float32, summed in float64
+    d = sum(mapBlocks(distances, values, block_size, threads, np.float32))
+
+    return d + d.T
+
+
+ENGINES = {"pearson": pearson, "spearman": spearman, "manhattan": manhattan}
+
+
+def pruneCache(cache_dir, keep=4):
+    '''Remove the results of all but the keep most recently used
+       matrices of cache_dir, the default those of both gene sets of
+       the last two runs'''
+
+    used = {}
+    for name in os.listdir(cache_dir):
+        if name.endswith(".npy") and not name.endswith(".tmp.npy"):
+            checksum = name.split(".")[0]
+            mtime = os.path.getmtime(os.path.join(cache_dir, name))
+            used[checksum] = max(used.get(checksum, mtime), mtime)
+
+    stale = set(sorted(used, key=used.get, reverse=True)[keep:])
+
+    for name in os.listdir(cache_dir):
+        if name.split(".")[0] in stale:
+            os.remove(os.path.join(cache_dir, name))
+
+
+def sampleCorrelation(matrix, method, block_size=5000, threads=1, cache_dir=None):
+    '''Return samples x samples correlations or distances of log2(x + 1)
+       values of a genes x samples matrix by method, from the cache if
+       the matrix has been seen before'''
+
+    cached = None
+    if cache_dir:
+        cached = os.path.join(cache_dir, f"{MatrixStore.matrixChecksum(matrix)}.{method}.npy")
+        if os.path.exists(cached):
+            # mark as used, pruneCache keeps the most recently used
+            os.utime(cached)
+            return pd.DataFrame(np.load(cached), index=matrix.columns,
+                                columns=matrix.columns)
+
+    values = np.log2(matrix.values.astype(np.float32) + 1)
+    result = ENGINES[method](values, block_size, threads)
+
+    if cached:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = cached + ".tmp.npy"
+        np.save(tmp, result)
+        os.replace(tmp, cached)
+
+    return pd.DataFrame(result, index=matrix.columns, columns=matrix.columns)
+
+
+def correlationTable(matrix, genes=None, top=5000, methods=METHODS,
+                     block_size=5000, threads=1, cache_dir=None):
+    '''Correlations & distances of the samples of an expression matrix,
+       upper quartile normalised and restricted to genes, for all genes
+       and the top genes by mean. Returns the long-wide table of all
+       methods & gene sets'''
+
+    matrix = ExpressionStats.upperQuartileNormalise(matrix)
+
+    if genes is not None:
+        matrix = matrix[matrix.index.isin(set(genes))]
+
+    means = np.nanmean(matrix.values, axis=1)
+    top_genes = np.sort(np.argsort(-means, kind="stable")[:top])
+
+    gene_sets = {"all": matrix, f"top{top}": matrix.iloc[top_genes]}
+
+    tables = []
+    for name, subset in gene_sets.items():
+        for method in methods:
+            result = sampleCorrelation(subset, method, block_size, threads, cache_dir)
+            result.insert(0, "sample_id", result.index)
+            result.insert(0, "genes", name)
+            result.insert(0, "method", method)
+            tables.append(result)
+
+    if cache_dir:
+        pruneCache(cache_dir)
+
+    return pd.concat(tables, ignore_index=True)
+
+
+def tableMatrix(table, method="pearson", genes="all"):
+    '''Return the samples x samples matrix of method & gene set of a
+       table written by correlationTable'''
+
+    subset = table[(table["method"] == method) & (table["genes"] == genes)]
+    subset = subset.set_index("sample_id")
+
+    return subset[list(subset.index)].astype(float)
+
+
+def main(argv=None):
+
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("matrix", help="matrix store of a genes x samples matrix")
+    parser.add_argument("output", help="output table")
+    parser.add_argument("--annotations-db", default=None,
+                        help="annotation database, restrict to its protein coding genes")
+    parser.add_argument("--top", type=int, default=5000,
+                        help="number of top genes by mean for the second gene set")
+    parser.add_argument("--methods", default=",".join(METHODS),
+                        help="comma separated methods, from %s" % ", ".join(METHODS))
+    parser.add_argument("--block-size", type=int, default=5000,
+                        help="genes per block")
+    parser.add_argument("--threads", type=int, default=1)
+    parser.add_argument("--cache-dir", default=None,
+                        help="directory of cached results")
+
+    args = parser.parse_args(argv)
+
+    genes = None
+    if args.annotations_db:
+        # only needed to subset genes
+        import ReportData
+        genes = ReportData.geneInfo(args.annotations_db)["gene_id"]
+
+    table = correlationTable(MatrixStore.loadMatrix(args.matrix), genes=genes,
+                             top=args.top, methods=args.methods.split(","),
+                             block_size=args.block_size, threads=args.threads,
+                             cache_dir=args.cache_dir)
+
+    table.to_csv(args.output, sep="\t", index=False, float_format="%.6g")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
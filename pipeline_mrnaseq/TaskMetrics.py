@@ -0,0 +1,142 @@
+"""Timing & resource usage of :file:`pipeline_mrnaseq.py` tasks.
+
+Every task job records one row for the task itself (the Python code
+run by ruffus, measured with ``getrusage``) and one row per cluster
+or local job it submits with ``P.run`` (from cgatcore's benchmark
+data). Rows are appended to ``metrics.dir/<task>.tsv`` and loaded into
+the ``pipeline_task_metrics`` table of csvdb, where they accumulate
+over runs::
+
+   task, job, kind, hostname, start_time, wall_t, cpu_t, max_rss,
+   bytes_read, bytes_written, threads_requested, threads_used,
+   memory_requested
+
+``kind`` is "task" or "job", times are in seconds, ``max_rss`` and
+I/O in bytes. ``threads_used`` is CPU time over wall time.
+
+"""
+import os
+import re
+import time
+import socket
+import resource
+import threading
+
+
+METRICS_DIR = "metrics.dir"
+
+COLUMNS = ["task", "job", "kind", "hostname", "start_time", "wall_t",
+           "cpu_t", "max_rss", "bytes_read", "bytes_written",
+           "threads_requested", "threads_used", "memory_requested"]
+
+# jobs submitted by the task job running in each thread
+_jobs = threading.local()
+_lock = threading.Lock()
+
+UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def toBytes(value, unit=1):
+    '''Convert a resource usage value to bytes. Numbers are in units of
+       unit bytes, strings may carry a K/M/G/T suffix (e.g. slurm)'''
+
+    if value is None or value == "":
+        return None
+
+    if isinstance(value, str):
+        match = re.match(r"^\s*([0-9.]+)\s*([KMGT]?)", value.upper())
+        if not match:
+            return None
+        if match.group(2):
+            return float(match.group(1)) * UNITS[match.group(2)]
+        value = match.group(1)
+
+    return float(value) * unit
+
+
+# ruffus runs jobs in threads, measure the job's own thread where possible
+RUSAGE = getattr(resource, "RUSAGE_THREAD", resource.RUSAGE_SELF)
+
+
+def usage():
+    '''Return wall clock time and rusage of this thread'''
+
+    return time.time(), resource.getrusage(RUSAGE)
+
+
+def startTask():
+    '''Start recording jobs submitted from this thread, returns usage'''
+
+    _jobs.rows = []
+
+    return usage()
+
+
+def recordJobs(benchmark, threads=1, memory=None):
+    '''Keep the benchmark data returned by P.run for the current task'''
+
+    rows = getattr(_jobs, "rows", None)
+    if rows is None or not benchmark:
+        return
+
+    for data in benchmark:
+        data = data._asdict() if hasattr(data, "_asdict") else dict(data)
+
+        wall = float(data.get("wall_t") or data.get("total_t") or 0)
+        cpu = float(data.get("cpu_t") or 0) or \
+            float(data.get("user_t") or 0) + float(data.get("sys_t") or 0)
+
+        rows.append({"kind": "job",
+                     "hostname": data.get("hostname"),
+                     "start_time": data.get("start_time"),
+                     "wall_t": wall,
+                     "cpu_t": cpu,
+                     # /usr/bin/time & rusage report KB and 512 byte blocks
+                     "max_rss": toBytes(data.get("max_rss"), 1024),
+                     "bytes_read": toBytes(data.get("io_input"), 512),
+                     "bytes_written": toBytes(data.get("io_output"), 512),
+                     "threads_requested": threads,
+                     "threads_used": cpu / wall if wall else None,
+                     "memory_requested": memory})
+
+
+def finishTask(task, job, start):
+    '''Write the task's own usage since start and its jobs to
+       metrics.dir/<task>.tsv'''
+
+    start_time, before = start
+    end_time, after = usage()
+
+    wall = end_time - start_time
+    cpu = (after.ru_utime - before.ru_utime) + (after.ru_stime - before.ru_stime)
+
+    rows = [{"kind": "task",
+             "hostname": socket.gethostname(),
+             "start_time": start_time,
+             "wall_t": wall,
+             "cpu_t": cpu,
+             # peak of the pipeline process, ru_maxrss is in KB on linux
+             "max_rss": after.ru_maxrss * 1024,
+             "bytes_read": (after.ru_inblock - before.ru_inblock) * 512,
+             "bytes_written": (after.ru_oublock - before.ru_oublock) * 512,
+             "threads_requested": 1,
+             "threads_used": cpu / wall if wall else None,
+             "memory_requested": None}]
+
+    rows.extend(getattr(_jobs, "rows", None) or [])
+    _jobs.rows = None
+
+    outfile = os.path.join(METRICS_DIR, f"{task}.tsv")
+
+    with _lock:
+        os.makedirs(METRICS_DIR, exist_ok=True)
+        header = not os.path.exists(outfile)
+
+        with open(outfile, "a") as outf:
+            if header:
+                outf.write("\t".join(COLUMNS) + "\n")
+
+            for row in rows:
+                row.update({"task": task, "job": job})
+                outf.write("\t".join("" if row.get(x) is None else str(row[x])
+                                     for x in COLUMNS) + "\n")
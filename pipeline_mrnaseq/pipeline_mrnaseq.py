@@ -65,77 +65,321 @@ from ruffus import *
 import sys
 import os
 import glob
-import sqlite3
+import functools
+import hashlib
+from collections.abc import Mapping
 import cgatcore.experiment as E
 from cgatcore import pipeline as P
-from cgat.BamTools import bamtools as BamTools
 import pandas as pd
 import re
+import PipelineMrnaseq
+import MatrixStore
+import CsvDB
+import TaskMetrics
+import ReportEngine
+import ReportData
 
 # Pipeline configuration
-P.get_parameters(
+#
+# Importing the pipeline has no side effects: the configuration is read
+# and the input data inspected on first use, and cached for the process.
+class LazyParams(Mapping):
+    '''Pipeline parameters, read from the pipeline.yml files when
+       first accessed'''
+
+    def __init__(self, paths):
+        self.paths = paths
+        self.params = None
+
+    def load(self):
+        if self.params is None:
+            self.params = P.get_parameters(self.paths)
+        return self.params
+
+    def __getitem__(self, key):
+        return self.load()[key]
+
+    def __iter__(self):
+        return iter(self.load())
+
+    def __len__(self):
+        return len(self.load())
+
+
+PARAMS = LazyParams(
 		 ["%s/pipeline.yml" % os.path.splitext(__file__)[0],
 		  "../pipeline.yml",
 		  "pipeline.yml"],
 		 )
 
-PARAMS = P.PARAMS
 
-db = PARAMS['database']['url'].split('./')[1]
+@functools.lru_cache()
+def database():
+    '''Return path of the pipeline database, configuring database access
+       on first use'''
+
+    CsvDB.configure(journal_mode=PARAMS.get("csvdb_journal_mode"),
+                    cache_mb=PARAMS.get("csvdb_cache_mb"),
+                    batch_size=PARAMS.get("csvdb_batch_size"))
+
+    return PARAMS['database']['url'].split('./')[1]
+
 
 def connect():
     '''connect to database.
     This method also attaches to helper databases.
     '''
 
-    dbh = sqlite3.connect(db)
+    dbh = CsvDB.getConnection(database())
 
-    if not os.path.exists(PARAMS["annotations_database"]):
-        raise ValueError(
-                     "can't find database '%s'" %
-                     PARAMS["annotations_database"])
+    return CsvDB.attach(dbh, PARAMS["annotations_database"], "annotations")
 
-    statement = '''ATTACH DATABASE '%s' as annotations''' % \
-    (PARAMS["annotations_database"])
 
-    cc = dbh.cursor()
-    cc.execute(statement)
-    cc.close()
+# utility functions
 
-    return dbh
+def run(statement, **kwargs):
+    '''Run statement(s) with P.run, keeping the jobs' timing & resource
+       usage for the metrics of the task running them'''
 
+    benchmark = P.run(statement, **kwargs)
 
-# utility functions
+    TaskMetrics.recordJobs(benchmark, kwargs.get("job_threads", 1),
+                           kwargs.get("job_memory"))
 
-def isPaired(files):
-    '''Check whether input files are single or paired end
-       Note: this is dependent on files having correct suffix'''
-    
-    paired = []
+    return benchmark
+
+
+def instrument(task):
+    '''Decorator recording wall & CPU time, peak memory and I/O of each
+       job of a task, and of the P.run jobs it submits, in
+       metrics.dir/<task>.tsv (see TaskMetrics.py)'''
+
+    @functools.wraps(task)
+    def job(*args):
+        start = TaskMetrics.startTask()
+        try:
+            return task(*args)
+        finally:
+            outputs = args[1] if len(args) > 1 else ""
+            if isinstance(outputs, (list, tuple)):
+                outputs = ",".join(outputs)
+            TaskMetrics.finishTask(task.__name__, outputs, start)
+
+    return job
+
+
+def flattenInputs(infiles):
+    '''Return the inputs of a @merge as a flat list of files. Upstream
+       jobs with several outputs pass them as a list'''
 
-    for fastq in files:
-        Fpair = re.findall(".*.fastq.1.gz", fastq)
-        paired = paired + Fpair
+    return [y for x in infiles for y in (x if isinstance(x, (list, tuple)) else [x])]
 
-    if len(paired)==0:
-        unpaired = True
+
+def starStatement(reads, outfile, threads, genome_load=None):
+    '''Build STAR mapping statement for a sample.
+       STAR SAM output is streamed straight to a coordinate sorted
+       BAM as set by star_sort:
+         samtools - multi-threaded samtools sort, index written on the fly
+         star - STAR's own sorted BAM output, indexed after mapping
+         legacy - unsorted tmp BAM, sorted in a second pass
+       genome_load sets STAR --genomeLoad, e.g. LoadAndKeep for batches
+       mapped against a genome held in shared memory'''
+
+    genomeDir = PARAMS["star_index_dir"]
+    tmpdir = PARAMS["tmp_dir"]
+    options = PARAMS.get("star_options") or ""
+    sort = PARAMS.get("star_sort") or "samtools"
+
+    sample = os.path.basename(outfile)[:-len(".bam")]
+    log_prefix = outfile[:-len(".bam")] + "."
+
+    star = f'''STAR 
+                  --runMode alignReads 
+                  --runThreadN {threads} 
+                  --genomeDir {genomeDir}
+                  --outSAMstrandField intronMotif 
+                  --outFileNamePrefix {log_prefix}
+                  --outSAMunmapped Within 
+                  {options}
+                  --readFilesIn {reads}
+                  --readFilesCommand zcat'''
+
+    if genome_load:
+        star = star + f" --genomeLoad {genome_load}"
+
+    sort_threads, sort_mem = starSortResources()
+
+    if sort == "samtools":
+        # samtools >= 1.10 for --write-index
+        statement = f'''{star}
+                          --outStd SAM |
+                        samtools sort 
+                          -@ {sort_threads}
+                          -m {sort_mem}
+                          -T {tmpdir}/{sample}.sort
+                          -O BAM
+                          --write-index
+                          -o {outfile}##idx##{outfile}.bai - '''
+
+    elif sort == "star":
+        bam_sort_ram = PARAMS.get("star_bam_sort_ram") or 10000000000
+
+        statement = f'''{star}
+                          --outSAMtype BAM SortedByCoordinate
+                          --outBAMsortingThreadN {sort_threads}
+                          --limitBAMsortRAM {bam_sort_ram}
+                          --outTmpDir {tmpdir}/{sample}.STARtmp &&
+                        mv {log_prefix}Aligned.sortedByCoord.out.bam {outfile} &&
+                        samtools index -@ {sort_threads} -b {outfile} {outfile}.bai'''
+
+    elif sort == "legacy":
+        statement = f'''tmp=`mktemp -p {tmpdir}` &&
+                        {star}
+                          --outStd SAM | samtools view -b - 
+                          >  $tmp &&
+                        samtools sort -O BAM  $tmp > {outfile} &&
+                        rm $tmp'''
 
     else:
-        unpaired = False
-    
-    return unpaired
+        raise ValueError(
+            "unknown star_sort option '%s', use samtools, star or legacy" % sort)
+
+    return statement
+
+
+def starSortResources():
+    '''Return threads & memory per thread for sorting STAR output'''
+
+    threads = PipelineMrnaseq.resolveThreads(
+        PARAMS, PARAMS.get("star_sort_threads") or 4)
+
+    return threads, PARAMS.get("star_sort_memory") or "768M"
+
+
+def starJobThreads(threads):
+    '''Threads to request for a STAR job, STAR's own threads plus
+       those of the samtools sort it streams into'''
+
+    if (PARAMS.get("star_sort") or "samtools") == "samtools":
+        threads = threads + starSortResources()[0]
+
+    return threads
+
+
+def starBatchStatement(samples, batch, threads):
+    '''Build a statement mapping a batch of samples on one node against
+       a STAR genome loaded once into shared memory.
+       samples is a list of (reads, outfile) tuples. Batches on the same
+       node share the genome: a node-local list of the PIDs of running
+       batches, updated under flock, makes the first batch load the
+       genome and the last one to finish remove it. A batch leaves the
+       list in an EXIT trap, which also fires when the job fails or is
+       sent INT, TERM or HUP by the scheduler. PIDs of batches killed
+       outright (SIGKILL) are dropped when the list is next updated, so
+       they do not keep the genome loaded'''
+
+    genomeDir = PARAMS["star_index_dir"]
+    prefix = f"star.dir/genome_load.{batch}."
+    key = hashlib.md5(os.path.abspath(genomeDir).encode()).hexdigest()
+    users = f"/tmp/star_genome.{key}"
+    pids = f"{users}.pids"
+
+    load = f'''STAR 
+                  --genomeDir {genomeDir}
+                  --genomeLoad LoadAndExit
+                  --outFileNamePrefix {prefix}'''
+
+    remove = f'''STAR 
+                    --genomeDir {genomeDir}
+                    --genomeLoad Remove
+                    --outFileNamePrefix {prefix}remove.
+                    > /dev/null 2>&1'''
+
+    # $$ is the PID of the job's shell, also in the ( ) subshells
+    statement = [f'''star_alive() {{
+                        for p in $(cat {pids} 2> /dev/null) ; do
+                           if kill -0 $p 2> /dev/null ; then echo $p ; fi ;
+                        done ; }} ;
+                     star_enter() {{ (
+                        flock 9 &&
+                        alive=$(star_alive) &&
+                        if [ -z "$alive" ]; then {load} ; fi &&
+                        printf "%s\\n" $alive $$ > {pids}
+                     ) 9> {users}.lock ; }} ;
+                     star_cleanup() {{ (
+                        flock 9 ;
+                        alive=$(star_alive | grep -vx $$) ;
+                        if [ -z "$alive" ]; then rm -f {pids} ; {remove} ;
+                        else printf "%s\\n" $alive > {pids} ; fi
+                     ) 9> {users}.lock ; }} ;
+                     star_enter &&
+                     trap star_cleanup EXIT &&
+                     trap "exit 1" INT TERM HUP''']
+
+    for reads, outfile in samples:
+        statement.append(
+            starStatement(reads, outfile, threads, genome_load="LoadAndKeep"))
+
+    return " && ".join(statement)
+
 
 # ---------------------------------------------------
 # Specific pipeline tasks
 
-# Configure pipeline for paired or single end data
-Unpaired = isPaired(glob.glob("data.dir/*fastq*gz"))
+# Pipeline configuration flags, evaluated when first needed (ruffus
+# calls @active_if conditions at run time) and cached
+
+# Layout (paired or single end) of each sample, cohorts can be mixed.
+# Samples are routed to the paired (*.fastq.1.gz) or single end
+# (*.fastq.gz) mapping & quantification tasks by their input files
+@functools.lru_cache()
+def sampleLayouts():
+    return PipelineMrnaseq.fastqLayouts(glob.glob("data.dir/*fastq*gz"))
+
+
+def isPairedBam(bam):
+    '''True if the sample of a BAM file has paired end reads. BAMs
+       without fastq files in data.dir are inspected directly'''
+
+    layout = sampleLayouts().get(PipelineMrnaseq.sampleName(bam))
+
+    if layout is None:
+        # cgat is slow to import, only load it when needed
+        from cgat.BamTools import bamtools as BamTools
+        return bool(BamTools.is_paired(bam))
+
+    return layout == "paired"
+
 
 # and strandedness
-Stranded = bool(PARAMS["strandedness"])
+@functools.lru_cache()
+def Stranded():
+    return bool(PARAMS["strandedness"])
 
 # were reads mapped using CGAT pipelines?
-cgat_mapping = bool(PARAMS["cgat_mapping_bool"])
+@functools.lru_cache()
+def cgat_mapping():
+    return bool(PARAMS["cgat_mapping_bool"])
+
+# and how are their missing sequences & qualities filled in?
+@functools.lru_cache()
+def pseudo_quality():
+    return PARAMS.get("cgat_mapping_pseudo_quality") or "stream"
+
+# map batches of samples against a STAR genome held in shared memory?
+@functools.lru_cache()
+def shared_genome():
+    return bool(PARAMS.get("star_genome_load"))
+
+# only count & load new or changed samples?
+@functools.lru_cache()
+def incremental():
+    return bool(PARAMS.get("incremental"))
+
+# BAM QC metrics from a single pass (bamqc) or picard?
+@functools.lru_cache()
+def picard_qc():
+    return (PARAMS.get("qc_engine") or "bamqc") == "picard"
 
 
 #####################################################
@@ -143,134 +387,165 @@ cgat_mapping = bool(PARAMS["cgat_mapping_bool"])
 #####################################################
 @follows(connect)
 @files(None, "sample_info.txt")
+@instrument
 def makeSampleInfoTable(infile, outfile):
     '''Parse sample names and construct sample info table,
        with "category" column for DESeq2 design'''
-    
-    make_sample_table = True
-    info = {}
 
     files = glob.glob("data.dir/*fastq*gz")
-    
-    if len(files)==0:
-        pass
-    
-    for f in files:
-        sample_id = os.path.basename(f).split(".")[0]
-        attr =  os.path.basename(f).split(".")[0].split("_")
 
-        if len(attr) == 2:
-            cols = ["sample_id", "condition", "replicate"]
+    sample_info = PipelineMrnaseq.sampleInfoTable(files, sampleLayouts())
 
-        elif len(attr) == 3:
-            cols = ["sample_id", "condition", "treatment", "replicate"]
-
-        elif len(attr) == 4:
-            cols = ["sample_id", "group", "condition", "treatment", "replicate"]
-
-        else:
-            make_sample_table = False
-            print("Please reformat sample names according to pipeline documentation")
-
-        if sample_id not in info:
-            info[sample_id] = [sample_id] + attr
-
-    if make_sample_table:
-        sample_info = pd.DataFrame.from_dict(info, orient="index")
-        sample_info.columns = cols
-        sub = [x for x in list(sample_info) if x not in ["sample_id", "index", "replicate"]]
-        sample_info["category"] = sample_info[sub].apply(lambda x: '_'.join(str(y) for y in x), axis=1)
-        sample_info.reset_index(inplace=True, drop=True)
-        
-        con = sqlite3.connect(db)
-        sample_info.to_sql("sample_info", con, if_exists="replace")
+    if sample_info is not None:
+        CsvDB.bulkLoad(database(), "sample_info", [sample_info.reset_index()],
+                       index="sample_id")
 
         sample_info.to_csv(outfile, sep="\t", header=True, index=False)
 
 
 @follows(makeSampleInfoTable, mkdir("star.dir"))
-@active_if(Unpaired==False)
+@active_if(lambda: not shared_genome())
 @transform("data.dir/*.fastq.1.gz",
            regex(r"data.dir/(.*).fastq.1.gz"),
            r"star.dir/\1.bam")
+@instrument
 def starMapping(infile, outfile):
 
-    genomeDir = PARAMS["star_index_dir"]
-
-    tmpdir = PARAMS["tmp_dir"]
-    
-    log_prefix = outfile.rstrip(".bam") + "."
+    threads, memory = PipelineMrnaseq.getResources(
+        PARAMS, "starMapping", "star", threads=12, memory="2G")
 
     read1 = infile
     read2 = read1.replace(".fastq.1.gz", ".fastq.2.gz")
-    
-    statement = f'''tmp=`mktemp -p {tmpdir}` &&
-                    STAR 
-                      --runMode alignReads 
-                      --runThreadN 12 
-                      --genomeDir {genomeDir}
-                      --outSAMstrandField intronMotif 
-                      --outFileNamePrefix {log_prefix}
-                      --outStd SAM 
-                      --outSAMunmapped Within 
-                      --outFilterMismatchNmax 2 
-                      --readFilesIn {read1} {read2}
-                      --readFilesCommand zcat | samtools view -b - 
-                      >  $tmp &&
-                    samtools sort -O BAM  $tmp > {outfile} &&
-                    rm $tmp'''
-
-    P.run(statement, job_threads=12)
 
-    
-@active_if(Unpaired)
+    statement = starStatement(f"{read1} {read2}", outfile, threads)
+
+    run(statement, job_threads=starJobThreads(threads), job_memory=memory)
+
+
+
+@follows(makeSampleInfoTable, mkdir("star.dir"))
+@active_if(lambda: not shared_genome())
 @transform("data.dir/*.fastq.gz",
            regex(r"data.dir/(.*).fastq.gz"),
            r"star.dir/\1.bam")
+@instrument
 def starMapping_SE(infile, outfile):
 
-    genomeDir = PARAMS["star_index_dir"]
+    threads, memory = PipelineMrnaseq.getResources(
+        PARAMS, "starMapping_SE", "star", threads=12, memory="2G")
 
-    tmpdir = PARAMS["tmp_dir"]
+    statement = starStatement(infile, outfile, threads)
 
-    log_prefix = outfile.rstrip(".bam") + "."
-    
-    statement = f'''tmp=`mktemp -p {tmpdir}` &&
-                    STAR 
-                      --runMode alignReads 
-                      --runThreadN 12 
-                      --genomeDir {genomeDir}
-                      --outSAMstrandField intronMotif 
-                      --outFileNamePrefix {log_prefix}
-                      --outStd SAM 
-                      --outSAMunmapped Within 
-                      --outFilterMismatchNmax 2 
-                      --readFilesIn {infile} 
-                      --readFilesCommand zcat | samtools view -b - 
-                      >  $tmp &&
-                    samtools sort -O BAM  $tmp > {outfile} &&
-                    rm $tmp''' 
-
-    P.run(statement, job_threads=12)
-    
+    run(statement, job_threads=starJobThreads(threads), job_memory=memory)
+
+
+@follows(makeSampleInfoTable, mkdir("star.dir"))
+@active_if(shared_genome)
+@merge(["data.dir/*.fastq.1.gz", "data.dir/*.fastq.gz"],
+       "star.dir/star_batches.tsv")
+@instrument
+def starMappingShared(infiles, outfile):
+    '''Map samples in batches of star_batch_size, each batch running as
+       one job that loads the STAR genome into shared memory once.
+       Batches run in parallel, samples with an up to date BAM are skipped'''
+
+    batch_size = int(PARAMS.get("star_batch_size") or 8)
+
+    threads, memory = PipelineMrnaseq.getResources(
+        PARAMS, "starMappingShared", "star", threads=12, memory="2G")
+
+    samples, present = [], set()
+    for infile in sorted(infiles):
+        if infile.endswith(".fastq.1.gz"):
+            sample = os.path.basename(infile)[:-len(".fastq.1.gz")]
+            reads = [infile, infile.replace(".fastq.1.gz", ".fastq.2.gz")]
+        else:
+            sample = os.path.basename(infile)[:-len(".fastq.gz")]
+            reads = [infile]
 
-@follows(starMapping, starMapping_SE)
+        present.add(sample)
+
+        bam = f"star.dir/{sample}.bam"
+        if os.path.exists(bam) and \
+           os.path.getmtime(bam) > max(os.path.getmtime(x) for x in reads):
+            continue
+
+        samples.append((sample, " ".join(reads), bam))
+
+    batches = [samples[i:i + batch_size]
+               for i in range(0, len(samples), batch_size)]
+
+    statements = [starBatchStatement([(reads, bam) for sample, reads, bam in batch],
+                                     n, threads)
+                  for n, batch in enumerate(batches)]
+
+    if statements:
+        run(statements, job_threads=starJobThreads(threads), job_memory=memory)
+
+    # keep the batches of samples mapped in earlier runs, numbering
+    # this run's batches after them
+    if os.path.exists(outfile):
+        table = pd.read_csv(outfile, sep="\t", dtype={"sample_id": str})
+    else:
+        table = pd.DataFrame(columns=["sample_id", "batch"])
+
+    mapped = set(sample for batch in batches for sample, reads, bam in batch)
+    table = table[table["sample_id"].isin(present) & ~table["sample_id"].isin(mapped)]
+
+    first = int(table["batch"].max()) + 1 if len(table) else 0
+    new = pd.DataFrame([(sample, first + n)
+                        for n, batch in enumerate(batches)
+                        for sample, reads, bam in batch],
+                       columns=["sample_id", "batch"])
+
+    table = pd.concat([table, new]).sort_values("sample_id")
+    table.to_csv(outfile, sep="\t", index=False)
+
+
+def bamIndexUptodate(infile, outfile):
+    '''ruffus up to date check, BAMs are only (re)indexed if their
+       index is missing, older than the BAM or can't be read'''
+
+    if PipelineMrnaseq.indexIsCurrent(infile, outfile):
+        return False, "index is current"
+
+    return True, "index missing, out of date or invalid"
+
+
+def indexStatement(infile, outfile):
+    '''Build multi-threaded samtools index statement, and return it
+       with the threads & memory for the job'''
+
+    threads, memory = PipelineMrnaseq.getResources(
+        PARAMS, "indexBam", "samtools", threads=4, memory="1G")
+
+    statement = f'''samtools index -@ {threads} -b {infile} {outfile}'''
+
+    return statement, threads, memory
+
+
+@follows(starMapping, starMapping_SE, starMappingShared)
+@check_if_uptodate(bamIndexUptodate)
 @transform("star.dir/*.bam", suffix(r".bam"), r".bam.bai")
+@instrument
 def indexBam(infile, outfile):
 
-    statement = f'''samtools index -b {infile} {outfile}'''
+    statement, threads, memory = indexStatement(infile, outfile)
 
-    P.run(statement)
+    run(statement, job_threads=threads, job_memory=memory)
 
     
 @follows(indexBam, mkdir("bam.dir"))
 @transform("star.dir/*.bam",
            regex(r"star.dir/(.*).bam"),
            r"bam.dir/\1.bam")
+@instrument
 def addPseudoSequenceQuality(infile, outfile):
     '''to allow multiQC to pick up the picard metric files
     sequence quality needs to be added if it is stripped.
-    Therefore an intermediate sam file needs to be generated
+    By default (cgat_mapping_pseudo_quality: stream) BAMs are only
+    symlinked and placeholder qualities added on the fly when picard
+    reads them, otherwise a fixed copy is written to bam.dir
     Arguments
     ---------
     infile : string
@@ -281,7 +556,7 @@ def addPseudoSequenceQuality(infile, outfile):
 
     log = outfile.replace(".bam", ".bam2bam.log")
     
-    if cgat_mapping:
+    if cgat_mapping() and pseudo_quality() == "bam2bam":
         venv = PARAMS["cgat_mapping_venv"]
         
         statement = f'''cat {infile} | 
@@ -291,14 +566,30 @@ def addPseudoSequenceQuality(infile, outfile):
                             --log={log}
                             > {outfile}'''
         
-        P.run(statement, job_condaenv=venv)
+        run(statement, job_condaenv=venv)
 
         statement = f'''samtools index {outfile}'''
 
-        P.run(statement)
+        run(statement)
+
+    elif cgat_mapping() and pseudo_quality() == "rewrite":
+        # placeholder qualities added in a single multi-threaded pass
+        srcdir = os.path.dirname(os.path.abspath(__file__))
+        threads = PipelineMrnaseq.resolveThreads(
+            PARAMS, PARAMS.get("cgat_mapping_threads") or 4)
+
+        statement = f'''python {srcdir}/PseudoQuality.py {infile}
+                          --output {outfile}
+                          --threads {threads}
+                          2> {log} &&
+                        samtools index -@ {threads} {outfile}'''
+
+        run(statement, job_threads=threads)
 
     else:
-        # if CGAT pipelines not used symlink data into new dir
+        # if CGAT pipelines not used symlink data into new dir. CGAT
+        # mapped BAMs are streamed through PseudoQuality.py to picard
+        # (see picardInput), so no second copy is written
         in_index = infile.replace(".bam", ".bam.bai")
         out_index = outfile.replace(".bam", ".bam.bai")
 
@@ -306,114 +597,312 @@ def addPseudoSequenceQuality(infile, outfile):
                         ln -s $dir/{infile} {outfile} &&
                         ln -s $dir/{in_index} {out_index}'''
 
-        P.run(statement)
+        run(statement)
     
 
-@follows(indexBam, addPseudoSequenceQuality)
+@follows(addPseudoSequenceQuality)
+@check_if_uptodate(bamIndexUptodate)
+@transform("bam.dir/*.bam", suffix(r".bam"), r".bam.bai")
+@instrument
+def indexInputBam(infile, outfile):
+    '''Check indexes of all BAMs in bam.dir, including BAMs placed there
+       directly as input, and (re)index those missing or invalid'''
+
+    statement, threads, memory = indexStatement(infile, outfile)
+
+    # replace a stale symlinked index rather than write through it
+    if os.path.islink(outfile):
+        os.unlink(outfile)
+
+    run(statement, job_threads=threads, job_memory=memory)
+
+
+@follows(indexBam, addPseudoSequenceQuality, indexInputBam)
 def mapping():
     pass
+
+
+#####################################################
+############## Annotation cache #####################
+#####################################################
+def annotationCacheUptodate(infile, outfile):
+    '''ruffus up to date check, cache is rebuilt when the
+       annotation files it was derived from change'''
+
+    if PipelineMrnaseq.annotationCacheIsCurrent(PARAMS, outfile):
+        return False, "annotation cache is current"
+
+    return True, "annotation cache missing or out of date"
+
+
+@check_if_uptodate(annotationCacheUptodate)
+@files(None, "annotation_cache.tsv")
+@instrument
+def annotationCache(infile, outfile):
+    '''Decompress the ensembl geneset & refFlat and derive a transcript
+       to gene map once per annotation release. Entries are keyed on the
+       checksum of the source file and shared across runs & projects'''
+
+    with open(outfile, "w") as outf:
+        outf.write("name\tsource\tpath\n")
+
+        for name, source, builder in PipelineMrnaseq.cachedAnnotations(PARAMS):
+            outf.write(f"{name}\t{source}\t{builder(PARAMS)}\n")
     
 #####################################################
 ################## Raw counts #######################
 #####################################################
-@follows(mapping, mkdir("read_counts.dir"))
-@merge("bam.dir/*.bam", "read_counts.dir/featureCounts.txt")
-def featureCount(infiles, outfile):
-    '''Count reads falling in ensembl genes (including introns)'''
-
-    gtf = os.path.join(PARAMS["annotations_dir"], PARAMS["annotations_ensembl_geneset"])
+def featureCountsStatement(bams, table, threads, paired):
+    '''Build featureCounts statement counting reads in bams, all of the
+       same layout, into table'''
 
-    bams = ' '.join(infiles)    
-    tmp_dir = PARAMS["tmp_dir"]
-  
-    threads = len(infiles)
+    gtf = PipelineMrnaseq.getCachedGtf(PARAMS)
 
-    if Unpaired==False:
+    if paired:
         pair_opts = "-p"
     else:
         pair_opts = " "
     
     # get strandedness for featureCounts
-    if PARAMS["strandedness"] == ("RF" or "R"):
+    if PARAMS["strandedness"] in ("RF", "R"):
         strand = "2"
-    elif PARAMS["strandedness"] == ("FR" or "F"):
+    elif PARAMS["strandedness"] in ("FR", "F"):
         strand = "1"
     else:
         strand = "0"
 
-    statement = f'''tmp=`mktemp -p {tmp_dir}` &&
-                    gtf=`mktemp -p {tmp_dir}` &&
-                    zcat {gtf} > $gtf &&
-                    featureCounts
+    bams = ' '.join(bams)
+
+    statement = f'''featureCounts
                       -T {threads}
                       -s {strand}
                       -Q 255
                       -t exon
                       -g gene_id
                       {pair_opts}
-                      -a $gtf
-                      -o $tmp
-                      {bams} &&
-                    sed 's/bam.dir\///g' $tmp | 
-                    sed 's/.bam//g' - > {outfile} &&
-                    rm $tmp $gtf'''
-    
-    P.run(statement, job_threads=threads)
+                      -a {gtf}
+                      -o {table}
+                      {bams}'''
+
+    return statement
+
+
+@active_if(incremental)
+@follows(mapping, annotationCache, mkdir("read_counts.dir/samples"))
+@transform("bam.dir/*.bam",
+           regex(r"bam.dir/(.*).bam"),
+           r"read_counts.dir/samples/\1.counts.txt")
+@instrument
+def featureCountSample(infile, outfile):
+    '''Count reads in genes for a single sample, so that in incremental
+       mode only new or changed BAMs are counted'''
+
+    threads, memory = PipelineMrnaseq.getResources(
+        PARAMS, "featureCountSample", "featurecounts", threads=4, memory="4G")
+
+    statement = featureCountsStatement([infile], outfile, threads,
+                                       isPairedBam(infile))
+
+    run(statement, job_threads=threads, job_memory=memory)
+
+
+# the per-sample counts (incremental mode only) are inputs too, so
+# that recounting a sample brings the merged table out of date
+@follows(mapping, annotationCache, featureCountSample, mkdir("read_counts.dir"))
+@merge(["bam.dir/*.bam", "read_counts.dir/samples/*.counts.txt"],
+       "read_counts.dir/featureCounts.txt")
+@instrument
+def featureCount(infiles, outfile):
+    '''Count reads falling in ensembl genes (including introns).
+       BAMs are grouped by layout (paired or single end) and counted
+       in batches of featurecounts_batch_size, each batch a separate
+       job with a bounded number of threads, all running concurrently.
+       The per-batch count tables are merged into a single table.
+       In incremental mode per-sample counts of new or changed BAMs
+       are spliced into the existing table instead'''
+
+    infiles = sorted(x for x in infiles if x.endswith(".bam"))
+
+    if incremental():
+        # counts of BAMs that were removed are left out
+        tables = ["read_counts.dir/samples/%s.counts.txt" % PipelineMrnaseq.sampleName(x)
+                  for x in infiles]
+        PipelineMrnaseq.spliceFeatureCounts(tables, outfile)
+        return
+
+    threads, memory = PipelineMrnaseq.getResources(
+        PARAMS, "featureCount", "featurecounts", threads=4, memory="4G")
+
+    batch_size = int(PARAMS.get("featurecounts_batch_size") or 24)
+
+    layouts = {True: [], False: []}
+    for infile in infiles:
+        layouts[isPairedBam(infile)].append(infile)
+
+    batches = [(bams[i:i + batch_size], paired)
+               for paired, bams in layouts.items()
+               for i in range(0, len(bams), batch_size)]
+
+    batch_tables = [outfile.replace(".txt", f".batch{n}.txt")
+                    for n in range(len(batches))]
+
+    statements = [featureCountsStatement(bams, table, threads, paired)
+                  for (bams, paired), table in zip(batches, batch_tables)]
+
+    run(statements, job_threads=threads, job_memory=memory)
+
+    PipelineMrnaseq.mergeFeatureCounts(batch_tables, outfile)
+
+    for table in batch_tables:
+        os.unlink(table)
+        os.unlink(table + ".summary")
 
     
 @transform(featureCount, suffix(r".txt"), r".load")
+@instrument
 def loadFeatureCount(infile, outfile):
-    P.load(infile, outfile)
+    '''Load featureCounts table, in incremental mode only columns of
+       new or changed samples are updated'''
+
+    if incremental() and os.path.exists(outfile):
+        matrix = PipelineMrnaseq.readFeatureCounts(infile)
+        changed = [x for x in PipelineMrnaseq.featureCountsSamples(infile)
+                   if PipelineMrnaseq.modifiedSince(
+                       f"read_counts.dir/samples/{x}.counts.txt", outfile)]
+
+        if PipelineMrnaseq.upsertColumns(database(), P.to_table(outfile), matrix,
+                                         "Geneid", changed):
+            with open(outfile, "w") as outf:
+                outf.write("updated %i samples\n" % len(changed))
+            return
+
+    nrows = CsvDB.loadTable(database(), infile, P.to_table(outfile), index="Geneid")
+
+    with open(outfile, "w") as outf:
+        outf.write("loaded %i rows\n" % nrows)
     
 
+@follows(mkdir("matrix.dir"))
+@transform(featureCount,
+           regex(r"read_counts.dir/(.*).txt"),
+           r"matrix.dir/\1/values.npy")
+@instrument
+def featureCountMatrix(infile, outfile):
+    '''Write read counts to the columnar matrix store'''
+
+    counts = PipelineMrnaseq.readFeatureCounts(infile)
+    counts = counts.drop(PipelineMrnaseq.FEATURECOUNTS_ANNOTATION, axis=1)
+
+    MatrixStore.writeMatrix(counts, os.path.dirname(outfile))
+
+
 #@follows(loadCountTables, loadFeatureCount)
-@follows(loadFeatureCount)
+@follows(loadFeatureCount, featureCountMatrix)
 def readcounts():
     pass
 
 #####################################################
 ################# Picard Stats  #####################
 #####################################################
+def picardInput(infile):
+    '''Return a pipe to prefix a picard command with, the input for
+       picard and a check to follow the picard command with "&&".
+       Symlinked CGAT mapped BAMs are streamed through PseudoQuality.py,
+       which fills in stripped sequences & qualities, the check fails the
+       job if PseudoQuality.py does, as the status of a pipe is that of
+       its last command'''
+
+    if cgat_mapping() and pseudo_quality() == "stream":
+        srcdir = os.path.dirname(os.path.abspath(__file__))
+        return (f"python {srcdir}/PseudoQuality.py {infile} | ", "/dev/stdin",
+                '[ "${PIPESTATUS[0]}" -eq 0 ] && ')
+
+    return "", infile, ""
+
+
+@follows(mapping, annotationCache)
+@active_if(lambda: not picard_qc())
+@subdivide("bam.dir/*.bam",
+           regex(r"(.*).bam"),
+           [r"\1.picardAlignmentStats.txt",
+            r"\1.picardRNAseqMetrics.txt",
+            r"\1.picardRNAseqMetrics.hist.txt"])
+@instrument
+def bamQC(infile, outfiles):
+    '''Alignment summary & RNA-seq metrics from a single pass over
+       each BAM, written as the tables of the picard tasks below'''
+
+    alignment, metrics, hist = outfiles
+
+    srcdir = os.path.dirname(os.path.abspath(__file__))
+    refFlat = PipelineMrnaseq.getCachedRefFlat(PARAMS)
+    strandedness = PARAMS["strandedness"] or "none"
+
+    threads, memory = PipelineMrnaseq.getResources(
+        PARAMS, "bamQC", "qc", threads=1, memory="4G")
+
+    statement = f'''python {srcdir}/BamQC.py
+                      --refflat {refFlat}
+                      --strandedness {strandedness}
+                      --alignment-stats {alignment}
+                      --rnaseq-metrics {metrics}
+                      --coverage-histogram {hist}
+                      {infile}'''
+
+    run(statement, job_threads=threads, job_memory=memory)
+
+
 @follows(mapping)
+@active_if(picard_qc)
 @transform("bam.dir/*.bam",
            regex(r"(.*).bam"),
            r"\1.picardAlignmentStats.txt")
+@instrument
 def picardAlignmentSummary(infile, outfile):
     '''get alignment summary stats with picard for filtered bams'''
 
     tmp_dir = PARAMS["tmp_dir"]
     refSeq = os.path.join(PARAMS["genome_dir"], PARAMS["genome"] + ".fa")
 
-    mem = "12G"
+    threads, mem = PipelineMrnaseq.getResources(
+        PARAMS, "picardAlignmentSummary", "picard", threads=3, memory="12G")
     
+    pipe, bam, check = picardInput(infile)
+
     statement = f'''tmp=`mktemp -p {tmp_dir}` &&
-                    picard -Xmx{mem}
+                    {pipe}picard -Xmx{mem}
                     CollectAlignmentSummaryMetrics
                       R={refSeq}
-                      I={infile}
+                      I={bam}
                       O=$tmp &&
-                    cat $tmp | grep -v "#" > {outfile}'''
+                    {check}cat $tmp | grep -v "#" > {outfile}'''
 
-    P.run(statement, job_threads=3, job_memory=mem)
+    run(statement, job_threads=threads, job_memory=mem)
 
     
-@merge(picardAlignmentSummary,
+@follows(picardAlignmentSummary, bamQC)
+@merge("bam.dir/*.picardAlignmentStats.txt",
        "picardAlignmentSummary.load")
+@instrument
 def loadpicardAlignmentSummary(infiles, outfile):
     '''load the complexity metrics to a single table in the db'''
 
-    P.concatenate_and_load(infiles, outfile,
-                         regex_filename="(.*).picardAlignmentStats",
-                         cat="sample_id",
-                         options='-i "sample_id"')
+    nrows = CsvDB.concatenateAndLoad(database(), infiles, P.to_table(outfile),
+                                     regex_filename="(.*).picardAlignmentStats",
+                                     cat="sample_id",
+                                     index="sample_id")
+
+    with open(outfile, "w") as outf:
+        outf.write("loaded %i rows\n" % nrows)
 
     
-@active_if(Stranded==True)
-@follows(mapping)
+@active_if(lambda: picard_qc() and Stranded())
+@follows(mapping, annotationCache)
 @subdivide("bam.dir/*.bam",
            regex(r"(.*).bam"),
            [r"\1.picardRNAseqMetrics.txt",
              r"\1.picardRNAseqMetrics.hist.txt"])
+@instrument
 def picardRNAseqMetrics(infile, outfiles):
     '''Run picard RNAseq metrics for stranded libraries.
        Split output into tables for database upload'''
@@ -423,43 +912,51 @@ def picardRNAseqMetrics(infile, outfiles):
     tmp_dir = PARAMS["tmp_dir"]
     refSeq = os.path.join(PARAMS["genome_dir"], PARAMS["genome"] + ".fa")
 
-    mem = "12G"
+    threads, mem = PipelineMrnaseq.getResources(
+        PARAMS, "picardRNAseqMetrics", "picard", threads=3, memory="12G")
 
-    refFlat = PARAMS["ref_flat"]
+    refFlat = PipelineMrnaseq.getCachedRefFlat(PARAMS)
 
     # convert strandedness to PICARD library type
-    if PARAMS["strandedness"] == ("RF" or "R"):
+    if PARAMS["strandedness"] in ("RF", "R"):
         strand = "SECOND_READ_TRANSCRIPTION_STRAND"
-    elif PARAMS["strandedness"] == ("FR" or "F"):
+    elif PARAMS["strandedness"] in ("FR", "F"):
         strand = "FIRST_READ_TRANSCRIPTION_STRAND"
     else:
         strand = "NONE"
         
+    pipe, bam, check = picardInput(infile)
+
     statement = f'''picard_out=`mktemp -p {tmp_dir}` &&
-                    picard -Xmx{mem}
+                    {pipe}picard -Xmx{mem}
                     CollectRnaSeqMetrics
                       REF_FLAT={refFlat}
-                      INPUT={infile}
+                      INPUT={bam}
                       OUTPUT=$picard_out
                       STRAND={strand} &&
-                    grep -v "#" $picard_out |
+                    {check}grep -v "#" $picard_out |
                       grep  "[a-z,A-Z,0-9]" - | head -n2 > {table} &&
                     grep -v "#" $picard_out |
                       sed -n '/normalized_position/,/^[[:blank:]]/p' - > {hist} &&
                     rm $picard_out'''
     
-    P.run(statement, job_threads=3, job_memory=mem)
+    run(statement, job_threads=threads, job_memory=mem)
 
     
+@follows(picardRNAseqMetrics, bamQC)
 @merge("bam.dir/*.picardRNAseqMetrics.txt",
        "picardRNAseqMetrics.load")
+@instrument
 def loadPicardRNAseqMetrics(infiles, outfile):
     '''load picardRNAseqMetrics'''
 
-    P.concatenate_and_load(infiles, outfile,
-                         regex_filename="(.*).picardRNAseqMetrics",
-                         cat="sample_id",
-                         options='-i "sample_id"')
+    nrows = CsvDB.concatenateAndLoad(database(), infiles, P.to_table(outfile),
+                                     regex_filename="(.*).picardRNAseqMetrics",
+                                     cat="sample_id",
+                                     index="sample_id")
+
+    with open(outfile, "w") as outf:
+        outf.write("loaded %i rows\n" % nrows)
 
        
 @follows(loadpicardAlignmentSummary, loadPicardRNAseqMetrics)
@@ -470,17 +967,18 @@ def summarystats():
 ############### TPMs with Salmon ####################
 #####################################################
 @follows(mkdir("salmon.dir"))
-@active_if(Unpaired==False)
 @transform("data.dir/*fastq.1.gz",
            regex(r"data.dir/(.*).fastq.1.gz"),
            r"salmon.dir/\1.log")
+@instrument
 def salmon(infile, outfile):
     '''Per sample quantification using salmon'''
 
     outname = outfile[:-len(".log")]
     salmon_index = PARAMS["salmon_index"] # get salmon quasi-mapping index here
     library_type = PARAMS["salmon_libtype"]
-    threads = 8
+    threads, memory = PipelineMrnaseq.getResources(
+        PARAMS, "salmon", "salmon", threads=8, memory="4G")
 
     read1 = infile
     read2 = read1.replace(".fastq.1.gz", ".fastq.2.gz")
@@ -503,20 +1001,21 @@ def salmon(infile, outfile):
 
     statement = ' '.join(statement)
 
-    P.run(statement, job_threads=threads)
+    run(statement, job_threads=threads, job_memory=memory)
 
 
-@active_if(Unpaired)
 @transform("data.dir/*fastq.gz",
            regex(r"data.dir/(.*).fastq.gz"),
            r"salmon.dir/\1.log")
+@instrument
 def salmon_SE(infile, outfile):
     '''Per sample quantification using salmon'''
 
     outname = outfile.replace(".log", "")
     salmon_index = PARAMS["salmon_index"] # get salmon quasi-mapping index here
     library_type = PARAMS["salmon_libtype"]
-    threads = 8
+    threads, memory = PipelineMrnaseq.getResources(
+        PARAMS, "salmon_SE", "salmon", threads=8, memory="4G")
 
     version = PARAMS["salmon_version"]
 
@@ -535,140 +1034,600 @@ def salmon_SE(infile, outfile):
 
     statement = ' '.join(statement)
 
-    P.run(statement, job_threads=threads)
+    run(statement, job_threads=threads, job_memory=memory)
 
     
 @follows(salmon, salmon_SE)
 @merge("salmon.dir/*log", "salmon.dir/salmon.load")
+@instrument
 def loadSalmon(infiles, outfile):
     '''load the salmon results'''
 
     tables = [x.replace(".log", "/quant.sf") for x in infiles]
 
-    P.concatenate_and_load(tables, outfile,
-                         regex_filename=".*/(.*)/quant.sf",
-                         cat="sample_id",
-                         options="-i Name",
-                         job_memory=PARAMS["sql_himem"])
+    if incremental() and os.path.exists(outfile):
+        frames = {os.path.basename(os.path.dirname(x)): pd.read_csv(x, sep="\t")
+                  for x in tables if PipelineMrnaseq.modifiedSince(x, outfile)}
+        samples = [os.path.basename(os.path.dirname(x)) for x in tables]
 
-    
-@files(loadSalmon,
-       "salmon.dir/salmon_genes.txt")
-def salmonGeneTable(infile, outfile):
-    '''Prepare a per-gene tpm table'''
+        if PipelineMrnaseq.upsertRows(database(), P.to_table(outfile), frames, samples):
+            with open(outfile, "w") as outf:
+                outf.write("updated %i samples\n" % len(frames))
+            return
+
+    nrows = CsvDB.concatenateAndLoad(database(), tables, P.to_table(outfile),
+                                     regex_filename=".*/(.*)/quant.sf",
+                                     cat="sample_id",
+                                     index=["Name", "sample_id"])
 
-    table = P.to_table(infile)
+    with open(outfile, "w") as outf:
+        outf.write("loaded %i rows\n" % nrows)
 
-    anndb = PARAMS["annotations_database"]
-    anndb_table = PARAMS["annotations_dbtable"]
     
-    attach = f'''attach "{anndb}" as anndb'''
-    con = sqlite3.connect(db)
-    c = con.cursor()
-    c.execute(attach)
+@follows(annotationCache, salmon, salmon_SE)
+@merge("salmon.dir/*.log",
+       ["salmon.dir/salmon_genes.txt",
+        "salmon.dir/salmon_genes_numreads.txt"])
+@instrument
+def salmonGeneTable(infiles, outfiles):
+    '''Prepare per-gene tpm & read count tables. quant.sf files are
+       streamed and summed over genes with the cached transcript to
+       gene map. In incremental mode only new or changed samples are
+       summed & spliced into the tables'''
+
+    tpm, numreads = outfiles
+
+    quants = {x[:-len(".log")].split("/")[-1]: x.replace(".log", "/quant.sf")
+              for x in sorted(infiles)}
+
+    if incremental():
+        changed = {sample: quant for sample, quant in quants.items()
+                   if PipelineMrnaseq.modifiedSince(quant, tpm)}
+    else:
+        changed = quants
 
-    sql = f'''select sample_id, gene_id, sum(TPM) tpm
-             from {table} t
-             inner join anndb.{anndb_table} i
-             on t.Name=i.transcript_id
-             group by gene_id, sample_id'''
+    tx2gene = PipelineMrnaseq.loadTranscriptGeneMap(PARAMS)
+    matrices = PipelineMrnaseq.aggregateSalmon(changed, tx2gene)
 
-    df = pd.read_sql(sql, con)
-    df = df.pivot("gene_id", "sample_id", "tpm")
-    df.to_csv(outfile, sep="\t", index=True, index_label="gene_id")
+    for outfile, column in ((tpm, "TPM"), (numreads, "NumReads")):
+        if incremental():
+            PipelineMrnaseq.spliceMatrix(outfile, dict(matrices[column].items()),
+                                         list(quants), "gene_id")
+        else:
+            matrices[column].to_csv(outfile, sep="\t", index=True,
+                                    index_label="gene_id")
 
     
-@transform(salmonGeneTable,
-           suffix(".txt"),
-           ".load")
-def loadSalmonGeneTable(infile, outfile):
+@merge(salmonGeneTable, "salmon.dir/salmon_genes.load")
+@instrument
+def loadSalmonGeneTable(infiles, outfile):
+    '''Load per-gene tpm & read count tables, in incremental mode
+       only columns of new or changed samples are updated'''
 
-    P.load(infile, outfile, options='-i "gene_id"')
+    infiles = flattenInputs(infiles)
+
+    for infile in infiles:
+        load = infile.replace(".txt", ".load")
+
+        if incremental() and os.path.exists(load):
+            matrix = pd.read_csv(infile, sep="\t", index_col=0)
+            changed = [x for x in matrix.columns
+                       if PipelineMrnaseq.modifiedSince(f"salmon.dir/{x}/quant.sf", load)]
+
+            if PipelineMrnaseq.upsertColumns(database(), P.to_table(load), matrix,
+                                             "gene_id", changed):
+                with open(load, "w") as outf:
+                    outf.write("updated %i samples\n" % len(changed))
+                continue
+
+        nrows = CsvDB.loadTable(database(), infile, P.to_table(load), index="gene_id")
+
+        with open(load, "w") as outf:
+            outf.write("loaded %i rows\n" % nrows)
 
     
-@follows(loadSalmonGeneTable)
+@follows(mkdir("matrix.dir"))
+@merge(salmonGeneTable,
+       ["matrix.dir/salmon_genes/values.npy",
+        "matrix.dir/salmon_genes_numreads/values.npy"])
+@instrument
+def salmonGeneMatrix(infiles, outfiles):
+    '''Write per-gene tpm & read count tables to the columnar matrix store'''
+
+    infiles = flattenInputs(infiles)
+
+    for infile, outfile in zip(infiles, outfiles):
+        matrix = pd.read_csv(infile, sep="\t", index_col=0)
+        MatrixStore.writeMatrix(matrix, os.path.dirname(outfile))
+
+
+@follows(salmon, salmon_SE, mkdir("matrix.dir"))
+@merge("salmon.dir/*.log", "matrix.dir/salmon_transcripts/values.npy")
+@instrument
+def salmonTranscriptMatrix(infiles, outfile):
+    '''Write per-transcript tpms to the columnar matrix store'''
+
+    quants = {x[:-len(".log")].split("/")[-1]: x.replace(".log", "/quant.sf")
+              for x in sorted(infiles)}
+
+    matrix = PipelineMrnaseq.salmonTranscriptTable(quants)
+    MatrixStore.writeMatrix(matrix, os.path.dirname(outfile))
+
+
+@follows(mkdir("correlation.dir"))
+@merge(salmonGeneMatrix, "correlation.dir/sample_correlations.tsv")
+@instrument
+def sampleCorrelation(infiles, outfile):
+    '''Pearson & Spearman correlations and Manhattan distances between
+       samples, of upper quartile normalised log2 TPMs of protein coding
+       genes, for all and the top genes. Results are cached by checksum
+       of the matrix, so are only recomputed when TPMs change'''
+
+    srcdir = os.path.dirname(os.path.abspath(__file__))
+
+    threads, memory = PipelineMrnaseq.getResources(
+        PARAMS, "sampleCorrelation", "correlation", threads=4, memory="4G")
+
+    top = PARAMS.get("correlation_top") or 5000
+
+    statement = f'''python {srcdir}/SampleCorrelation.py
+                      --annotations-db {PARAMS["annotations_database"]}
+                      --top {top}
+                      --threads {threads}
+                      --cache-dir correlation.dir/cache
+                      matrix.dir/salmon_genes {outfile}'''
+
+    run(statement, job_threads=threads, job_memory=memory)
+
+
+@transform(sampleCorrelation, suffix(r".tsv"), r".load")
+@instrument
+def loadSampleCorrelation(infile, outfile):
+    '''Load sample correlations & distances, read by the report heatmaps'''
+
+    nrows = CsvDB.loadTable(database(), infile, P.to_table(outfile),
+                            index=["method", "genes"])
+
+    with open(outfile, "w") as outf:
+        outf.write("loaded %i rows\n" % nrows)
+
+
+@follows(loadSalmonGeneTable, salmonGeneMatrix, salmonTranscriptMatrix,
+         loadSampleCorrelation)
 def readquant():
     pass
 
 #####################################################
 ############### DeepTools Coverage ##################
 #####################################################
+def strandCoverage():
+    '''Are plus & minus strand tracks made with the coverage? Only the
+       built in engine makes them, for stranded libraries'''
+
+    engine = PARAMS.get("deeptools_engine") or "builtin"
+    norm_method = str(PARAMS["deeptools_norm_method"])
+
+    return Stranded() and engine == "builtin" and \
+        norm_method in ("BPM", "CPM", "RPKM", "None")
+
+
+def bamCoverageUptodate(infile, outfiles):
+    '''ruffus up to date check, the strand tracks are only expected
+       when strandCoverage() makes them'''
+
+    expected = outfiles if strandCoverage() else outfiles[:1]
+
+    for outfile in expected:
+        if not os.path.exists(outfile) or \
+           os.path.getmtime(outfile) < os.path.getmtime(infile):
+            return True, f"{outfile} missing or out of date"
+
+    return False, "coverage is current"
+
+
 @follows(mapping)
+@check_if_uptodate(bamCoverageUptodate)
 @transform("star.dir/*.bam",
            regex(r"star.dir/(.*).bam"),
-           r"star.dir/\1.coverage.bw")
-def bamCoverageRNA(infile, outfile):
-    '''Make normalised bigwig tracks with deeptools'''
-
-    norm_method = PARAMS["deeptools_norm_method"]
+           [r"star.dir/\1.coverage.bw",
+            r"star.dir/\1.coverage.plus.bw",
+            r"star.dir/\1.coverage.minus.bw"])
+@instrument
+def bamCoverageRNA(infile, outfiles):
+    '''Make normalised bigwig tracks, with the built in coverage engine
+       (BamCoverage.py, chromosomes counted in parallel) or deeptools.
+       For stranded libraries the built in engine also writes plus &
+       minus strand tracks (*.coverage.plus.bw, *.coverage.minus.bw)
+       from the same pass over the BAM'''
+
+    outfile, plus, minus = outfiles
+
+    norm_method = str(PARAMS["deeptools_norm_method"])
+    engine = PARAMS.get("deeptools_engine") or "builtin"
+
+    threads, memory = PipelineMrnaseq.getResources(
+        PARAMS, "bamCoverageRNA", "deeptools", threads=10, memory="2G")
     
     # STAR MAPQ of 255 indicates uniquely mapped read
     
-    if len(infile) > 0:
-        if BamTools.is_paired(infile):
-            statement = f'''bamCoverage -b {infile} -o {outfile}
-                              --binSize 5
-                              --normalizeUsing {norm_method}
-                              --samFlagInclude 64
-                              --centerReads
-                              --minMappingQuality 255
-                              --smoothLength 10
-                              --skipNAs
-                              -p "max" '''
-                
-        else:
-            statement = f'''bamCoverage -b {infile} -o {outfile}
-                              --binSize 5
-                              --normalizeUsing {norm_method}
-                              --minMappingQuality 255
-                              --smoothLength 10
-                              --samFlagExclude 4
-                              --centerReads
-                              -p "max" '''
+    paired = isPairedBam(infile)
+
+    # RPGC needs an effective genome size, only deeptools does it
+    if engine == "builtin" and norm_method in ("BPM", "CPM", "RPKM", "None"):
+        srcdir = os.path.dirname(os.path.abspath(__file__))
+
+        # count first reads of pairs only, as --samFlagInclude 64
+        flags = "--flag-include 64" if paired else "--flag-exclude 4"
+
+        if strandCoverage():
+            flags = flags + f''' --strandedness {PARAMS["strandedness"]}
+                                --plus {plus}
+                                --minus {minus}'''
+
+        statement = f'''python {srcdir}/BamCoverage.py
+                          --bin-size 5
+                          --smooth-length 10
+                          --normalize-using {norm_method}
+                          --min-mapq 255
+                          {flags}
+                          --threads {threads}
+                          {infile} {outfile}'''
+
+    elif paired:
+        statement = f'''bamCoverage -b {infile} -o {outfile}
+                          --binSize 5
+                          --normalizeUsing {norm_method}
+                          --samFlagInclude 64
+                          --centerReads
+                          --minMappingQuality 255
+                          --smoothLength 10
+                          --skipNAs
+                          -p {threads} '''
+            
+    else:
+        statement = f'''bamCoverage -b {infile} -o {outfile}
+                          --binSize 5
+                          --normalizeUsing {norm_method}
+                          --minMappingQuality 255
+                          --smoothLength 10
+                          --samFlagExclude 4
+                          --centerReads
+                          -p {threads} '''
 
-        P.run(statement, job_memory="2G", job_threads=10)
+    run(statement, job_memory=memory, job_threads=threads)
 
 @follows(bamCoverageRNA)
 def coverage():
     pass
 
+#####################################################
+###################### DESeq2 #######################
+#####################################################
+def readContrast(infile):
+    '''Return (factor, a, b) of a contrast file'''
+
+    with open(infile) as inf:
+        factor, a, b = inf.read().rstrip("\n").split("\t")
+
+    return factor, a, b
+
+
+def contrastFiles(infile):
+    '''Return dict of contrast file: contents for the DESeq2 contrasts
+       of sample info table infile and the configuration'''
+
+    sample_info = pd.read_csv(infile, sep="\t", dtype=str)
+
+    contrasts = PipelineMrnaseq.deseq2Contrasts(sample_info["category"],
+                                                PARAMS.get("report_comparisons"))
+
+    factor = PARAMS.get("deseq2_factor") or "category"
+
+    return {f"deseq2.dir/{name}.contrast": f"{factor}\t{a}\t{b}\n"
+            for name, a, b in contrasts}
+
+
+def deseq2ContrastsUptodate(infile, outfiles):
+    '''ruffus up to date check, contrast files are rewritten if
+       report: comparisons or deseq2: factor in pipeline.yml, or the
+       sample categories, no longer give the same contrasts'''
+
+    if not os.path.exists(infile):
+        return True, "sample info missing"
+
+    current = contrastFiles(infile)
+
+    if set(current) != set(glob.glob("deseq2.dir/*.contrast")):
+        return True, "contrasts added or removed"
+
+    for outfile, contrast in current.items():
+        with open(outfile) as inf:
+            if inf.read() != contrast:
+                return True, f"{outfile} changed"
+
+    return False, "contrasts are current"
+
+
+@follows(mkdir("deseq2.dir"))
+@check_if_uptodate(deseq2ContrastsUptodate)
+@split(makeSampleInfoTable, "deseq2.dir/*.contrast")
+@instrument
+def deseq2Contrasts(infile, outfiles):
+    '''Write a file per DESeq2 contrast, those of report: comparisons
+       in pipeline.yml or all pairs of sample categories. Files of
+       unchanged contrasts are left as they are, so their results are
+       not recomputed. Results of removed contrasts are deleted'''
+
+    current = contrastFiles(infile)
+
+    for outfile in glob.glob("deseq2.dir/*.contrast"):
+        if outfile not in current:
+            name = os.path.basename(outfile)[:-len(".contrast")]
+            for stale in (outfile,
+                          f"deseq2.dir/DESeq2_{name}.tsv",
+                          f"deseq2.dir/DESeq2_{name}.load"):
+                if os.path.exists(stale):
+                    os.unlink(stale)
+
+    for outfile, contrast in current.items():
+        if os.path.exists(outfile):
+            with open(outfile) as inf:
+                if inf.read() == contrast:
+                    continue
+
+        with open(outfile, "w") as outf:
+            outf.write(contrast)
+
+
+def deseq2Settings():
+    '''Return the DESeq2 design & fitType of pipeline.yml as a
+       one row dataframe'''
+
+    return pd.DataFrame([[PARAMS.get("deseq2_design") or "~ category",
+                          PARAMS.get("deseq2_fit_type") or "local"]],
+                        columns=["design", "fit_type"])
+
+
+def deseq2DesignUptodate(infile, outfile):
+    '''ruffus up to date check, the DESeq2 settings are rewritten, and
+       the model refitted, if deseq2: design or fit_type changed'''
+
+    if os.path.exists(outfile) and \
+       pd.read_csv(outfile, sep="\t", dtype=str).equals(deseq2Settings()):
+        return False, "design is current"
+
+    return True, "design missing or changed"
+
+
+@follows(connect, mkdir("deseq2.dir"))
+@check_if_uptodate(deseq2DesignUptodate)
+@files(None, "deseq2.dir/design.tsv")
+@instrument
+def deseq2Design(infile, outfile):
+    '''Write & load the DESeq2 design & fitType the model is fitted
+       with. The DESeq2 report takes them from the report bundle, so it
+       loads the pipeline's fit from the cache'''
+
+    settings = deseq2Settings()
+
+    settings.to_csv(outfile, sep="\t", index=False)
+
+    CsvDB.bulkLoad(database(), "DESeq2_design", [settings])
+
+
+@follows(featureCountMatrix, mkdir("deseq2.dir"))
+@merge([makeSampleInfoTable, deseq2Design, "matrix.dir/featureCounts/values.npy"],
+       "deseq2.dir/dds.rds")
+@instrument
+def deseq2Fit(infiles, outfile):
+    '''Fit the DESeq2 model once, to the read counts of all samples
+       with the design of pipeline.yml. The fit, VST counts & LRT
+       results are cached by checksum of the counts, sample info &
+       design in deseq2.dir/cache, where the DESeq2 report loads them'''
+
+    srcdir = os.path.dirname(os.path.abspath(__file__))
+
+    sample_info, settings, counts = infiles
+
+    threads, memory = PipelineMrnaseq.getResources(
+        PARAMS, "deseq2Fit", "deseq2", threads=4, memory="8G")
+
+    settings = pd.read_csv(settings, sep="\t", dtype=str).iloc[0]
+    design, fit_type = settings["design"], settings["fit_type"]
+
+    statement = f'''Rscript {srcdir}/DESeq2Analysis.R fit
+                      --counts {os.path.dirname(counts)}
+                      --sample-info {sample_info}
+                      --design "{design}"
+                      --fit-type {fit_type}
+                      --threads {threads}
+                      --cache-dir deseq2.dir/cache
+                      --output {outfile}'''
+
+    run(statement, job_threads=threads, job_memory=memory)
+
+
+@transform(deseq2Contrasts,
+           regex(r"deseq2.dir/(.*).contrast"),
+           add_inputs(deseq2Fit),
+           r"deseq2.dir/DESeq2_\1.tsv")
+@instrument
+def deseq2Contrast(infiles, outfile):
+    '''DESeq2 results of a contrast, each contrast is a separate job
+       using the fitted model'''
+
+    srcdir = os.path.dirname(os.path.abspath(__file__))
+
+    contrast, dds = infiles
+    factor, a, b = readContrast(contrast)
+
+    threads, memory = PipelineMrnaseq.getResources(
+        PARAMS, "deseq2Contrast", "deseq2_contrast", threads=1, memory="8G")
+
+    statement = f'''Rscript {srcdir}/DESeq2Analysis.R contrast
+                      --dds {dds}
+                      --factor {factor}
+                      --a {a}
+                      --b {b}
+                      --output {outfile}'''
+
+    run(statement, job_threads=threads, job_memory=memory)
+
+
+@follows(annotationCache)
+@transform(deseq2Contrast, suffix(r".tsv"), r".load")
+@instrument
+def loadDESeq2Contrast(infile, outfile):
+    '''Load the DESeq2 results of a contrast into a table of its own,
+       with the gene_name of each gene from the cached annotation'''
+
+    genes = PipelineMrnaseq.loadTranscriptGeneMap(PARAMS)
+    genes = genes[["gene_id", "gene_name"]].drop_duplicates("gene_id")
+
+    results = pd.read_csv(infile, sep="\t", dtype={"gene_id": str})
+    results = pd.merge(results, genes, how="left", on="gene_id")
+    results = results[["gene_id", "gene_name"] +
+                      [x for x in results.columns if x not in ("gene_id", "gene_name")]]
+
+    nrows = CsvDB.bulkLoad(database(), P.to_table(outfile), [results], index="gene_id")
+
+    with open(outfile, "w") as outf:
+        outf.write("loaded %i rows\n" % nrows)
+
+
+@merge(loadDESeq2Contrast, "deseq2.dir/DESeq2_contrasts.load")
+@instrument
+def loadDESeq2Contrasts(infiles, outfile):
+    '''Load the table of DESeq2 contrasts, with the table & file of
+       results of each. Tables of contrasts that were removed are
+       dropped'''
+
+    contrasts = []
+
+    for infile in sorted(infiles):
+        comparison = re.match(r"deseq2.dir/DESeq2_(.*).load", infile).group(1)
+        factor, a, b = readContrast(f"deseq2.dir/{comparison}.contrast")
+        contrasts.append([comparison, factor, a, b, P.to_table(infile),
+                          re.sub(r".load$", ".tsv", infile)])
+
+    contrasts = pd.DataFrame(contrasts, columns=["comparison", "factor", "a", "b",
+                                                 "tablename", "results"])
+
+    table = P.to_table(outfile)
+    dbh = CsvDB.getConnection(database())
+
+    if CsvDB.tableColumns(dbh, table):
+        loaded = [x[0] for x in dbh.execute(
+            f'''select tablename from {CsvDB.quote(table)}''')]
+        CsvDB.dropTables(database(), [x for x in loaded
+                                      if x not in set(contrasts["tablename"])])
+
+    CsvDB.bulkLoad(database(), table, [contrasts], index="comparison")
+
+    with open(outfile, "w") as outf:
+        outf.write("loaded %i rows\n" % len(contrasts))
+
+
+@follows(loadDESeq2Contrasts)
+def deseq2():
+    pass
+
 # ---------------------------------------------------
 # Generic pipeline tasks
 @follows(mapping, summarystats, readcounts, readquant, coverage)
+@merge("metrics.dir/*.tsv", "pipeline_task_metrics.load")
+def loadTaskMetrics(infiles, outfile):
+    '''Load timing & resource usage of task jobs, accumulated over
+       runs, into pipeline_task_metrics. Not instrumented itself, so
+       it is up to date until other tasks run'''
+
+    text = {x: str for x in ("task", "job", "kind", "hostname", "memory_requested")}
+    chunks = (pd.read_csv(x, sep="\t", dtype=text) for x in sorted(infiles))
+
+    nrows = CsvDB.bulkLoad(database(), P.to_table(outfile), chunks,
+                           index=["task"])
+
+    with open(outfile, "w") as outf:
+        outf.write("loaded %i rows\n" % nrows)
+
+
+@follows(mapping, summarystats, readcounts, readquant, coverage, loadTaskMetrics)
 def full():
     pass
 
 
-#@follows(full)
-@files(None, "*.nbconvert.html")
-def report(infile, outfile):
-    '''Generate html report on pipeline results from ipynb template(s)'''
+@follows(full, mkdir(ReportData.BUNDLE_DIR))
+@merge([makeSampleInfoTable, loadpicardAlignmentSummary, loadPicardRNAseqMetrics,
+        featureCountMatrix, salmonGeneMatrix, loadSampleCorrelation, deseq2Design,
+        loadDESeq2Contrasts],
+       f"{ReportData.BUNDLE_DIR}/manifest.tsv")
+@instrument
+def reportData(infiles, outfile):
+    '''Materialise the data plotted by the reports, sample info, QC
+       metrics joined to it, protein coding genes and count & TPM
+       matrices, in a bundle the notebooks load in one call'''
+
+    ReportData.writeBundle(database(), PARAMS["annotations_database"],
+                           os.path.dirname(outfile))
+
+
+def reportJobs():
+    '''Yield (template, html report) for each report template'''
 
-    templates = PARAMS["report_path"]
+    templates = PARAMS.get("report_path") or []
 
     if len(templates)==0:
-        print("Specify Jupyter ipynb template path in pipeline.ini for html report generation")
-        pass
-    
+        print("Specify Jupyter ipynb template path in pipeline.yml for html report generation")
+
     for template in templates:
-        infile = os.path.basename(template)
-        outfile = infile.replace(".ipynb", ".nbconvert.html")
-        nbconvert = infile.replace(".ipynb", ".nbconvert.ipynb")
-        tmp = os.path.basename(template)
-        
-        statement = f'''cp {template} .  &&
-                        jupyter nbconvert 
-                          --to notebook 
-                          --allow-errors 
-                          --ExecutePreprocessor.timeout=-1
-                          --execute {infile} && 
-                        jupyter nbconvert 
-                          --to html 
-                          --ExecutePreprocessor.timeout=-1
-                          --execute {nbconvert} &&
-                        rm {tmp}'''
-
-        P.run(statement)
+        yield template, os.path.basename(template).replace(".ipynb", ".nbconvert.html")
+
+
+def reportUptodate(infile, outfile):
+    '''ruffus up to date check, reports are re-run when their template
+       or the tables & files they read change'''
+
+    if ReportEngine.reportIsCurrent(infile, outfile, database()):
+        return False, "report is current"
+
+    return True, "report missing, or its template or inputs changed"
+
+
+@follows(reportData)
+@check_if_uptodate(reportUptodate)
+@files(reportJobs)
+@instrument
+def report(infile, outfile):
+    '''Generate html report on pipeline results from an ipynb template.
+       The template is executed once and exported to html, templates
+       are rendered in parallel'''
+
+    srcdir = os.path.dirname(os.path.abspath(__file__))
+
+    threads, memory = PipelineMrnaseq.getResources(
+        PARAMS, "report", "report", threads=1, memory="8G")
+
+    timeout = PARAMS.get("report_timeout")
+    timeout = f"--timeout {timeout}" if timeout not in (None, "") else ""
+
+    # report notebooks import helper modules from the pipeline directory
+    statement = f'''export PYTHONPATH={srcdir}:$PYTHONPATH &&
+                    python {srcdir}/ReportEngine.py
+                      --database {database()}
+                      {timeout}
+                      --force
+                      {infile} {outfile}'''
+
+    run(statement, job_threads=threads, job_memory=memory)
+
+def main(argv=None):
+    '''Read the configuration up front when running the pipeline,
+       job submission takes its cluster options from it'''
+
+    PARAMS.load()
+
+    return P.main(argv)
+
 
 if __name__ == "__main__":
-    sys.exit(P.main(sys.argv))
+    sys.exit(main(sys.argv))
@@ -0,0 +1,7 @@
+'''pytest configuration, the modules under test sit next to
+pipeline_mrnaseq.py rather than in a package'''
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
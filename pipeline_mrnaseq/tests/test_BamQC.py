@@ -0,0 +1,32 @@
+import numpy as np
+import BamQC
+
+
+def test_segments_take_highest_level():
+    bounds, level = BamQC.segments([(0, 10, 1), (5, 20, 2), (30, 40, 1)], levels=2)
+
+    assert bounds.tolist() == [0, 5, 10, 20, 30, 40]
+    assert level.tolist() == [1, 2, 2, 0, 1]
+
+
+def test_segments_skip_empty_intervals():
+    bounds, level = BamQC.segments([(5, 5, 1)], levels=1)
+
+    assert bounds.tolist() == [0]
+    assert len(level) == 0
+
+
+def test_level_bases():
+    bounds, level = BamQC.segments([(0, 10, 1), (5, 20, 2)], levels=2)
+
+    starts = np.array([0, 3, 8, 25, -5])
+    ends = np.array([20, 7, 12, 30, 50])
+
+    assert BamQC.levelBases(bounds, level, 1, starts, ends).tolist() == [5, 2, 0, 0, 5]
+    assert BamQC.levelBases(bounds, level, 2, starts, ends).tolist() == [15, 2, 4, 0, 15]
+
+
+def test_level_bases_without_segments():
+    bounds, level = BamQC.segments([], levels=1)
+
+    assert BamQC.levelBases(bounds, level, 1, np.array([0]), np.array([10])).tolist() == [0]
@@ -0,0 +1,24 @@
+import pandas as pd
+import BenchmarkMrnaseq
+
+
+def results(rows):
+    return pd.DataFrame(rows, columns=BenchmarkMrnaseq.RESULT_COLUMNS)
+
+
+def test_compare_baseline():
+    baseline = results([["a", 10, 100, 1.0, 100.0, "ok"],
+                        ["b", 10, 100, 1.0, 100.0, "ok"],
+                        ["c", 10, 100, 0.01, 100.0, "ok"],
+                        ["d", 10, 100, 1.0, 100.0, "ok"]])
+
+    current = results([["a", 10, 100, 1.1, 110.0, "ok"],     # within threshold
+                       ["b", 10, 100, 2.0, 100.0, "ok"],     # slower
+                       ["c", 10, 100, 0.03, 100.0, "ok"],    # too fast to time
+                       ["d", 10, 100, 1.0, 200.0, "ok"],     # bigger
+                       ["e", 10, 100, 1.0, 100.0, "ok"]])    # no baseline
+
+    compared = BenchmarkMrnaseq.compareBaseline(current, baseline, threshold=0.25)
+
+    assert compared["regression"].tolist() == [False, True, False, True, False]
+    assert compared.loc[1, "time_ratio"] == 2.0
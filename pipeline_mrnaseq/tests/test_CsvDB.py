@@ -0,0 +1,47 @@
+import sqlite3
+import pandas as pd
+import CsvDB
+
+
+def test_chunks_load_the_union_of_their_columns(tmp_path):
+    db = str(tmp_path / "csvdb")
+    chunks = [pd.DataFrame({"gene_id": ["g1"], "a": [1]}),
+              pd.DataFrame({"gene_id": ["g2"], "b": [2.5]})]
+
+    assert CsvDB.bulkLoad(db, "counts", chunks, index="gene_id") == 2
+
+    rows = sqlite3.connect(db).execute(
+        '''select gene_id, a, b from counts order by gene_id''').fetchall()
+    assert rows == [("g1", 1, None), ("g2", None, 2.5)]
+
+
+def test_appending_keeps_the_existing_columns(tmp_path):
+    db = str(tmp_path / "csvdb")
+
+    CsvDB.bulkLoad(db, "counts", [pd.DataFrame({"gene_id": ["g1"], "a": [1]})])
+    CsvDB.bulkLoad(db, "counts", [pd.DataFrame({"a": [2]})], replace=False)
+
+    assert sqlite3.connect(db).execute(
+        '''select gene_id, a from counts order by a''').fetchall() == [("g1", 1), (None, 2)]
+
+
+def test_replacing_with_no_chunks_drops_the_table(tmp_path):
+    db = str(tmp_path / "csvdb")
+
+    CsvDB.bulkLoad(db, "counts", [pd.DataFrame({"a": [1]})])
+
+    assert CsvDB.bulkLoad(db, "counts", [], index="a") == 0
+    assert CsvDB.tableColumns(CsvDB.getConnection(db), "counts") == []
+
+
+def test_concatenate_files_with_different_columns(tmp_path):
+    db = str(tmp_path / "csvdb")
+    pd.DataFrame({"x": [1], "y": [2]}).to_csv(tmp_path / "s1.tsv", sep="\t", index=False)
+    pd.DataFrame({"x": [3]}).to_csv(tmp_path / "s2.tsv", sep="\t", index=False)
+
+    CsvDB.concatenateAndLoad(db, [str(tmp_path / "s1.tsv"), str(tmp_path / "s2.tsv")],
+                             "stats", r"(s\d).tsv")
+
+    assert sqlite3.connect(db).execute(
+        '''select sample_id, x, y from stats order by x''').fetchall() == \
+        [("s1", 1, 2), ("s2", 3, None)]
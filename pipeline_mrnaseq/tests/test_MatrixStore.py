@@ -0,0 +1,41 @@
+import numpy as np
+import pandas as pd
+import MatrixStore
+
+
+def test_round_trip(tmp_path):
+    counts = pd.DataFrame({"b": [0, 5, 7], "a": [1, 2, 3]},
+                          index=pd.Index(["g1", "g2", "g3"], name="gene_id"))
+
+    MatrixStore.writeMatrix(counts, str(tmp_path / "counts"))
+
+    assert MatrixStore.openMatrix(str(tmp_path / "counts")).dtype == np.int32
+    pd.testing.assert_frame_equal(MatrixStore.loadMatrix(str(tmp_path / "counts")),
+                                  counts.astype(np.int32))
+
+    subset = MatrixStore.loadMatrix(str(tmp_path / "counts"), genes=["g3", "g1"], samples=["a"])
+    assert subset["a"].tolist() == [3, 1]
+    assert subset.index.tolist() == ["g3", "g1"]
+
+
+def test_whole_floats_stay_floats():
+    values = np.array([[1.0, 2.0], [3.0, 4.0]])
+
+    assert MatrixStore.compactDtype(values) == np.float32
+    assert MatrixStore.compactDtype(values, downcast=True) == np.int32
+    assert MatrixStore.compactDtype(values * 2 ** 40, downcast=True) == np.float64
+
+
+def test_large_integers_are_not_truncated():
+    assert MatrixStore.compactDtype(np.array([1, 2 ** 40])) == np.float64
+
+
+def test_int64_counts_round_trip(tmp_path):
+    counts = pd.DataFrame({"a": np.array([1, 2 ** 40], dtype=np.int64)},
+                          index=pd.Index(["g1", "g2"], name="gene_id"))
+
+    MatrixStore.writeMatrix(counts, str(tmp_path / "counts"))
+
+    # stored as float64, which R reads, rather than int64
+    assert MatrixStore.openMatrix(str(tmp_path / "counts")).dtype == np.float64
+    assert MatrixStore.loadMatrix(str(tmp_path / "counts"))["a"].tolist() == [1, 2 ** 40]
@@ -0,0 +1,185 @@
+import os
+import sqlite3
+import pandas as pd
+import pytest
+import CsvDB
+import PipelineMrnaseq
+
+
+GENES = ["g1", "g2", "g3"]
+
+
+def writeCounts(path, sample, counts, mtime):
+    '''Write a featureCounts table of one sample, modified at mtime'''
+
+    with open(path, "w") as outf:
+        outf.write("# Program:featureCounts v1.6.3\n")
+        outf.write("Geneid\tChr\tStart\tEnd\tStrand\tLength\tbam.dir/%s.bam\n" % sample)
+        for gene, count in zip(GENES, counts):
+            outf.write(f"{gene}\t1\t1\t100\t+\t100\t{count}\n")
+
+    os.utime(path, (mtime, mtime))
+    return str(path)
+
+
+def test_modified_since(tmp_path):
+    infile, outfile = tmp_path / "in", tmp_path / "out"
+    infile.touch()
+
+    assert PipelineMrnaseq.modifiedSince(str(infile), str(outfile))
+
+    outfile.touch()
+    os.utime(infile, (100, 100))
+    os.utime(outfile, (200, 200))
+    assert not PipelineMrnaseq.modifiedSince(str(infile), str(outfile))
+
+    os.utime(infile, (300, 300))
+    assert PipelineMrnaseq.modifiedSince(str(infile), str(outfile))
+
+
+def test_splice_feature_counts(tmp_path):
+    outfile = str(tmp_path / "featureCounts.txt")
+    a = writeCounts(tmp_path / "a.counts.txt", "a", [1, 2, 3], 100)
+    b = writeCounts(tmp_path / "b.counts.txt", "b", [4, 5, 6], 100)
+
+    assert PipelineMrnaseq.spliceFeatureCounts([a, b], outfile) == ["a", "b"]
+    os.utime(outfile, (200, 200))
+
+    # b recounted, c added, a removed
+    b = writeCounts(tmp_path / "b.counts.txt", "b", [7, 8, 9], 300)
+    c = writeCounts(tmp_path / "c.counts.txt", "c", [0, 0, 1], 300)
+
+    assert PipelineMrnaseq.spliceFeatureCounts([b, c], outfile) == ["b", "c"]
+
+    merged = PipelineMrnaseq.readFeatureCounts(outfile)
+    assert list(merged.columns) == PipelineMrnaseq.FEATURECOUNTS_ANNOTATION + ["b", "c"]
+    assert merged["b"].tolist() == [7, 8, 9]
+    assert merged["c"].tolist() == [0, 0, 1]
+
+
+def test_splice_feature_counts_skips_current_samples(tmp_path):
+    outfile = str(tmp_path / "featureCounts.txt")
+    a = writeCounts(tmp_path / "a.counts.txt", "a", [1, 2, 3], 100)
+
+    PipelineMrnaseq.spliceFeatureCounts([a], outfile)
+    os.utime(outfile, (200, 200))
+
+    assert PipelineMrnaseq.spliceFeatureCounts([a], outfile) == []
+
+
+def test_splice_matrix(tmp_path):
+    outfile = str(tmp_path / "salmon_genes.txt")
+    pd.DataFrame({"a": [1.0, 2.0], "b": [3.0, 4.0]},
+                 index=["g1", "g2"]).to_csv(outfile, sep="\t", index_label="gene_id")
+
+    vectors = {"b": pd.Series([5.0, 6.0], index=["g1", "g2"]),
+               "c": pd.Series([7.0, 8.0], index=["g1", "g2"])}
+
+    matrix = PipelineMrnaseq.spliceMatrix(outfile, vectors, ["b", "c"], "gene_id")
+
+    expected = pd.DataFrame({"b": [5.0, 6.0], "c": [7.0, 8.0]}, index=["g1", "g2"])
+    pd.testing.assert_frame_equal(matrix, expected)
+    pd.testing.assert_frame_equal(
+        pd.read_csv(outfile, sep="\t", index_col=0).rename_axis(None), expected)
+
+
+def test_upsert_columns(tmp_path):
+    db = str(tmp_path / "csvdb")
+    table = 'feature "counts"'
+    CsvDB.bulkLoad(db, table, [pd.DataFrame({"Geneid": GENES, "a": [1, 2, 3],
+                                             'b"1': [4, 5, 6]})])
+
+    matrix = pd.DataFrame({"a": [1, 2, 3], 'b"1': [7, 8, 9], "c": [0, 0, 1]}, index=GENES)
+
+    assert PipelineMrnaseq.upsertColumns(db, table, matrix, "Geneid", ['b"1'])
+
+    loaded = pd.read_sql_query('select * from "feature ""counts"""', sqlite3.connect(db))
+    assert list(loaded.columns) == ["Geneid", "a", 'b"1', "c"]
+    assert loaded['b"1'].tolist() == [7, 8, 9]
+    assert loaded["c"].tolist() == [0, 0, 1]
+
+
+def test_upsert_columns_reloads_when_samples_are_removed(tmp_path):
+    db = str(tmp_path / "csvdb")
+    CsvDB.bulkLoad(db, "featureCounts", [pd.DataFrame({"Geneid": GENES, "a": [1, 2, 3],
+                                                       "b": [4, 5, 6]})])
+
+    matrix = pd.DataFrame({"b": [4, 5, 6]}, index=GENES)
+
+    assert not PipelineMrnaseq.upsertColumns(db, "featureCounts", matrix, "Geneid", [])
+    assert not PipelineMrnaseq.upsertColumns(db, "missing", matrix, "Geneid", [])
+
+
+def test_upsert_rows(tmp_path):
+    db = str(tmp_path / "csvdb")
+    CsvDB.bulkLoad(db, "salmon", [pd.DataFrame({"sample_id": ["a", "a", "b", "b"],
+                                                "Name": ["t1", "t2", "t1", "t2"],
+                                                "TPM": [1.0, 2.0, 3.0, 4.0]})],
+                   index=["Name"])
+
+    frames = {"b": pd.DataFrame({"Name": ["t1", "t2"], "TPM": [5.0, 6.0]}),
+              "c": pd.DataFrame({"Name": ["t1", "t2"], "TPM": [7.0, 8.0]})}
+
+    assert PipelineMrnaseq.upsertRows(db, "salmon", frames, ["b", "c"])
+
+    dbh = sqlite3.connect(db)
+    loaded = pd.read_sql_query("select * from salmon order by sample_id, Name", dbh)
+    assert loaded["sample_id"].tolist() == ["b", "b", "c", "c"]
+    assert loaded["TPM"].tolist() == [5.0, 6.0, 7.0, 8.0]
+
+    # deletes are served by an index on the key
+    plan = dbh.execute("explain query plan delete from salmon where sample_id = 'b'").fetchall()
+    assert "salmon_sample_id" in str(plan)
+
+    assert not PipelineMrnaseq.upsertRows(db, "missing", frames, ["b", "c"])
+
+
+def writeQuant(path, rows):
+    pd.DataFrame(rows, columns=["Name", "Length", "EffectiveLength", "TPM", "NumReads"]
+                 ).to_csv(path, sep="\t", index=False)
+    return str(path)
+
+
+def test_aggregate_salmon(tmp_path):
+    tx2gene = pd.DataFrame({"transcript_id": ["t1", "t2", "t3", "t5"],
+                            "gene_id": ["g1", "g1", "g2", "g3"]})
+
+    quants = {"a": writeQuant(tmp_path / "a.sf", [["t1", 100, 90, 1.0, 10.0],
+                                                  ["t2", 100, 90, 2.0, 20.0],
+                                                  ["t3", 100, 90, 4.0, 40.0],
+                                                  ["t4", 100, 90, 8.0, 80.0]]),
+              # other transcript order, as from another salmon index
+              "b": writeQuant(tmp_path / "b.sf", [["t3", 100, 90, 3.0, 30.0],
+                                                  ["t1", 100, 90, 5.0, 50.0],
+                                                  ["t2", 100, 90, 0.0, 0.0]])}
+
+    matrices = PipelineMrnaseq.aggregateSalmon(quants, tx2gene)
+
+    # t4 is not in tx2gene, g3 has no quantified transcript
+    expected = pd.DataFrame({"a": [3.0, 4.0], "b": [5.0, 3.0]},
+                            index=pd.Index(["g1", "g2"], name="gene_id"))
+
+    pd.testing.assert_frame_equal(matrices["TPM"], expected)
+    pd.testing.assert_frame_equal(matrices["NumReads"], expected * 10)
+
+
+def test_deseq2_contrasts_sanitise_names():
+    contrasts = PipelineMrnaseq.deseq2Contrasts(["WT-0hr", "KO 2hr", "WT-0hr"])
+
+    assert contrasts == [("WT_0hr_VS_KO_2hr", "WT-0hr", "KO 2hr")]
+
+
+def test_deseq2_contrasts_reject_colliding_names():
+    with pytest.raises(ValueError):
+        PipelineMrnaseq.deseq2Contrasts(["a", "b"], {"a.b": ["a", "b"], "a b": ["b", "a"]})
+
+
+def test_auto_threads_need_node_cores_on_a_cluster():
+    params = {"resources_node_cores": "auto", "resources_jobs_per_node": 2}
+
+    with pytest.raises(ValueError):
+        PipelineMrnaseq.resolveThreads(params, "auto")
+
+    assert PipelineMrnaseq.resolveThreads(dict(params, resources_node_cores=16), "auto") == 8
+    assert PipelineMrnaseq.resolveThreads(dict(params, without_cluster=True), "auto") >= 1
+    assert PipelineMrnaseq.resolveThreads(params, 4) == 4
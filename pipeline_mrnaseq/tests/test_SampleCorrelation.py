@@ -0,0 +1,54 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import MatrixStore
+import SampleCorrelation
+
+
+@pytest.fixture
+def values():
+    rng = np.random.default_rng(0)
+    # ties, for the average ranks of spearman
+    return np.round(rng.gamma(1.0, 10.0, size=(1003, 5))).astype(np.float32)
+
+
+@pytest.mark.parametrize("method", ["pearson", "spearman"])
+def test_blockwise_correlation(values, method):
+    expected = pd.DataFrame(values.astype(np.float64)).corr(method=method).values
+
+    result = SampleCorrelation.ENGINES[method](values, block_size=100, threads=3)
+
+    np.testing.assert_allclose(result, expected, rtol=1e-5, atol=1e-6)
+
+
+def test_blockwise_manhattan(values):
+    expected = np.abs(values[:, :, None] - values[:, None, :]).sum(axis=0, dtype=np.float64)
+
+    result = SampleCorrelation.manhattan(values, block_size=100, threads=3)
+
+    np.testing.assert_allclose(result, expected, rtol=1e-6)
+
+
+def test_average_ranks():
+    ranks = SampleCorrelation.averageRanks(np.array([3.0, 1.0, 3.0, 2.0]))
+
+    assert ranks.tolist() == [3.5, 1.0, 3.5, 2.0]
+
+
+
+def test_cache_keeps_the_most_recently_used_matrices(tmp_path):
+    cache = tmp_path / "cache"
+    matrices = [pd.DataFrame({"a": [1.0 + n, 2.0, 3.0], "b": [3.0, 1.0, 2.0 + n]})
+                for n in range(3)]
+
+    for n, matrix in enumerate(matrices):
+        for method in ("pearson", "manhattan"):
+            SampleCorrelation.sampleCorrelation(matrix, method, cache_dir=str(cache))
+            cached = cache / f"{MatrixStore.matrixChecksum(matrix)}.{method}.npy"
+            os.utime(cached, (1000 * n, 1000 * n))
+
+    SampleCorrelation.pruneCache(str(cache), keep=2)
+
+    kept = {x.name.split(".")[0] for x in cache.iterdir()}
+    assert kept == {MatrixStore.matrixChecksum(x) for x in matrices[1:]}